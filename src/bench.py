@@ -0,0 +1,202 @@
+# coding: utf-8
+#
+# Copyright (c) 2015--2016, Kang Seonghoon.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+# times each stage of process.py against the actual font sources.
+# results are appended to a JSON history (one entry per run, with the current commit),
+# and the run fails when any stage got slower than the previous (or given) entry by a threshold.
+
+import time
+import sys
+import os
+import os.path
+import glob
+import json
+import argparse
+import subprocess
+from cStringIO import StringIO
+from collections import OrderedDict
+
+import process
+from process import ParseError, Font, ContourCache, Pixels, track_contour, PX_SUBPIXEL
+
+HISTORY_PATH = os.path.join(process.ExternalData.cache.path, 'bench.json')
+
+def run_build(sources):
+    # returns an OrderedDict of stage name: seconds.
+    # other than the stages themselves nothing is cached between runs, including contours.
+    times = process.STAGE_TIMES = OrderedDict()
+    try:
+        font = Font()
+        for path, lines in sources:
+            t = time.time()
+            try:
+                font.read(lines)
+            except ParseError as e:
+                raise ParseError(u'%s: %s' % (path, e))
+            times['read:' + os.path.basename(path)] = time.time() - t
+
+        t = time.time()
+        font.resolve_glyphs()
+        t = process.stage_done('resolve_glyphs', t)
+        font.inline_glyphs()
+        process.stage_done('inline_glyphs', t)
+
+        # traced separately, so that write_ttf below doesn't include the tracing
+        contour_cache = ContourCache()
+        pending = OrderedDict()
+        for _, glyph in sorted(font.glyphs.items()):
+            for g in glyph.subglyphs:
+                if not isinstance(g.data, Pixels): continue
+                key = ContourCache.make_key(g.height, g.width, g.stride, g.data, PX_SUBPIXEL)
+                pending[key] = g.height, g.width, g.width, bytearray(key[3])
+        t = time.time()
+        for key, (height, width, stride, data) in pending.items():
+            contour_cache.put(key, track_contour(height, width, stride, data, PX_SUBPIXEL))
+        t = process.stage_done('track_contour', t)
+
+        font.write_ttf(StringIO(), contour_cache=contour_cache)
+        t = process.stage_done('write_ttf', t)
+        font.write_binary(StringIO())
+        t = process.stage_done('write_binary', t)
+        font.write_json(StringIO())
+        process.stage_done('write_json', t)
+    finally:
+        process.STAGE_TIMES = None
+    return times
+
+def get_commit():
+    # returns (commit id, whether the working tree has uncommitted changes) or (None, None)
+    root = os.path.join(os.path.dirname(__file__), '..')
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=root).strip() != ''
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks each stage of src/process.py.')
+    parser.add_argument('sources', nargs='*', metavar='SOURCE',
+                        help='font source files (glob patterns are accepted)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, metavar='N',
+                        help='number of measured runs (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=1, metavar='N',
+                        help='number of unmeasured runs before measuring (default: %(default)s)')
+    parser.add_argument('--history', default=HISTORY_PATH, metavar='PATH',
+                        help='JSON file to keep the results in (default: cache/bench.json)')
+    parser.add_argument('--no-save', dest='save', action='store_false',
+                        help='do not append the results to the history')
+    parser.add_argument('--baseline', metavar='COMMIT',
+                        help='compare with the latest entry for this commit (prefix) '
+                             'instead of the latest entry')
+    parser.add_argument('--threshold', type=float, default=0.2, metavar='RATIO',
+                        help='fail when a stage gets slower by this ratio (default: %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=0.01, metavar='SECONDS',
+                        help='ignore slowdowns smaller than this, which are mostly noises '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+    if args.repeat < 1: parser.error('--repeat should be positive')
+
+    sources = []
+    for pat in args.sources:
+        for path in glob.glob(pat):
+            with open(path, 'rb') as f:
+                sources.append((path, f.readlines()))
+    if not sources: parser.error('no source files given')
+
+    samples = OrderedDict() # stage name: [seconds, ...]
+    try:
+        for i in xrange(args.warmup):
+            print >>sys.stderr, 'warming up (%d/%d)...' % (i + 1, args.warmup)
+            run_build(sources)
+        for i in xrange(args.repeat):
+            print >>sys.stderr, 'measuring (%d/%d)...' % (i + 1, args.repeat)
+            for stage, elapsed in run_build(sources).items():
+                samples.setdefault(stage, []).append(elapsed)
+    except ParseError as e:
+        print >>sys.stderr, unicode(e).encode('utf-8')
+        raise SystemExit(1)
+
+    commit, dirty = get_commit()
+    entry = OrderedDict([
+        ('commit', commit),
+        ('dirty', dirty),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ('python', sys.version.split()[0]),
+        ('repeat', args.repeat),
+        ('stages', OrderedDict((stage, OrderedDict([('min', min(times)),
+                                                    ('median', median(times))]))
+                               for stage, times in samples.items())),
+    ])
+
+    try:
+        with open(args.history, 'rb') as f:
+            history = json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        history = []
+    baseline = None
+    for prev in reversed(history):
+        if not args.baseline or (prev['commit'] or '').startswith(args.baseline):
+            baseline = prev
+            break
+    if args.baseline and not baseline:
+        print >>sys.stderr, 'no history entry for the commit %s' % args.baseline
+        raise SystemExit(2)
+
+    # the minimum is compared, as it is least affected by other processes
+    regressed = []
+    print '%-28s %9s %9s %9s %8s' % ('stage', 'min', 'median', 'baseline', 'change')
+    for stage, result in entry['stages'].items():
+        base = baseline and baseline['stages'].get(stage)
+        if base:
+            change = (result['min'] - base['min']) / base['min'] if base['min'] else 0
+            mark = ''
+            if change > args.threshold and result['min'] - base['min'] > args.min_delta:
+                regressed.append(stage)
+                mark = ' !'
+            print '%-28s %8.3fs %8.3fs %8.3fs %+7.1f%%%s' % (
+                    stage, result['min'], result['median'], base['min'], change * 100, mark)
+        else:
+            print '%-28s %8.3fs %8.3fs %9s %8s' % (stage, result['min'], result['median'], '-', '-')
+    if baseline:
+        print '(baseline: commit %s at %s)' % ((baseline['commit'] or 'unknown')[:10],
+                                               baseline['time'])
+
+    if args.save:
+        history.append(entry)
+        try:
+            os.makedirs(os.path.dirname(args.history))
+        except Exception:
+            pass
+        with open(args.history, 'wb') as f:
+            json.dump(history, f, indent=1)
+
+    if regressed:
+        print >>sys.stderr, '%d stage(s) regressed by more than %d%%: %s' % (
+                len(regressed), args.threshold * 100, ', '.join(regressed))
+        raise SystemExit(1)
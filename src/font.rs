@@ -3,6 +3,8 @@ use std::error::Error;
 use std::io::{self, Read};
 use std::collections::{BTreeMap, BTreeSet};
 use serde_json;
+use rmp::Marker;
+use rmp::decode;
 
 pub const PX_SUBPIXEL: u8 = 0x1f;
 pub const PX_FULL:     u8 = 0x20;
@@ -109,6 +111,98 @@ pub enum RemapItem {
     List(Vec<String>), // glyph names
 }
 
+// the binary interchange format written by `Font.write_binary` in process.py (see there).
+pub const BINARY_MAGIC: &'static str = "unison";
+pub const BINARY_VERSION: i64 = 1;
+
+const BINARY_INDEX_SIZE: usize = 8;
+const BINARY_GLYPH_SIZE: usize = 28;
+const BINARY_SUBGLYPH_SIZE: usize = 36;
+const BINARY_POINT_SIZE: usize = 12;
+const BINARY_CMAP_SIZE: usize = 8;
+
+const BINARY_DATA_NONE: u32 = 0;
+const BINARY_DATA_PIXELS: u32 = 1;
+const BINARY_DATA_NAMED: u32 = 2;
+const BINARY_DATA_ADJOIN: u32 = 3;
+
+fn invalid_data<E: fmt::Debug>(e: E) -> io::Error {
+    io::Error::new(io::ErrorKind::InvalidData, format!("invalid binary font: {:?}", e))
+}
+
+struct BinaryReader<'a> {
+    buf: &'a [u8],
+}
+
+impl<'a> BinaryReader<'a> {
+    fn int(&mut self) -> io::Result<i64> {
+        decode::read_int(&mut self.buf).map_err(invalid_data)
+    }
+
+    fn str(&mut self) -> io::Result<&'a str> {
+        let (s, buf) = decode::read_str_from_slice(self.buf).map_err(invalid_data)?;
+        self.buf = buf;
+        Ok(s)
+    }
+
+    fn bin(&mut self) -> io::Result<&'a [u8]> {
+        let len = decode::read_bin_len(&mut self.buf).map_err(invalid_data)? as usize;
+        if self.buf.len() < len {
+            return Err(invalid_data("truncated bin"));
+        }
+        let (data, buf) = self.buf.split_at(len);
+        self.buf = buf;
+        Ok(data)
+    }
+
+    fn array_len(&mut self) -> io::Result<usize> {
+        Ok(decode::read_array_len(&mut self.buf).map_err(invalid_data)? as usize)
+    }
+
+    fn map_len(&mut self) -> io::Result<usize> {
+        Ok(decode::read_map_len(&mut self.buf).map_err(invalid_data)? as usize)
+    }
+
+    fn is_array(&self) -> bool {
+        match self.buf.first().map(|&b| Marker::from_u8(b)) {
+            Some(Marker::FixArray(_)) | Some(Marker::Array16) | Some(Marker::Array32) => true,
+            _ => false,
+        }
+    }
+}
+
+// a view to little-endian structs in bins
+struct BinaryRecords<'a> {
+    buf: &'a [u8],
+    size: usize,
+}
+
+impl<'a> BinaryRecords<'a> {
+    fn new(buf: &'a [u8], size: usize) -> io::Result<BinaryRecords<'a>> {
+        if buf.len() % size != 0 {
+            return Err(invalid_data("truncated records"));
+        }
+        Ok(BinaryRecords { buf: buf, size: size })
+    }
+
+    fn len(&self) -> usize {
+        self.buf.len() / self.size
+    }
+
+    fn get(&self, i: usize) -> &'a [u8] {
+        &self.buf[i * self.size..(i + 1) * self.size]
+    }
+}
+
+fn read_u32(buf: &[u8], pos: usize) -> u32 {
+    (buf[pos] as u32) | (buf[pos + 1] as u32) << 8 |
+        (buf[pos + 2] as u32) << 16 | (buf[pos + 3] as u32) << 24
+}
+
+fn read_i32(buf: &[u8], pos: usize) -> i32 {
+    read_u32(buf, pos) as i32
+}
+
 #[derive(Debug)]
 pub struct NoSuchGlyphName {
     name: String,
@@ -135,6 +229,185 @@ impl Font {
         serde_json::from_reader(r)
     }
 
+    pub fn from_binary<R: Read>(mut r: R) -> io::Result<Font> {
+        let mut buf = Vec::new();
+        r.read_to_end(&mut buf)?;
+        Font::from_binary_slice(&buf)
+    }
+
+    pub fn from_binary_slice(buf: &[u8]) -> io::Result<Font> {
+        let mut rd = BinaryReader { buf: buf };
+
+        if rd.str()? != BINARY_MAGIC {
+            return Err(invalid_data("bad magic"));
+        }
+        let version = rd.int()?;
+        if version != BINARY_VERSION {
+            return Err(invalid_data(format!("unsupported version {}", version)));
+        }
+
+        let height = rd.int()? as usize;
+        let ascent = rd.int()? as i32;
+        let descent = rd.int()? as i32;
+
+        let nnames = rd.array_len()?;
+        let mut names = Vec::with_capacity(nnames);
+        for _ in 0..nnames {
+            names.push(rd.str()?);
+        }
+        let name = |i: u32| -> io::Result<String> {
+            names.get(i as usize).map(|&s| s.to_owned()).ok_or_else(|| invalid_data("bad name"))
+        };
+
+        let pixels = rd.bin()?;
+        let index = BinaryRecords::new(rd.bin()?, BINARY_INDEX_SIZE)?;
+        let table = rd.bin()?;
+
+        // the glyph index is only needed to seek to a particular glyph;
+        // we read every glyph here, but go through the index to check the consistency.
+        let mut glyphs = BTreeMap::new();
+        for i in 0..index.len() {
+            let entry = index.get(i);
+            let offset = read_u32(entry, 4) as usize;
+            let record = table.get(offset..offset + BINARY_GLYPH_SIZE)
+                              .ok_or_else(|| invalid_data("bad glyph offset"))?;
+            let nsubglyphs = read_u32(record, 20) as usize;
+            let npoints = read_u32(record, 24) as usize;
+
+            let subglyphs_start = offset + BINARY_GLYPH_SIZE;
+            let points_start = subglyphs_start + nsubglyphs * BINARY_SUBGLYPH_SIZE;
+            let points_end = points_start + npoints * BINARY_POINT_SIZE;
+            if table.len() < points_end {
+                return Err(invalid_data("truncated glyph"));
+            }
+
+            let subglyph_records =
+                BinaryRecords::new(&table[subglyphs_start..points_start], BINARY_SUBGLYPH_SIZE)?;
+            let mut subglyphs = Vec::with_capacity(nsubglyphs);
+            for j in 0..subglyph_records.len() {
+                let sub = subglyph_records.get(j);
+                let (stride, data) = match read_u32(sub, 20) {
+                    BINARY_DATA_NONE => (None, None),
+                    BINARY_DATA_PIXELS => {
+                        let start = read_u32(sub, 28) as usize;
+                        let end = start + read_u32(sub, 32) as usize;
+                        let px = pixels.get(start..end)
+                                       .ok_or_else(|| invalid_data("bad pixel offset"))?;
+                        (Some(read_u32(sub, 24) as usize), Some(SubglyphData::Pixels(px.to_vec())))
+                    }
+                    BINARY_DATA_NAMED => {
+                        (None, Some(SubglyphData::Named(name(read_u32(sub, 24))?)))
+                    }
+                    BINARY_DATA_ADJOIN => {
+                        (None, Some(SubglyphData::Adjoin((name(read_u32(sub, 24))?,))))
+                    }
+                    kind => return Err(invalid_data(format!("bad subglyph kind {}", kind))),
+                };
+                subglyphs.push(Subglyph {
+                    top: read_i32(sub, 0),
+                    left: read_i32(sub, 4),
+                    height: read_u32(sub, 8),
+                    width: read_u32(sub, 12),
+                    stride: stride,
+                    data: data,
+                    negated: read_u32(sub, 16) as usize,
+                });
+            }
+
+            let point_records =
+                BinaryRecords::new(&table[points_start..points_end], BINARY_POINT_SIZE)?;
+            let mut points = BTreeMap::new();
+            for j in 0..point_records.len() {
+                let point = point_records.get(j);
+                points.insert(name(read_u32(point, 0))?, (read_i32(point, 4), read_i32(point, 8)));
+            }
+
+            glyphs.insert(name(read_u32(entry, 0))?, Glyph {
+                flags: read_u32(record, 0),
+                height: read_u32(record, 4),
+                width: read_u32(record, 8),
+                preferred_top: read_i32(record, 12),
+                preferred_left: read_i32(record, 16),
+                subglyphs: subglyphs,
+                points: points,
+            });
+        }
+
+        let cmap_records = BinaryRecords::new(rd.bin()?, BINARY_CMAP_SIZE)?;
+        let mut cmap = BTreeMap::new();
+        for i in 0..cmap_records.len() {
+            let entry = cmap_records.get(i);
+            cmap.insert(read_u32(entry, 0), name(read_u32(entry, 4))?);
+        }
+
+        let mut remaps = BTreeMap::new();
+        for _ in 0..rd.map_len()? {
+            let setname = name(rd.int()? as u32)?;
+            let nremaps = rd.array_len()?;
+            let mut setremaps = Vec::with_capacity(nremaps);
+            for _ in 0..nremaps {
+                if rd.array_len()? != 4 {
+                    return Err(invalid_data("bad remap"));
+                }
+                let mut items = Vec::with_capacity(4);
+                for _ in 0..4 {
+                    let nitems = rd.array_len()?;
+                    let mut part = Vec::with_capacity(nitems);
+                    for _ in 0..nitems {
+                        if rd.is_array() {
+                            let nlist = rd.array_len()?;
+                            let mut list = Vec::with_capacity(nlist);
+                            for _ in 0..nlist {
+                                list.push(name(rd.int()? as u32)?);
+                            }
+                            part.push(RemapItem::List(list));
+                        } else {
+                            part.push(RemapItem::Name(name(rd.int()? as u32)?));
+                        }
+                    }
+                    items.push(part);
+                }
+                let replacement = items.pop().unwrap();
+                let lookahead = items.pop().unwrap();
+                let pattern = items.pop().unwrap();
+                let lookbehind = items.pop().unwrap();
+                setremaps.push(Remap {
+                    lookbehind: lookbehind,
+                    pattern: pattern,
+                    lookahead: lookahead,
+                    replacement: replacement,
+                });
+            }
+            remaps.insert(setname, setremaps);
+        }
+
+        let mut features = BTreeMap::new();
+        for _ in 0..rd.map_len()? {
+            let featurename = name(rd.int()? as u32)?;
+            let nsets = rd.array_len()?;
+            let mut sets = Vec::with_capacity(nsets);
+            for _ in 0..nsets {
+                sets.push(name(rd.int()? as u32)?);
+            }
+            features.insert(featurename, sets);
+        }
+
+        let exclude_records = BinaryRecords::new(rd.bin()?, 4)?;
+        let exclude_from_sample =
+            (0..exclude_records.len()).map(|i| read_u32(exclude_records.get(i), 0)).collect();
+
+        Ok(Font {
+            height: height,
+            ascent: ascent,
+            descent: descent,
+            glyphs: glyphs,
+            cmap: cmap,
+            remaps: remaps,
+            features: features,
+            exclude_from_sample: exclude_from_sample,
+        })
+    }
+
     pub fn get_glyph(&self, name: &str) -> Result<&Glyph, NoSuchGlyphName> {
         self.glyphs.get(name).ok_or_else(|| NoSuchGlyphName { name: name.to_owned() })
     }
@@ -27,7 +27,7 @@ pub mod sample;
 fn main() {
     let progress = Arc::new(MultiProgress::new());
 
-    let font = font::Font::from_json(io::stdin()).expect("failed to parse");
+    let font = font::Font::from_binary(io::stdin()).expect("failed to parse");
 
     fn set_style(bar: ProgressBar) -> ProgressBar {
         bar.set_style(
@@ -25,14 +25,28 @@ import sys
 import os
 import os.path
 import re
+import math
 import glob
+import argparse
+import multiprocessing
+import hashlib
+import struct
 from fractions import gcd
 import itertools
-import urllib
+import gc
+import copy
+import zlib
+import mmap
+import bisect
 import cPickle as pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import zipfile
+from cStringIO import StringIO
 from xml.etree import cElementTree as ET
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 # pixels
 PX_SUBPIXEL     = 0x1f # subpixel mask
@@ -109,6 +123,9 @@ PIXELNAMES = {
 G_STICKY = 1
 G_INLINE = 2
 
+# font units per pixel
+SCALE = 16
+
 ADJACENCY_MAP = {
     #    a   b
     #   +--+--+
@@ -143,6 +160,53 @@ for k in xrange(0x20):
         ADJACENCY.append((adj ^ 0b11111111, segments))
 ADJACENCY.append(ADJACENCY[PX_ALMOSTFULL]) # used as the entry for PX_FULL
 
+# line segments along the sides of a pixel, indexed by the adjacency bits.
+# coordinates are in half-pixel units, and every segment has the pixel on its right side
+# (the y axis points downwards), so that segments from all pixels form directed cycles.
+SIDE_SEGMENTS = []
+for bits in xrange(0x100):
+    segments = []
+    for full, half1, half2, (x1, y1), (x2, y2), (x3, y3) in [
+            (0b11000000, 0b10000000, 0b01000000, (0, 0), (1, 0), (2, 0)),
+            (0b00110000, 0b00100000, 0b00010000, (2, 0), (2, 1), (2, 2)),
+            (0b00001100, 0b00001000, 0b00000100, (2, 2), (1, 2), (0, 2)),
+            (0b00000011, 0b00000010, 0b00000001, (0, 2), (0, 1), (0, 0))]:
+        if (bits & full) == full: segments.append((x1, y1, x3, y3))
+        else:
+            if bits & half1: segments.append((x1, y1, x2, y2))
+            if bits & half2: segments.append((x2, y2, x3, y3))
+    SIDE_SEGMENTS.append(segments)
+
+# line segments from ADJACENCY in the same convention as SIDE_SEGMENTS.
+# the filled side is found from the centroid of the (convex) shape in ADJACENCY_MAP,
+# and inverted shapes from the complement of ADJACENCY_MAP get the opposite direction.
+GAP_SEGMENTS = []
+for k, (adj, segments) in enumerate(ADJACENCY):
+    inverted = k not in ADJACENCY_MAP
+    segments = [(int(x1*2), int(y1*2), int(x2*2), int(y2*2)) for x1, y1, x2, y2 in segments]
+    points = [(x, y) for x1, y1, x2, y2 in segments + SIDE_SEGMENTS[adj ^ 0xff if inverted else adj]
+                     for x, y in ((x1, y1), (x2, y2))]
+    directed = []
+    for x1, y1, x2, y2 in segments:
+        cx = sum(x for x, y in points) - x1 * len(points)
+        cy = sum(y for x, y in points) - y1 * len(points)
+        if ((x2 - x1) * cy - (y2 - y1) * cx > 0) ^ inverted:
+            directed.append((x1, y1, x2, y2))
+        else:
+            directed.append((x2, y2, x1, y1))
+    GAP_SEGMENTS.append(directed)
+
+# the adjacency bits of neighboring pixels moved to the facing sides of the center pixel
+# (as translation tables for bytearrays of adjacency bits)
+FACING_TOP    = ''.join(chr(((a << 5) & 0b10000000) | ((a << 3) & 0b01000000))
+                        for a in xrange(0x100))
+FACING_RIGHT  = ''.join(chr(((a << 5) & 0b00100000) | ((a << 3) & 0b00010000))
+                        for a in xrange(0x100))
+FACING_BOTTOM = ''.join(chr(((a >> 3) & 0b00001000) | ((a >> 5) & 0b00000100))
+                        for a in xrange(0x100))
+FACING_LEFT   = ''.join(chr(((a >> 3) & 0b00000010) | ((a >> 5) & 0b00000001))
+                        for a in xrange(0x100))
+
 LEFTMOST = [0] * len(ADJACENCY)
 LEFTMOST[PX_EMPTY] = None
 LEFTMOST[PX_QUAD3] = LEFTMOST[PX_SLANT2H] = LEFTMOST[PX_SLANT4H] = 0.5
@@ -151,7 +215,39 @@ LEFTMOST[PX_QUAD3] = LEFTMOST[PX_SLANT2H] = LEFTMOST[PX_SLANT4H] = 0.5
 Delta = namedtuple('Delta', 'value')
 Adjoin = namedtuple('Adjoin', 'value')
 
-# data = None | list of pixel codes | subglyph name | Adjoin(subglyph name)
+class Pixels(object):
+    # a read-only view to pixel codes stored in an arena (bytearray) shared by many subglyphs,
+    # so that we don't keep a list of boxed ints for every pixel subglyph.
+    # indexing and slicing are relative to the view; slices are copied out as bytearrays.
+    __slots__ = ('arena', 'offset', 'length')
+
+    def __init__(self, arena, offset, length):
+        self.arena = arena
+        self.offset = offset
+        self.length = length
+
+    def __reduce__(self):
+        # the arena is pickled only once when views are pickled together
+        return Pixels, (self.arena, self.offset, self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            return self.arena[self.offset+start:self.offset+stop:step]
+        if i < 0: i += self.length
+        if not 0 <= i < self.length: raise IndexError('pixel index out of range')
+        return self.arena[self.offset+i]
+
+    def __iter__(self):
+        return iter(self.arena[self.offset:self.offset+self.length])
+
+    def __str__(self):
+        return str(self.arena[self.offset:self.offset+self.length])
+
+# data = None | Pixels | subglyph name | Adjoin(subglyph name)
 # top/left can be a Delta value instead of the actual value; will be resolved later.
 # negated is 1 if the subglyph should be negated; >=2 matters for complex nesting.
 Subglyph = namedtuple('Subglyph', 'top left height width stride data negated')
@@ -167,92 +263,312 @@ Remap = namedtuple('Remap', 'lookbehind pattern lookahead replacement')
 
 class ParseError(ValueError): pass
 
-UCD = namedtuple('UCD', 'name decomp')
-
-class ExternalData(object):
-    def __init__(self, cachepath, universion):
-        self.cachepath = cachepath
-        self.universion = universion
-        self.unicodedata = None # UnicodeData.txt
+# the default size limit of the whole on-disk build cache (approximate, in bytes)
+BUILD_CACHE_SIZE = 128 << 20
+
+class BuildCache(object):
+    # on-disk cache of derived data, shared by every stage of the build.
+    # each entry is stored in `<path>/<namespace>/<key>.dat`, where the key is a digest of
+    # everything the data is derived from (see `make_key`); a stale entry is never looked up again,
+    # and it eventually gets evicted as the least recently used one.
+    #
+    # entries are written to a temporary file and renamed, so readers never see a partial entry
+    # and don't need to lock. writers take an exclusive lock on `<path>/.lock` (when available)
+    # so that concurrent builds don't evict what the other is writing.
+    # the cache is disabled when the path is None.
+    def __init__(self, path, maxsize=BUILD_CACHE_SIZE):
+        self.path = path
+        self.maxsize = maxsize
+
+    @staticmethod
+    def make_key(*parts):
+        # parts are length-prefixed, so that they can't be confused with each other
+        key = hashlib.sha1()
+        for part in parts:
+            part = str(part)
+            key.update('%d:' % len(part))
+            key.update(part)
+        return key.hexdigest()
+
+    def entry_path(self, namespace, key):
+        return os.path.join(self.path, namespace, key + '.dat')
+
+    def open(self, namespace, key):
+        # returns a file for reading the entry, or None if the entry doesn't exist
+        if not self.path: return None
+        path = self.entry_path(namespace, key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            os.utime(path, None) # for the eviction
+        except OSError:
+            pass
+        return f
 
-    def download_if_not_exists(self, path, cached_path):
+    def load(self, namespace, key):
+        # returns the unpickled entry, or None if the entry doesn't exist or is unreadable
+        f = self.open(namespace, key)
+        if not f: return None
         try:
-            cached_dir = os.path.dirname(cached_path)
-            if cached_dir: os.makedirs(cached_dir)
+            with f:
+                return pickle.load(f)
         except Exception:
+            return None
+
+    def store_bytes(self, namespace, key, data):
+        # failures are silently ignored, as the cache is only an optimization
+        if not self.path: return
+        path = self.entry_path(namespace, key)
+        temppath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with self.lock():
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+                try:
+                    with open(temppath, 'wb') as f:
+                        f.write(data)
+                    os.rename(temppath, path)
+                finally:
+                    if os.path.exists(temppath): os.unlink(temppath)
+                self.evict(keep=path)
+        except EnvironmentError:
             pass
-        if not os.path.exists(cached_path):
-            print >>sys.stderr, 'downloading %s...' % path,
+
+    def store(self, namespace, key, value):
+        self.store_bytes(namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def lock(self):
+        return CacheLock(os.path.join(self.path, '.lock'))
+
+    def evict(self, keep=None):
+        # removes the least recently used entries until the cache fits in `maxsize`.
+        # should be called with the lock held.
+        entries = []
+        total = 0
+        for namespace in os.listdir(self.path):
+            dirpath = os.path.join(self.path, namespace)
+            if not os.path.isdir(dirpath): continue
+            for name in os.listdir(dirpath):
+                if not name.endswith('.dat'): continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+                total += st.st_size
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.maxsize: break
+            if path == keep: continue
             try:
-                urllib.urlretrieve(path, cached_path)
-                print >>sys.stderr, 'done.'
-            except:
-                print >>sys.stderr, 'failed.'
-                try: os.unlink(cached_path)
-                except OSError: pass
-                raise
-
-    def try_fetch_cache(self, filename, get):
-        path = os.path.join(self.cachepath, filename)
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+class CacheLock(object):
+    # an exclusive advisory lock on given file while in the `with` block.
+    # does nothing where fcntl is not available; writes to the cache are atomic anyway.
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        if fcntl is None: return self
         try:
-            with open(path, 'rb') as f:
-                return pickle.load(f)
-        except Exception:
-            data = get()
-            with open(path, 'wb') as f:
-                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
-            return data
-
-    def parse_unicodedata(self):
-        ucdpath = os.path.join(self.cachepath, 'UnicodeData.txt')
-        self.download_if_not_exists('http://www.unicode.org/Public/' + self.universion +
-                                    '/ucd/UnicodeData.txt', ucdpath)
-        data = {}
-        with open(ucdpath) as f:
-            for line in f:
-                code, name, category, ccc, bidi, decomp, decimal, digit, numeric, \
-                mirrored, u1name, isocomment, upperch, lowerch, titlech = \
-                    line.rstrip('\r\n').split(';')
-                code = int(code, 16)
-                if not name.startswith('<'):
-                    decompty, _, decompmap = decomp.rpartition('> ')
-                    decompty = decompty[1:]
-                    decompmap = [int(c, 16) for c in decompmap.split()]
-                    if not decompty: decompty = None
-                    if not decompmap: decompmap = None
-                    data[code] = UCD(name=name, decomp=(decompty, decompmap))
-        return data
-
-    def get_unicodedata(self):
-        if not self.unicodedata:
-            self.unicodedata = self.try_fetch_cache('unicodedata.dat', self.parse_unicodedata)
-            assert self.unicodedata
-        return self.unicodedata
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            pass
+        self.f = open(self.path, 'ab')
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.f:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+# character names from UnicodeData.txt are kept in a compact index, which is memory-mapped and
+# binary-searched so that a lookup doesn't need to load the whole table. the index consists of:
+#
+# - the header (UNAMES_HEADER), including the SHA-1 digest of UnicodeData.txt it was built from
+# - sorted code points as little-endian uint32
+# - offsets to each name in the name blob as uint32, plus the end offset
+# - ranges with algorithmic names (UNAMES_RANGE), from `<..., First>` and `<..., Last>` entries
+# - the name blob, which has range names as well
+UNAMES_MAGIC = 'UNAM'
+UNAMES_VERSION = 1
+UNAMES_HEADER = struct.Struct('<4sLLL20s') # magic, version, # of code points, # of ranges, digest
+UNAMES_RANGE = struct.Struct('<LLLLL') # first, last, kind, name offset, name length
+UNAMES_CODE = struct.Struct('<L')
+UNAMES_OFFSETS = struct.Struct('<LL')
+
+# range kinds. see the Unicode Standard, section 4.8 for the name derivation rules.
+UNR_PREFIX = 0 # NR2: the name followed by the hexadecimal code point
+UNR_HANGUL = 1 # NR1: `HANGUL SYLLABLE ` followed by the names of jamos
+
+HANGUL_L = ('G','GG','N','D','DD','R','M','B','BB','S','SS','','J','JJ','C','K','T','P','H')
+HANGUL_V = ('A','AE','YA','YAE','EO','E','YEO','YE','O','WA','WAE','OE','YO','U','WEO','WE',
+            'WI','YU','EU','YI','I')
+HANGUL_T = ('','G','GG','GS','N','NJ','NH','D','L','LG','LM','LB','LS','LT','LP','LH',
+            'M','B','BS','S','SS','NG','J','C','K','T','P','H')
+
+class UnicodeNames(object):
+    def __init__(self, sourcepath, cache):
+        self.sourcepath = sourcepath
+        self.cache = cache
+        self.index = None # mmap, or '' if the index is unavailable
+        self.count = 0
+        self.ranges = []
+
+    @staticmethod
+    def range_name(label):
+        # returns (kind, name) for `<label, First>`, or None if the range has no names
+        if label == 'Hangul Syllable': return UNR_HANGUL, 'HANGUL SYLLABLE '
+        if label.startswith('CJK Ideograph'): return UNR_PREFIX, 'CJK UNIFIED IDEOGRAPH-'
+        if label.endswith(' Ideograph'): return UNR_PREFIX, label.upper() + '-'
+        return None
+
+    def build(self, source, digest):
+        entries = []
+        ranges = []
+        first = None
+        for line in source.splitlines():
+            if not line.strip(): continue
+            code, name, _ = line.split(';', 2)
+            code = int(code, 16)
+            if name.startswith('<'):
+                label, _, mark = name[1:-1].rpartition(', ')
+                if mark == 'First':
+                    first = code
+                elif mark == 'Last' and first is not None:
+                    kind_name = self.range_name(label)
+                    if kind_name: ranges.append((first, code) + kind_name)
+                    first = None
+            else:
+                entries.append((code, name))
+        entries.sort()
+
+        blob = []
+        offsets = []
+        offset = 0
+        for _, name in entries:
+            offsets.append(offset)
+            blob.append(name)
+            offset += len(name)
+        offsets.append(offset)
+        packed_ranges = []
+        for first, last, kind, name in ranges:
+            packed_ranges.append(UNAMES_RANGE.pack(first, last, kind, offset, len(name)))
+            blob.append(name)
+            offset += len(name)
+
+        return ''.join([
+            UNAMES_HEADER.pack(UNAMES_MAGIC, UNAMES_VERSION, len(entries), len(ranges), digest),
+            struct.pack('<%dL' % len(entries), *[code for code, _ in entries]),
+            struct.pack('<%dL' % len(offsets), *offsets),
+        ] + packed_ranges + blob)
+
+    def open(self):
+        self.index = ''
+        try:
+            with open(self.sourcepath, 'rb') as f:
+                source = f.read()
+        except IOError:
+            return # names are only used for diagnostics, so we can go without them
+        digest = hashlib.sha1(source).digest()
+        key = BuildCache.make_key(UNAMES_VERSION, digest)
+
+        index = None
+        f = self.cache.open('unicodenames', key)
+        if f:
+            try:
+                with f:
+                    index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError): # including an empty file
+                pass
+        if index is not None:
+            # the version is already a part of the key
+            if len(index) < UNAMES_HEADER.size: index = None
+            else:
+                magic, _, _, _, cached_digest = UNAMES_HEADER.unpack_from(index)
+                if (magic, cached_digest) != (UNAMES_MAGIC, digest): index = None
+        if index is None:
+            index = self.build(source, digest)
+            self.cache.store_bytes('unicodenames', key, index)
+
+        _, _, self.count, nranges, _ = UNAMES_HEADER.unpack_from(index)
+        self.codes_at = UNAMES_HEADER.size
+        self.offsets_at = self.codes_at + self.count * 4
+        ranges_at = self.offsets_at + (self.count + 1) * 4
+        self.names_at = ranges_at + nranges * UNAMES_RANGE.size
+        self.ranges = [UNAMES_RANGE.unpack_from(index, ranges_at + i * UNAMES_RANGE.size)
+                       for i in xrange(nranges)]
+        self.index = index
+
+    def get(self, code):
+        if self.index is None: self.open()
+        index = self.index
+        if not index: return None
+
+        for first, last, kind, offset, length in self.ranges:
+            if first <= code <= last:
+                name = index[self.names_at+offset:self.names_at+offset+length]
+                if kind == UNR_HANGUL:
+                    lv, t = divmod(code - first, len(HANGUL_T))
+                    l, v = divmod(lv, len(HANGUL_V))
+                    return name + HANGUL_L[l] + HANGUL_V[v] + HANGUL_T[t]
+                return '%s%04X' % (name, code)
+
+        lo = 0
+        hi = self.count
+        codes_at = self.codes_at
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if UNAMES_CODE.unpack_from(index, codes_at + mid * 4)[0] < code:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or UNAMES_CODE.unpack_from(index, codes_at + lo * 4)[0] != code:
+            return None
+        start, end = UNAMES_OFFSETS.unpack_from(index, self.offsets_at + lo * 4)
+        return index[self.names_at+start:self.names_at+end]
+
+class ExternalData(object):
+    # everything comes from the bundled data directory; nothing is ever downloaded.
+    def __init__(self, cache, datapath):
+        self.cache = cache
+        self.datapath = datapath
+        self.names = UnicodeNames(os.path.join(datapath, 'UnicodeData.txt'), cache)
+        self.blocks = None # loaded on demand
 
     def get_char_name(self, code):
-        # algorithmic mappings
-        if 0x3400 <= code <= 0x4db5 or 0x4e00 <= code <= 0x9fd5 or 0x20000 <= code <= 0x2a6d6 or \
-           0x2a700 <= code <= 0x2b734 or 0x2b740 <= code <= 0x2b81d or 0x2b820 <= code <= 0x2cea1:
-            return 'CJK UNIFIED IDEOGRAPH-%X' % code
-        if 0xac00 <= code <= 0xd7a3:
-            a, bc = divmod(code - 0xac00, 588)
-            b, c = divmod(bc, 28)
-            return 'HANGUL SYLLABLE %s%s%s' % (
-                ('G','GG','N','D','DD','R','M','B','BB','S','SS','','J','JJ','C','K',
-                 'T','P','H')[a],
-                ('A','AE','YA','YAE','EO','E','YEO','YE','O','WA','WAE','OE','YO','U','WEO','WE',
-                 'WI','YU','EU','YI','I')[b],
-                ('','G','GG','GS','N','NJ','NH','D','L','LG','LM','LB','LS','LT','LP','LH',
-                 'M','B','BS','S','SS','NG','J','C','K','T','P','H')[c],
-            )
-
-        entry = self.get_unicodedata().get(code, None)
-        if not entry: return None
-        return entry.name
+        return self.names.get(code)
+
+    def get_blocks(self):
+        # returns a sorted list of (first, last, block name) from Blocks.txt
+        if self.blocks is None:
+            blocks = []
+            with open(os.path.join(self.datapath, 'Blocks.txt'), 'rb') as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if not line: continue
+                    span, name = line.split(';', 1)
+                    first, last = span.split('..')
+                    blocks.append((int(first, 16), int(last, 16), name.strip()))
+            blocks.sort()
+            self.blocks = blocks
+        return self.blocks
 
 ExternalData = ExternalData(
-    cachepath=os.path.join(os.path.dirname(__file__), '..', 'cache'),
-    universion='8.0.0')
+    cache=BuildCache(os.path.join(os.path.dirname(__file__), '..', 'cache')),
+    datapath=os.path.join(os.path.dirname(__file__), '..', 'data'))
 
 def lcm(a, b):
     return a // gcd(a, b) * b
@@ -284,232 +600,263 @@ def char_name(i):
     if name: name = u' ' + name
     return u'U+%04X%s (%s)' % (i, name, unichar(i))
 
-def signed_area(path):
-    x0, y0 = path[-1]
-    area = 0
-    for i, (x, y) in enumerate(path):
-        area += x0 * y - x * y0
-        x0 = x
-        y0 = y
-    return area
-
-# 3-----2   2-----3
-#       |   |         1--2--3
-#       1   1
-# ccw > 0   ccw < 0   ccw = 0
-def ccw(x1, y1, x2, y2, x3, y3):
-    return (x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1)
-
-def inside(x1, y1, x, y, x2, y2):
-    # i.e. colinear and (x,y) is inside a rectangle formed by (x1,y1) and (x2,y2)
-    return ccw(x1, y1, x, y, x2, y2) == 0 and (x1 <= x <= x2 or x1 >= x >= x2) \
-                                          and (y1 <= y <= y2 or y1 >= y >= y2)
-
-# http://geomalgorithms.com/a03-_inclusion.html
-def winding_number(x, y, path):
-    xx0, yy0 = path[-1]
-    wn = 0
-    for i, (xx, yy) in enumerate(path):
-        if yy0 <= y:
-            if yy > y and ccw(xx0, yy0, xx, yy, x, y) > 0: wn += 1
+CODEPOINT_RANGE_PATTERN = re.compile(r'^(?:u\+)?([0-9a-f]{1,6})(?:(?:-|\.\.)([0-9a-f]{1,6}))?$',
+                                     re.I)
+
+class CodepointRanges(object):
+    # a set of code points kept as sorted, disjoint and non-adjacent (first, last) ranges.
+    def __init__(self, ranges=()):
+        self.ranges = []
+        for first, last in sorted(ranges):
+            if self.ranges and first <= self.ranges[-1][1] + 1:
+                if last > self.ranges[-1][1]: self.ranges[-1] = self.ranges[-1][0], last
+            else:
+                self.ranges.append((first, last))
+        self.firsts = [first for first, _ in self.ranges]
+
+    def __contains__(self, ch):
+        i = bisect.bisect_right(self.firsts, ch) - 1
+        return i >= 0 and ch <= self.ranges[i][1]
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __str__(self):
+        # in the syntax of CSS `unicode-range`
+        return ', '.join('U+%X' % first if first == last else 'U+%X-%X' % (first, last)
+                         for first, last in self.ranges)
+
+    @staticmethod
+    def parse(specs):
+        # each spec is either a comma-separated list of code points and ranges
+        # (`U+AC00-D7A3`, `U+0041` or `ac00..d7a3`), or `@<path>` to an UTF-8 text file
+        # whose characters are used. raises ValueError for invalid specs.
+        ranges = []
+        for spec in specs:
+            if spec.startswith('@'):
+                with open(spec[1:], 'rb') as f:
+                    text = f.read().decode('utf-8-sig')
+                # surrogate pairs are only seen in narrow builds
+                for m in re.finditer(u'[\ud800-\udbff][\udc00-\udfff]|.', text, re.S):
+                    ch = try_ord(m.group())
+                    if ch is not None: ranges.append((ch, ch))
+                continue
+            for item in spec.split(','):
+                m = CODEPOINT_RANGE_PATTERN.match(item.strip())
+                if not m: raise ValueError('invalid code point or range %r' % item)
+                first = int(m.group(1), 16)
+                last = int(m.group(2), 16) if m.group(2) is not None else first
+                if first > last or last > 0x10ffff:
+                    raise ValueError('invalid code point or range %r' % item)
+                ranges.append((first, last))
+        return CodepointRanges(ranges)
+
+def follow_cycles(edges, vstride):
+    # splits directed segments into simple cycles, where `edges` maps a vertex
+    # `y * vstride + x` (the y axis points downwards) to a list of next vertices.
+    # `edges` is emptied.
+    def rightmost(prev, v, targets):
+        # where multiple cycles meet, keep the turn as sharp as possible to the right,
+        # so that the filled area stays on the same side and touching cycles are separated.
+        vy, vx = divmod(v, vstride)
+        if prev is None:
+            dx, dy = 0, -1
         else:
-            if yy <= y and ccw(xx0, yy0, xx, yy, x, y) < 0: wn -= 1
-        xx0 = xx
-        yy0 = yy
-    return wn
+            py, px = divmod(prev, vstride)
+            dx, dy = vx - px, vy - py
+        def angle(w):
+            wy, wx = divmod(w, vstride)
+            cross = dx * (wy - vy) - dy * (wx - vx)
+            dot = dx * (wx - vx) + dy * (wy - vy)
+            if cross == 0 and dot < 0: return -4 # turning back is the last resort
+            return math.atan2(cross, dot)
+        return max(targets, key=angle)
+
+    # follow the segments, splitting the walk into a simple cycle whenever it revisits a vertex.
+    cycles = []
+    for start in sorted(edges):
+        while start in edges:
+            walk = []
+            indices = {} # vertex: index in walk
+            prev = None
+            v = start
+            while True:
+                k = indices.get(v)
+                if k is not None:
+                    cycle = walk[k:]
+                    del walk[k:]
+                    for u in cycle: del indices[u]
+                    cycles.append(cycle)
+                    if not walk: break
+
+                indices[v] = len(walk)
+                walk.append(v)
+                targets = edges[v]
+                if len(targets) == 1:
+                    w = targets[0]
+                    del edges[v]
+                else:
+                    w = rightmost(prev, v, targets)
+                    targets.remove(w)
+                prev = v
+                v = w
+    return cycles
+
+MASKED_TABLES = {} # mask: (table for pixel codes, table for adjacency bits)
 
 def track_contour(height, width, stride0, data0, mask):
-    # add sentinels around the pixels (would be progressively removed during traversal)
+    # add sentinels to the right and bottom of the pixels
+    # (negative indices make them also work as the sentinels to the left and top)
     stride = width + 1
-    data = []
+    codes = bytearray(stride * (height + 1))
     for r in xrange(height):
-        data.extend(data0[r*stride0:r*stride0+width])
-        data.append(PX_EMPTY)
-    data.extend([PX_EMPTY] * stride)
-
+        codes[r*stride:r*stride+width] = data0[r*stride0:r*stride0+width]
+    try:
+        masked, adjacent = MASKED_TABLES[mask]
+    except KeyError:
+        masked = ''.join(chr(i & mask) for i in xrange(0x100))
+        adjacent = ''.join(chr(ADJACENCY[i & mask][0]) for i in xrange(0x100))
+        MASKED_TABLES[mask] = masked, adjacent
+    codes = codes.translate(masked)
+    adjacency = codes.translate(adjacent)
+    tops = adjacency.translate(FACING_TOP)
+    rights = adjacency.translate(FACING_RIGHT)
+    bottoms = adjacency.translate(FACING_BOTTOM)
+    lefts = adjacency.translate(FACING_LEFT)
+
+    # collect directed boundary segments in one scan over non-empty pixels.
+    # a vertex is an integer `y * vstride + x` where (x, y) is in half-pixel units.
+    vstride = stride * 2
+    edges = {} # vertex: [next vertex, ...]
+    offsets = {} # (sides, code): [(vertex offset, next vertex offset), ...]
+    for i in itertools.compress(xrange(height * stride), codes):
+        pixel = adjacency[i]
+        connected = pixel & (tops[i-stride] | rights[i+1] | bottoms[i+stride] | lefts[i-1])
+        disconnected = connected ^ 0b11111111
+        if not disconnected: continue
+
+        code = codes[i]
+        key = pixel & disconnected, code if ~pixel & disconnected else None
+        try:
+            segments = offsets[key]
+        except KeyError:
+            segments = SIDE_SEGMENTS[key[0]]
+            if key[1] is not None: segments = segments + GAP_SEGMENTS[code]
+            segments = offsets[key] = [(y1 * vstride + x1, y2 * vstride + x2)
+                                       for x1, y1, x2, y2 in segments]
+
+        y, x = divmod(i, stride)
+        origin = (y * vstride + x) * 2
+        for v, w in segments:
+            try: edges[origin + v].append(origin + w)
+            except KeyError: edges[origin + v] = [origin + w]
+
+    cycles = follow_cycles(edges, vstride)
+
+    # start every cycle from its topmost-leftmost vertex, which is always a corner,
+    # and remove vertices in the middle of straight lines.
     paths = []
-    visited = set()
-    for i0 in xrange(0, height * stride, stride):
-        for i in xrange(i0, i0 + width):
-            # find the first non-empty pixel unvisited
-            if data[i] == PX_EMPTY: continue
-            if i in visited: continue
-
-            unsure = set([i])
-            segs = []
-            while unsure:
-                i = unsure.pop()
-                visited.add(i)
-
-                pixel,  gapsegs = ADJACENCY[data[i]        & mask]
-                top,    _       = ADJACENCY[data[i-stride] & mask]
-                bottom, _       = ADJACENCY[data[i+stride] & mask]
-                left,   _       = ADJACENCY[data[i-1]      & mask]
-                right,  _       = ADJACENCY[data[i+1]      & mask]
-
-                connected = (
-                    (pixel & (top    << 5) & 0b10000000) |
-                    (pixel & (top    << 3) & 0b01000000) |
-                    (pixel & (right  << 5) & 0b00100000) |
-                    (pixel & (right  << 3) & 0b00010000) |
-                    (pixel & (bottom >> 3) & 0b00001000) |
-                    (pixel & (bottom >> 5) & 0b00000100) |
-                    (pixel & (left   >> 3) & 0b00000010) |
-                    (pixel & (left   >> 5) & 0b00000001)
-                )
-
-                if (connected & 0b11000000) and (i-stride) not in visited: unsure.add(i-stride)
-                if (connected & 0b00110000) and (i+1)      not in visited: unsure.add(i+1)
-                if (connected & 0b00001100) and (i+stride) not in visited: unsure.add(i+stride)
-                if (connected & 0b00000011) and (i-1)      not in visited: unsure.add(i-1)
-
-                disconnected = connected ^ 0b11111111
-                if disconnected:
-                    y, x = divmod(i, stride)
-
-                    linesegs = pixel & disconnected
-                    if (linesegs & 0b11000000) == 0b11000000: segs.append((x, y, x + 1, y))
-                    else:
-                        if linesegs & 0b10000000: segs.append((x, y, x + 0.5, y))
-                        if linesegs & 0b01000000: segs.append((x + 0.5, y, x + 1, y))
-                    if (linesegs & 0b00110000) == 0b00110000: segs.append((x + 1, y, x + 1, y + 1))
+    for cycle in cycles:
+        k = cycle.index(min(cycle))
+        cycle = cycle[k:] + cycle[:k]
+        points = [divmod(v, vstride) for v in cycle]
+        path = []
+        y0, x0 = points[-1]
+        for i, (y, x) in enumerate(points):
+            y2, x2 = points[i+1] if i + 1 < len(points) else points[0]
+            if (x - x0) * (y2 - y) != (y - y0) * (x2 - x):
+                path.append((x // 2 if x % 2 == 0 else x / 2., y // 2 if y % 2 == 0 else y / 2.))
+            y0 = y
+            x0 = x
+        paths.append((cycle[0], path))
+    paths.sort()
+    return [path for _, path in paths]
+
+def optimize_contours(contours):
+    # merges contours traced from multiple pixel subglyphs of a glyph (in font units).
+    # edges are split into the shortest steps on the lattice of all coordinates, and steps
+    # in the opposite directions cancel each other, so abutting contours become one.
+    # the winding number of every point (and thus the rendering) does not change,
+    # so overlapping areas are kept as they are; the remaining steps are followed into
+    # cycles as in track_contour, cycles without an area are removed, and every contour
+    # starts from its topmost-leftmost point.
+    unit = 0
+    for contour in contours:
+        for x, y in contour: unit = gcd(unit, gcd(abs(x), abs(y)))
+    if not unit: return []
+    xs = [x for contour in contours for x, _ in contour]
+    ys = [y for contour in contours for _, y in contour]
+    left = min(xs)
+    top = max(ys)
+    vstride = (max(xs) - left) // unit + 2
+
+    steps = {} # (vertex, next vertex): count
+    for contour in contours:
+        vertices = [((top - y) // unit) * vstride + (x - left) // unit for x, y in contour]
+        v = vertices[-1]
+        for w in vertices:
+            (vy, vx), (wy, wx) = divmod(v, vstride), divmod(w, vstride)
+            n = gcd(abs(wx - vx), abs(wy - vy))
+            if n:
+                step = (w - v) // n
+                for u in xrange(v, w, step):
+                    if steps.get((u + step, u)):
+                        steps[u + step, u] -= 1
                     else:
-                        if linesegs & 0b00100000: segs.append((x + 1, y, x + 1, y + 0.5))
-                        if linesegs & 0b00010000: segs.append((x + 1, y + 0.5, x + 1, y + 1))
-                    if (linesegs & 0b00001100) == 0b00001100: segs.append((x + 1, y + 1, x, y + 1))
-                    else:
-                        if linesegs & 0b00001000: segs.append((x + 1, y + 1, x + 0.5, y + 1))
-                        if linesegs & 0b00000100: segs.append((x + 0.5, y + 1, x, y + 1))
-                    if (linesegs & 0b00000011) == 0b00000011: segs.append((x, y + 1, x, y))
-                    else:
-                        if linesegs & 0b00000010: segs.append((x, y + 1, x, y + 0.5))
-                        if linesegs & 0b00000001: segs.append((x, y + 0.5, x, y))
-
-                    if ~pixel & disconnected:
-                        segs.extend((x + x1, y + y1, x + x2, y + y2) for x1, y1, x2, y2 in gapsegs)
-
-            assert len(segs) == len(set(segs)), segs
-            pxtosegs = {}
-            for x1, y1, x2, y2 in segs:
-                pxtosegs.setdefault((x1, y1), []).append((x2, y2))
-                pxtosegs.setdefault((x2, y2), []).append((x1, y1))
-
-            while pxtosegs:
-                (x0, y0), v = pxtosegs.popitem()
-                assert len(v) >= 2
-                assert len(v) % 2 == 0
-                x, y = v.pop()
-                pxtosegs[x0, y0] = v
-
-                xorg = x0
-                yorg = y0
-                dx = x0 - x
-                dy = y0 - y
-                path = [(xorg, yorg)]
-                indices = {(xorg, yorg): 0}
-                while True:
-                    nx = pxtosegs.pop((x, y))
-                    nx.remove((x0, y0))
-
-                    # check for the cycle...
-                    k = indices.get((x, y))
-                    if k is not None:
-                        # then extract that cycle.
-                        # should re-add the first point if it were elided previously.
-                        extracted = path[k:]
-                        del path[k:]
-                        if extracted[0] != (x, y): extracted.insert(0, (x, y))
-                        paths.append(extracted)
-
-                        # if nothing remains, we've reached the initial point.
-                        if not path:
-                            assert len(nx) % 2 == 0
-                            if nx: pxtosegs[x, y] = nx
-                            break
-
-                        for k, v in indices.items():
-                            if v >= len(path): del k
-
-                        # simulate the state right after (x, y) was originally added
-                        px, py = path[-1]
-                        dx = x - px
-                        dy = y - py
-
-                    xx, yy = nx.pop(0)
-                    assert len(nx) % 2 == 0
-                    if nx: pxtosegs[x, y] = nx
-
-                    # flush the previous segment if the current segment has a different slope
-                    indices[x, y] = len(path)
-                    if dx * (y - yy) != dy * (x - xx):
-                        path.append((x, y))
-                        dx = x - xx
-                        dy = y - yy
-
-                    x0 = x
-                    y0 = y
-                    x = xx
-                    y = yy
-
-    # fix the winding directions of resulting contours
-    for path in paths:
-        # pick any point in the path, and sum the winding numbers of that point in other paths.
-        # the point should be not in other paths being compared.
-        wn = 0
-        for p in paths:
-            if p is path: continue # "any" point would always coincide
-            for k in xrange(len(path)):
-                # it is possible that every point in `path` overlaps with `p`
-                # while they don't share any common points themselves.
-                # thus we cheat here and try to pick a point that is not in `path`
-                # while it *does* overlap with `path` and is very unlikely to overlap with `p`.
-                # this is ensured by using, eh, a very small amount of interpolation.
-                # of course, we can do better, but who cares?
-                x1, y1 = path[k-1]
-                x2, y2 = path[k]
-                x = (x1 + x2 * 1023) / 1024.
-                y = (y1 + y2 * 1023) / 1024.
-
-                # even if (x, y) is not in the path itself, it may coincide with some segment
-                if all(not inside(p[i-1][0], p[i-1][1], x, y, p[i][0], p[i][1])
-                       for i in xrange(len(p))): break
-            else:
-                assert False
-
-            wn += winding_number(x, y, p)
+                        steps[u, u + step] = steps.get((u, u + step), 0) + 1
+            v = w
+    edges = {}
+    for (v, w), count in steps.items():
+        if count: edges.setdefault(v, []).extend([w] * count)
 
-        # if a sign of the signed area mismatches with the winding number, reverse.
-        # (the signed area only works with the simple polygon, which is the case)
-        a = signed_area(path)
-        if ((wn & 1) == 1) ^ (a < 0): path.reverse()
-
-    return paths
+    paths = []
+    for cycle in follow_cycles(edges, vstride):
+        k = cycle.index(min(cycle))
+        cycle = cycle[k:] + cycle[:k]
+        points = [divmod(v, vstride) for v in cycle]
+        path = []
+        area = 0
+        y0, x0 = points[-1]
+        for i, (y, x) in enumerate(points):
+            y2, x2 = points[i+1] if i + 1 < len(points) else points[0]
+            if (x - x0) * (y2 - y) != (y - y0) * (x2 - x):
+                path.append((left + x * unit, top - y * unit))
+            area += x0 * y - x * y0
+            y0 = y
+            x0 = x
+        if area: paths.append((cycle[0], path))
+    paths.sort()
+    return [path for _, path in paths]
+
+TOKEN_PATTERN = re.compile(ur'`(?:[^`]|``)*`|\S+')
+def tokenize_line(line):
+    args = []
+    for tok in TOKEN_PATTERN.findall(line):
+        if tok.startswith('//'): break # beginning of comment
+        if tok.startswith('`'):
+            assert len(tok) >= 2 and tok.endswith('`')
+            args.append(tok[1:-1].replace('``', '`'))
+        elif '`' in tok:
+            raise ParseError('unquoted backquotes in token %r' % tok)
+        else:
+            args.append(tok)
+    return args
 
-class Font(object):
+class FontFragment(object):
+    # the parsed contents of a single source file.
+    # everything is kept in the definition order, so that merging fragments in the order of
+    # source files reproduces the font as if all files were read into it one by one.
     def __init__(self, fp=None):
-        # +-----+               ^
-        # |     |               |
-        # |_____|  ^            |
-        # | @@@ |  |            |
-        # |@   @|  | ascent     |
-        # |@@@@@|  |            | height
-        # |@   @|  v            |
-        # ============ baseline |
-        # |     |  ^            |
-        # |     |  | descent    |
-        # +-----+  v            v
-        self.height = 16
-        self.ascent = 16
-        self.descent = 0 # XXX probably needs the downward translation in the glyph itself
-
-        self.glyphs = {} # name: Glyph
-        self.cmap = {} # index: glyph name
-        self.remaps = {} # set name: a list of Remaps
-        self.features = {} # feature name: a list of remap set names
-        self.exclude_from_sample = set()
+        self.glyphs = OrderedDict() # name: Glyph
+        self.cmap = OrderedDict() # index: glyph name
+        self.remaps = OrderedDict() # set name: a list of Remaps
+        self.features = OrderedDict() # feature name: a list of remap set names
+        self.exclude_from_sample = [] # indices, possibly duplicate
+        self.arena = bytearray() # referenced by Pixels in self.glyphs
 
         if fp: self.read(fp)
 
+
     def read(self, fp):
         SubglyphArgs = namedtuple('SubglyphArgs', 'name placeholder roff coff filters adjoin')
         GlyphArgs = namedtuple('GlyphArgs', 'name flags lines parts pos2marks morepixels')
@@ -617,97 +964,108 @@ class Font(object):
                                 roff=None, coff=None, filters=filters, adjoin=adjoin)
 
         FILLED = frozenset(list('@b9Pd(u)n') + range(PX_FULL, (PX_FULL | PX_ALMOSTFULL) + 1))
+
+        # pixels that do not depend on their neighbors. rows made of them only (the majority)
+        # are converted at once with a translation table; others are classified per pixel.
+        SIMPLE_PIXELS = {'.': PX_EMPTY, '!': PX_EMPTY, '+': PX_EMPTY,
+                         '@': PX_ALMOSTFULL | PX_FULL, '*': PX_DOT | PX_FULL}
+        SIMPLE_CHARS = ''.join(SIMPLE_PIXELS)
+        SIMPLE_TABLE = ''.join(chr(SIMPLE_PIXELS.get(chr(i), 0)) for i in xrange(256))
+
+        def classify_pixel(lines, rr, cc, px):
+            t = lines[rr-1][cc]; b = lines[rr+1][cc]
+            l = lines[rr][cc-1]; r = lines[rr][cc+1]
+            v = None
+            if px == 'b':
+                # @@.@@
+                # @/d@@ <- avoid parsing this as connected
+                rcont = (r == '\\' and not (lines[rr][cc+2] in FILLED and
+                                            lines[rr-1][cc+1] in FILLED))
+                tcont = (t == '\\' and not (lines[rr-2][cc] in FILLED and
+                                            lines[rr-1][cc+1] in FILLED))
+                v = ((None           if rcont else PX_HALFSLANT1H) if tcont else
+                     (PX_HALFSLANT1V if rcont else PX_HALF1))
+            elif px == '9':
+                lcont = (l == '\\' and not (lines[rr][cc-2] in FILLED and
+                                            lines[rr+1][cc-1] in FILLED))
+                bcont = (b == '\\' and not (lines[rr+2][cc] in FILLED and
+                                            lines[rr+1][cc-1] in FILLED))
+                v = ((None           if lcont else PX_HALFSLANT2H) if bcont else
+                     (PX_HALFSLANT2V if lcont else PX_HALF2))
+            elif px == 'P':
+                rcont = (r == '/' and not (lines[rr][cc+2] in FILLED and
+                                           lines[rr+1][cc+1] in FILLED))
+                bcont = (b == '/' and not (lines[rr+2][cc] in FILLED and
+                                           lines[rr+1][cc+1] in FILLED))
+                v = ((None           if rcont else PX_HALFSLANT3H) if bcont else
+                     (PX_HALFSLANT3V if rcont else PX_HALF3))
+            elif px == 'd':
+                lcont = (l == '/' and not (lines[rr][cc-2] in FILLED and
+                                           lines[rr-1][cc-1] in FILLED))
+                tcont = (t == '/' and not (lines[rr-2][cc] in FILLED and
+                                           lines[rr-1][cc-1] in FILLED))
+                v = ((None           if lcont else PX_HALFSLANT4H) if tcont else
+                     (PX_HALFSLANT4V if lcont else PX_HALF4))
+            else:
+                tfull = (t in FILLED)
+                bfull = (b in FILLED)
+                lfull = (l in FILLED)
+                rfull = (r in FILLED)
+                if px == '\\':
+                    if (lfull or bfull) and not (rfull and tfull):
+                        v = ((None       if l=='b' else PX_SLANT1H) if b=='b' else
+                             (PX_SLANT1V if l=='b' else PX_HALF1))
+                    if not (lfull and bfull) and (rfull or tfull):
+                        v = ((None       if r=='9' else PX_SLANT2H) if t=='9' else
+                             (PX_SLANT2V if r=='9' else PX_HALF2))
+                elif px == '/':
+                    if (lfull or tfull) and not (rfull and bfull):
+                        v = ((None       if l=='P' else PX_SLANT3H) if t=='P' else
+                             (PX_SLANT3V if l=='P' else PX_HALF3))
+                    if not (lfull and tfull) and (rfull or bfull):
+                        v = ((None       if r=='d' else PX_SLANT4H) if b=='d' else
+                             (PX_SLANT4V if r=='d' else PX_HALF4))
+                elif px in '>)':
+                    if lfull and not (rfull or tfull or bfull): v = PX_QUAD1
+                    if not lfull and (rfull or tfull or bfull): v = PX_INVQUAD1
+                elif px in 'vu':
+                    if tfull and not (lfull or rfull or bfull): v = PX_QUAD2
+                    if not tfull and (lfull or rfull or bfull): v = PX_INVQUAD2
+                elif px in '<(':
+                    if rfull and not (lfull or tfull or bfull): v = PX_QUAD3
+                    if not rfull and (lfull or tfull or bfull): v = PX_INVQUAD3
+                elif px in '^n':
+                    if bfull and not (lfull or rfull or tfull): v = PX_QUAD4
+                    if not bfull and (lfull or rfull or tfull): v = PX_INVQUAD4
+                else:
+                    raise ParseError(u'unknown %r pixel at %r' % (px, (rr, cc)))
+            if v is None:
+                raise ParseError(u'ambiguous %r pixel at %r' % (px, (rr, cc)))
+            if px in FILLED:
+                v |= PX_FULL
+            return v
+
         def parse_pixels(lines, bbox):
-            width = len(lines[0])
-            height = len(lines)
-            pixels = []
-            for rr, line in enumerate(lines):
-                assert len(line) == width
-                if not (bbox[0] <= rr <= bbox[2]): continue
-                for cc, px in enumerate(line):
-                    if not (bbox[1] <= cc <= bbox[3]): continue
+            top, left, bottom, right = bbox
+            pixels = self.arena
+            start = len(pixels)
+            for rr in xrange(top, bottom + 1):
+                line = lines[rr]
+                if not isinstance(line, list): # no explicit pixels
+                    row = line[left:right+1].encode('ascii', 'replace')
+                    if not row.translate(None, SIMPLE_CHARS):
+                        pixels.extend(row.translate(SIMPLE_TABLE))
+                        continue
+                for cc in xrange(left, right + 1):
+                    px = line[cc]
                     if isinstance(px, int): # explicit pixel
                         pixels.append(px)
                         continue
-                    v = None
-                    t = lines[rr-1][cc]; b = lines[rr+1][cc]
-                    l = lines[rr][cc-1]; r = lines[rr][cc+1]
-                    if px == '@':
-                        v = PX_ALMOSTFULL
-                    elif px == '*':
-                        # does not participate to the contextual positioning
-                        v = PX_DOT | PX_FULL
-                    elif px in '.!+':
-                        v = PX_EMPTY
-                    elif px == 'b':
-                        # @@.@@
-                        # @/d@@ <- avoid parsing this as connected
-                        rcont = (r == '\\' and not (lines[rr][cc+2] in FILLED and
-                                                    lines[rr-1][cc+1] in FILLED))
-                        tcont = (t == '\\' and not (lines[rr-2][cc] in FILLED and
-                                                    lines[rr-1][cc+1] in FILLED))
-                        v = ((None           if rcont else PX_HALFSLANT1H) if tcont else
-                             (PX_HALFSLANT1V if rcont else PX_HALF1))
-                    elif px == '9':
-                        lcont = (l == '\\' and not (lines[rr][cc-2] in FILLED and
-                                                    lines[rr+1][cc-1] in FILLED))
-                        bcont = (b == '\\' and not (lines[rr+2][cc] in FILLED and
-                                                    lines[rr+1][cc-1] in FILLED))
-                        v = ((None           if lcont else PX_HALFSLANT2H) if bcont else
-                             (PX_HALFSLANT2V if lcont else PX_HALF2))
-                    elif px == 'P':
-                        rcont = (r == '/' and not (lines[rr][cc+2] in FILLED and
-                                                   lines[rr+1][cc+1] in FILLED))
-                        bcont = (b == '/' and not (lines[rr+2][cc] in FILLED and
-                                                   lines[rr+1][cc+1] in FILLED))
-                        v = ((None           if rcont else PX_HALFSLANT3H) if bcont else
-                             (PX_HALFSLANT3V if rcont else PX_HALF3))
-                    elif px == 'd':
-                        lcont = (l == '/' and not (lines[rr][cc-2] in FILLED and
-                                                   lines[rr-1][cc-1] in FILLED))
-                        tcont = (t == '/' and not (lines[rr-2][cc] in FILLED and
-                                                   lines[rr-1][cc-1] in FILLED))
-                        v = ((None           if lcont else PX_HALFSLANT4H) if tcont else
-                             (PX_HALFSLANT4V if lcont else PX_HALF4))
-                    else:
-                        tfull = (t in FILLED)
-                        bfull = (b in FILLED)
-                        lfull = (l in FILLED)
-                        rfull = (r in FILLED)
-                        if px == '\\':
-                            if (lfull or bfull) and not (rfull and tfull):
-                                v = ((None       if l=='b' else PX_SLANT1H) if b=='b' else
-                                     (PX_SLANT1V if l=='b' else PX_HALF1))
-                            if not (lfull and bfull) and (rfull or tfull):
-                                v = ((None       if r=='9' else PX_SLANT2H) if t=='9' else
-                                     (PX_SLANT2V if r=='9' else PX_HALF2))
-                        elif px == '/':
-                            if (lfull or tfull) and not (rfull and bfull):
-                                v = ((None       if l=='P' else PX_SLANT3H) if t=='P' else
-                                     (PX_SLANT3V if l=='P' else PX_HALF3))
-                            if not (lfull and tfull) and (rfull or bfull):
-                                v = ((None       if r=='d' else PX_SLANT4H) if b=='d' else
-                                     (PX_SLANT4V if r=='d' else PX_HALF4))
-                        elif px in '>)':
-                            if lfull and not (rfull or tfull or bfull): v = PX_QUAD1
-                            if not lfull and (rfull or tfull or bfull): v = PX_INVQUAD1
-                        elif px in 'vu':
-                            if tfull and not (lfull or rfull or bfull): v = PX_QUAD2
-                            if not tfull and (lfull or rfull or bfull): v = PX_INVQUAD2
-                        elif px in '<(':
-                            if rfull and not (lfull or tfull or bfull): v = PX_QUAD3
-                            if not rfull and (lfull or tfull or bfull): v = PX_INVQUAD3
-                        elif px in '^n':
-                            if bfull and not (lfull or rfull or tfull): v = PX_QUAD4
-                            if not bfull and (lfull or rfull or tfull): v = PX_INVQUAD4
-                        else:
-                            raise ParseError(u'unknown %r pixel at %r' % (px, (rr, cc)))
+                    v = SIMPLE_PIXELS.get(px)
                     if v is None:
-                        raise ParseError(u'ambiguous %r pixel at %r' % (px, (rr, cc)))
-                    if px in FILLED:
-                        v |= PX_FULL
+                        v = classify_pixel(lines, rr, cc, px)
                     pixels.append(v)
-            return pixels
+            return Pixels(pixels, start, len(pixels) - start)
 
         # referenced by flush_glyph and define_glyph
         default_flags = 0
@@ -750,6 +1108,15 @@ class Font(object):
                                 raise ParseError(u'duplicate row mark %r in glyph %s' %
                                                  (rowmark, name))
                             rowmarks[rowmark] = r
+                        if '?' not in line and placeholders.isdisjoint(line):
+                            # only + needs to be looked at, which can be done per row
+                            left = len(line) - len(line.lstrip('+'))
+                            if left < len(line):
+                                right = len(line.rstrip('+')) - 1
+                                bbox = update_bbox(update_bbox(bbox, r, left), r, right)
+                            newlines.append(line + '.')
+                            r += 1
+                            continue
                         newline = []
                         for c, px in enumerate(line):
                             if px == '?':
@@ -833,6 +1200,7 @@ class Font(object):
             self.glyphs[name] = Glyph(flags=flags, height=None, width=default_width,
                                       preferred_top=roff, preferred_left=coff,
                                       subglyphs=subglyphs, points=points)
+            if PROFILE is not None: PROFILE.glyph_parsed(name)
 
         def define_glyph(name, specs):
             if isinstance(name, basestring):
@@ -873,18 +1241,9 @@ class Font(object):
 
         current_glyph = None # or GlyphArgs
         prev_args = []
-        TOKEN_PATTERN = re.compile(ur'`(?:[^`]|``)*`|\S+')
+        if PROFILE is not None: PROFILE.start_parsing()
         for line in fp:
-            args = []
-            for tok in TOKEN_PATTERN.findall(line.decode('utf-8')):
-                if tok.startswith('//'): break # beginning of comment
-                if tok.startswith('`'):
-                    assert len(tok) >= 2 and tok.endswith('`')
-                    args.append(tok[1:-1].replace('``', '`'))
-                elif '`' in tok:
-                    raise ParseError('unquoted backquotes in token %r' % tok)
-                else:
-                    args.append(tok)
+            args = tokenize_line(line.decode('utf-8'))
             if not args: continue
             if args[-1] == '..': # continuation token
                 prev_args.extend(args[:-1])
@@ -1029,7 +1388,7 @@ class Font(object):
                 # exclude-from-sample <char> ...
                 for arg in args[1:]:
                     for name in parse_char_name(arg):
-                        self.exclude_from_sample.add(name)
+                        self.exclude_from_sample.append(name)
 
             elif args[0] == 'default':
                 # default +<option> [<args> ...]
@@ -1150,12 +1509,927 @@ class Font(object):
 
         if current_glyph: flush_glyph(*current_glyph)
 
-    def resolve_glyphs(self):
-        resolved = set()
-        def resolve(name):
-            if name in resolved: return
-            resolved.add(name)
+# the parse cache is keyed by the source file contents and the parser itself,
+# so any change to this script invalidates every cached fragment.
+# bump this when the cached format changes without changing the parser.
+PARSE_CACHE_VERSION = 1
+
+_parser_digest = None
+def get_parser_digest():
+    global _parser_digest
+    if _parser_digest is None:
+        with open(os.path.splitext(__file__)[0] + '.py', 'rb') as f:
+            _parser_digest = hashlib.sha1(f.read()).hexdigest()
+    return _parser_digest
+
+# source files larger than this are split into multiple fragments when parsed in parallel
+SOURCE_CHUNK_SIZE = 16384
+
+def split_source(lines, chunksize=SOURCE_CHUNK_SIZE):
+    # split the source at `glyph` commands so that each chunk can be parsed independently.
+    # `default` and `name-parts` commands change the parser state,
+    # so they are repeated at the beginning of every subsequent chunk.
+    chunks = []
+    current = []
+    prelude = []
+    size = 0
+    continued = stateful = False
+    for line in lines:
+        if '`' in line or '//' in line or '..' in line:
+            try:
+                args = tokenize_line(line)
+            except ParseError:
+                return [lines] # let the parser report this
+        else:
+            args = line.split()
+        if args and not continued:
+            stateful = args[0] in ('default', 'name-parts')
+            if args[0] == 'glyph' and size >= chunksize:
+                chunks.append(current)
+                current = prelude[:]
+                size = 0
+        current.append(line)
+        size += len(line)
+        if stateful: prelude.append(line)
+        if args:
+            continued = (args[-1] == '..')
+            if not continued: stateful = False
+    chunks.append(current)
+    return chunks
+
+def read_source(path, cache=None, pool=None):
+    # returns a function that returns a list of FontFragments for given source file.
+    # when the pool is given the parsing is started immediately (possibly in multiple chunks),
+    # otherwise the parsing is deferred until the function gets called.
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    if cache:
+        # pickled classes are found by the module name, which differs when this is imported
+        key = BuildCache.make_key(PARSE_CACHE_VERSION, get_parser_digest(), __name__, contents)
+        fragments = cache.load('parse', key)
+        if fragments is not None: return lambda: fragments
+
+    lines = contents.splitlines(True)
+    if pool:
+        results = [pool.apply_async(FontFragment, (chunk,)) for chunk in split_source(lines)]
+        parse = lambda: [result.get() for result in results]
+    else:
+        parse = lambda: [FontFragment(lines)]
+    if not cache: return parse
+
+    def parse_and_cache():
+        fragments = parse()
+        cache.store('parse', key, fragments)
+        return fragments
+    return parse_and_cache
+
+# how often --watch checks source files for changes, in seconds
+WATCH_INTERVAL = 0.5
+
+class SourceWatcher(object):
+    # keeps the parsed fragments of source files and resolved glyphs between builds,
+    # so that only changed files are parsed again and only affected glyphs are resolved again.
+    # source files are found from glob patterns at every check, so added files are noticed.
+    def __init__(self, patterns, cache=None, pool=None, subset=None):
+        self.patterns = patterns
+        self.cache = cache
+        self.pool = pool
+        self.subset = subset # CodepointRanges or None
+        self.files = OrderedDict() # path: ((mtime, size), list of FontFragments or None)
+        self.resolved = {} # memo for Font.resolve_glyphs
+
+    def poll(self):
+        # returns a list of changed (including added) paths, or None if nothing has changed
+        files = OrderedDict()
+        changed = []
+        for pat in self.patterns:
+            for path in glob.glob(pat):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # removed in the meantime
+                stamp = st.st_mtime, st.st_size
+                previous = self.files.get(path)
+                if previous and previous[0] == stamp:
+                    files[path] = previous
+                else:
+                    files[path] = stamp, None
+                    changed.append(path)
+        if not changed and list(files) == list(self.files): return None
+        self.files = files
+        return changed
+
+    def build(self):
+        # parses files not parsed yet and returns a font with resolved and inlined glyphs.
+        # ParseError is annotated with the path as much as possible; the failed file is
+        # parsed again at the next build, which is only triggered by a change.
+        for path, (stamp, fragments) in self.files.items():
+            if fragments is not None: continue
+            try:
+                fragments = read_source(path, self.cache, self.pool)()
+            except ParseError as e:
+                raise ParseError(u'%s: %s' % (path.decode(sys.getfilesystemencoding()), e))
+            except IOError:
+                continue # removed in the meantime, will be noticed at the next check
+            self.files[path] = stamp, fragments
+
+        font = Font()
+        for path, (_, fragments) in self.files.items():
+            for fragment in fragments or ():
+                try:
+                    font.merge(fragment)
+                except ParseError as e:
+                    raise ParseError(u'%s: %s' % (path.decode(sys.getfilesystemencoding()), e))
+        font.resolve_glyphs(self.resolved)
+        if self.subset is not None: font.subset(self.subset)
+        font.inline_glyphs()
+        return font
+
+    def run(self, write_outputs):
+        # builds whenever any source file changes, until interrupted
+        print >>sys.stderr, 'watching %d source file(s), press Ctrl-C to stop' % \
+                len(self.poll() or ())
+        changed = True
+        while True:
+            if changed is not None:
+                start = time.time()
+                try:
+                    font = self.build()
+                except ParseError as e:
+                    print >>sys.stderr, unicode(e).encode('utf-8')
+                else:
+                    write_outputs(font)
+                    print >>sys.stderr, '%s: rebuilt in %.3fs' % (time.strftime('%H:%M:%S'),
+                                                                 time.time() - start)
+            time.sleep(WATCH_INTERVAL)
+            changed = self.poll()
+
+# benchmarks (see src/bench.py) set this to a dict to collect the time spent in each stage
+# that reports itself with `stage_done`; otherwise the reporting is almost free.
+STAGE_TIMES = None
+
+def stage_done(name, start):
+    # returns the current time, so that the next stage can start from there
+    now = time.time()
+    if STAGE_TIMES is not None:
+        STAGE_TIMES[name] = STAGE_TIMES.get(name, 0) + (now - start)
+    return now
+
+# set to a Profile by --profile; the build calls into it only when set.
+PROFILE = None
+
+class Profile(object):
+    # per-glyph and per-remapping-set costs of the build.
+    # parsing and tracing report to this while running, and others are collected afterwards.
+    def __init__(self):
+        self.last_parsed = None
+        self.parse_times = {} # glyph name: seconds since the previous glyph (or the file start)
+        self.trace_times = {} # ContourCache key: seconds
+        self.depths = {} # glyph name: nesting depth of subglyph references after resolve_glyphs
+        self.glyphs = {} # glyph name: GlyphProfile, available after `record_layout`
+        self.remaps = {} # set name: RemapProfile, available after `record_layout`
+        # (lookups, subtables) in GSUB and the same without class-based subtables and
+        # shared chained lookups, available after `record_layout`
+        self.gsub = None
+
+    def start_parsing(self):
+        self.last_parsed = time.time()
+
+    def glyph_parsed(self, name):
+        now = time.time()
+        self.parse_times[name] = now - self.last_parsed
+        self.last_parsed = now
+
+    def trace(self, pending):
+        # replaces the sequential tracing in Font.layout
+        for key, (height, width, stride, data) in pending.items():
+            start = time.time()
+            contours = track_contour(height, width, stride, data, PX_SUBPIXEL)
+            self.trace_times[key] = time.time() - start
+            yield contours
+
+    def record_resolved(self, font):
+        def get_depth(name):
+            try: return self.depths[name]
+            except KeyError: pass
+            depth = 0 # resolve_glyphs has rejected cyclic references
+            for g in font.glyphs[name].subglyphs:
+                data = g.data.value if isinstance(g.data, Adjoin) else g.data
+                if isinstance(data, basestring): depth = max(depth, get_depth(data) + 1)
+            self.depths[name] = depth
+            return depth
+        for name in font.glyphs: get_depth(name)
+
+    def record_layout(self, font, contour_cache):
+        # should be called after the font is written with `contour_cache`.
+        # glyphs removed by inline_glyphs are not included. the tracing time of
+        # identical pixel subglyphs, which are traced only once, is counted for every glyph.
+        for name, gg in font.glyphs.items():
+            contours = points = 0
+            trace_time = 0.0
+            for g in gg.subglyphs:
+                if not isinstance(g.data, Pixels): continue
+                key = ContourCache.make_key(g.height, g.width, g.stride, g.data, PX_SUBPIXEL)
+                paths = contour_cache.entries.get(key, [])
+                contours += len(paths)
+                points += sum(len(path) for path in paths)
+                trace_time += self.trace_times.get(key, 0.0)
+            self.glyphs[name] = GlyphProfile(
+                name=name, parse_time=self.parse_times.get(name), depth=self.depths.get(name),
+                subglyphs=len(gg.subglyphs), contours=contours, points=points,
+                trace_time=trace_time)
+
+        # chained lookups are counted to the remapping set using them
+        layout = font.layout(contour_cache=contour_cache)
+        glyphids = dict((name, i) for i, name in enumerate(layout.glyphorder))
+        parents = {}
+        for setname, kind, data in layout.lookups:
+            if kind == LOOKUP_CHAIN:
+                for rule in data: parents[rule.setname] = setname
+        for setname, kind, data in layout.lookups:
+            setname = parents.get(setname, setname)
+            entries = sum(len(ligs) for _, ligs in data) if kind == LOOKUP_LIGATURE else len(data)
+            prev = self.remaps.get(setname) or \
+                   RemapProfile(name=setname, remaps=len(font.remaps[setname]),
+                                lookups=0, entries=0)
+            self.remaps[setname] = prev._replace(lookups=prev.lookups + 1,
+                                                 entries=prev.entries + entries)
+
+        # otherwise every chaining rule would have its own subtable and chained lookup
+        chains = [data for _, kind, data in layout.lookups if kind == LOOKUP_CHAIN]
+        rules = sum(map(len, chains))
+        chained = len(set(rule.lookup for data in chains for rule in data))
+        subtables = len(layout.lookups) - len(chains) + \
+                    sum(1 if chain_classes(data, glyphids) else len(data) for data in chains)
+        lookups = len(layout.lookups) - chained + rules
+        self.gsub = len(layout.lookups), subtables, lookups, lookups - len(chains) + rules
+
+    def write(self, fp, csv=False):
+        # CSV has glyphs only; remapping sets are written separately by `write_remaps_csv`
+        glyphs = sorted(self.glyphs.values())
+        remaps = sorted(self.remaps.values())
+        if csv:
+            print >>fp, ','.join(GlyphProfile._fields)
+            for p in glyphs:
+                print >>fp, ','.join('' if v is None else '"%s"' % v.replace('"', '""')
+                                     if isinstance(v, basestring) else repr(v)
+                                     for v in p).encode('utf-8')
+        else:
+            import json
+            json.dump({'glyphs': [p._asdict() for p in glyphs],
+                       'remaps': [p._asdict() for p in remaps]}, fp, indent=1)
+
+    def write_remaps_csv(self, fp):
+        print >>fp, ','.join(RemapProfile._fields)
+        for p in sorted(self.remaps.values()):
+            print >>fp, ('"%s",%d,%d,%d' % (p.name.replace('"', '""'), p.remaps,
+                                            p.lookups, p.entries)).encode('utf-8')
+
+    def summarize(self, fp, top=10):
+        def show(title, items, key, fmt):
+            items = sorted(items, key=key, reverse=True)[:top]
+            if not items: return
+            print >>fp, '  top %d %s:' % (len(items), title)
+            for p in items:
+                print >>fp, ('    %-32s %s' % (p.name, fmt(p))).encode('utf-8')
+        glyphs = self.glyphs.values()
+        show('glyphs by parsing time', glyphs, lambda p: p.parse_time,
+             lambda p: '%.2fms' % (p.parse_time * 1000))
+        show('glyphs by tracing time', glyphs, lambda p: p.trace_time,
+             lambda p: '%.2fms (%d contours, %d points)' % (p.trace_time * 1000,
+                                                            p.contours, p.points))
+        show('glyphs by resolve depth', glyphs, lambda p: p.depth,
+             lambda p: 'depth %d, %d subglyphs after inlining' % (p.depth, p.subglyphs))
+        show('remapping sets by GSUB entries', self.remaps.values(), lambda p: p.entries,
+             lambda p: '%d entries in %d lookups (from %d remaps)' % (p.entries, p.lookups,
+                                                                      p.remaps))
+        if self.gsub:
+            print >>fp, '  GSUB: %d lookups and %d subtables ' \
+                        '(%d lookups and %d subtables without class-based subtables ' \
+                        'and shared lookups)' % self.gsub
+
+GlyphProfile = namedtuple('GlyphProfile',
+                          'name parse_time depth subglyphs contours points trace_time')
+RemapProfile = namedtuple('RemapProfile', 'name remaps lookups entries')
+
+class MemoryReport(object):
+    # memory usage of the main process at the end of each build stage, for --mem-report.
+    # python 2 has no tracemalloc, so the peak is the high-water mark of the resident set size
+    # (reset at each stage boundary on Linux, otherwise the peak so far from getrusage),
+    # the retained memory is the resident set size from /proc (if any), and gc-tracked objects
+    # are counted by type in place of allocation sites.
+    def __init__(self, budget=None, top=10):
+        self.budget = budget # in bytes, or None
+        self.top = top
+        # (stage, peak, whether the peak is of that stage only, retained,
+        #  [(type name, count delta, size delta), ...])
+        self.stages = []
+        self.last_rss = self.get_rss()
+        self.last_counts = self.count_objects()
+        self.peak_reset = self.reset_peak_rss()
+
+    @staticmethod
+    def reset_peak_rss():
+        # resets the high-water mark to the current resident set size (Linux 4.0+).
+        # returns False if it can't be reset, so that the peak is of the whole process so far.
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except IOError:
+            return False
+
+    @staticmethod
+    def get_peak_rss():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except IOError:
+            pass
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # in bytes
+
+    @staticmethod
+    def get_rss():
+        try:
+            import resource
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, ImportError):
+            return None
+
+    @staticmethod
+    def count_objects():
+        counts = {} # type name: (count, total size)
+        for o in gc.get_objects():
+            name = type(o).__name__
+            count, size = counts.get(name, (0, 0))
+            counts[name] = count + 1, size + sys.getsizeof(o)
+        return counts
+
+    def stage_done(self, stage):
+        gc.collect() # only count what is retained
+        peak = self.get_peak_rss()
+        rss = self.get_rss()
+        retained = None if rss is None or self.last_rss is None else rss - self.last_rss
+        counts = self.count_objects()
+        growths = []
+        for name, (count, size) in counts.items():
+            lastcount, lastsize = self.last_counts.get(name, (0, 0))
+            if count != lastcount: growths.append((name, count - lastcount, size - lastsize))
+        growths.sort(key=lambda (name, count, size): (-abs(size), name))
+        self.stages.append((stage, peak, self.peak_reset, retained, growths[:self.top]))
+        self.last_rss = rss
+        self.last_counts = counts
+
+        if self.budget is not None and peak > self.budget:
+            self.print_report(sys.stderr)
+            print >>sys.stderr, 'memory budget exceeded %s %s: %.1fMB > %.1fMB' % (
+                    'in' if self.peak_reset else 'by the end of', stage,
+                    peak / 1048576., self.budget / 1048576.)
+            raise SystemExit(1)
+        self.peak_reset = self.reset_peak_rss()
+
+    def print_report(self, fp):
+        print >>fp, '  memory (main process):'
+        for stage, peak, peak_reset, retained, growths in self.stages:
+            print >>fp, '    %-14s %-11s %7.1fMB, retained %s' % (
+                    stage, 'peak' if peak_reset else 'peak so far', peak / 1048576.,
+                    '?' if retained is None else '%+.1fMB' % (retained / 1048576.))
+            for name, count, size in growths:
+                print >>fp, '      %-28s %+9d objects %+9.1fKB' % (name, count, size / 1024.)
+
+# the number of pixel subglyphs traced at once by each worker process
+TRACE_CHUNK_SIZE = 64
+
+def trace_contours(tracings):
+    # runs in the worker process; also returns its pid and the time spent for reporting
+    start = time.time()
+    contours = [track_contour(height, width, stride, data, PX_SUBPIXEL)
+                for height, width, stride, data in tracings]
+    return os.getpid(), time.time() - start, contours
+
+# the default size limit of the on-disk contour cache (approximate, in bytes)
+CONTOUR_CACHE_SIZE = 32 << 20
+
+# should be bumped whenever track_contour returns different contours for the same pixels
+CONTOUR_CACHE_VERSION = 2
+
+KEY_TABLES = {} # mask: table for pixel codes in ContourCache keys
+
+class ContourCache(object):
+    # memoizes track_contour by the pixel contents, so identical pixel subglyphs are traced once.
+    # when the BuildCache is given, the entries are loaded from and saved to that cache;
+    # only the most recently used entries up to `maxsize` bytes are saved.
+    def __init__(self, cache=None, maxsize=CONTOUR_CACHE_SIZE):
+        self.cache = cache
+        self.maxsize = maxsize
+        self.entries = OrderedDict() # key: contours, least recently used first
+        self.hits = 0
+        self.misses = 0
+        if cache:
+            entries = cache.load('contours', self.cache_key())
+            if isinstance(entries, OrderedDict): self.entries = entries
+
+    @staticmethod
+    def cache_key():
+        return BuildCache.make_key(CONTOUR_CACHE_VERSION)
+
+    @staticmethod
+    def make_key(height, width, stride, data, mask):
+        # the stride and bits out of the mask do not affect the tracing.
+        # rows are copied straight out of the arena (slicing a buffer gives a str).
+        try:
+            table = KEY_TABLES[mask]
+        except KeyError:
+            table = KEY_TABLES[mask] = ''.join(chr(i & mask) for i in xrange(0x100))
+        view = buffer(data.arena, data.offset)
+        if stride == width:
+            pixels = view[:height*width]
+        else:
+            pixels = ''.join(view[r*stride:r*stride+width] for r in xrange(height))
+        return height, width, mask, pixels.translate(table)
+
+    def get(self, key):
+        try:
+            contours = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = contours
+        return contours
+
+    def put(self, key, contours):
+        self.entries[key] = contours
+
+    def save(self):
+        if not self.cache: return
+        entries = OrderedDict()
+        size = 0
+        for key, contours in reversed(self.entries.items()):
+            size += len(key[3]) + 16 * sum(len(path) for path in contours)
+            if size > self.maxsize: break
+            entries[key] = contours
+        self.cache.store('contours', self.cache_key(), OrderedDict(reversed(entries.items())))
+
+# should be bumped whenever the fingerprint or the cached fragments change their meanings
+# without changing this script (any change to the script invalidates the manifest anyway)
+MANIFEST_VERSION = 1
+
+class GlyphManifest(object):
+    # per-glyph fingerprints of the final font, so that outputs for unchanged glyphs can be
+    # reused from the previous build. the fingerprint of a glyph covers its own data and
+    # the fingerprints of glyphs it refers to, so anything affecting its output changes it.
+    # output fragments (e.g. TTX glyf entries) are kept by the fingerprint for each kind of output,
+    # and only fragments for glyphs in the current font are saved.
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.fingerprints = {} # glyph name: hex digest
+        self.fragments = {} # kind: {fingerprint: fragment}
+        self.referrers = {} # glyph name: list of glyph names referring to it
+        self.changed = set() # glyph names with a different fingerprint from the previous build
+        self.hits = 0
+        self.misses = 0
+        if cache:
+            saved = cache.load('manifest', self.cache_key())
+            if saved: self.fingerprints, self.fragments = saved
+
+    def update(self, font):
+        # should be called with the final font before any fragment is requested.
+        # fingerprints are calculated from referenced glyphs to referring glyphs.
+        # shared pixel subglyphs are covered by their positions, as their pixels are same.
+        previous = self.fingerprints
+        self.fingerprints = {}
+        references, self.referrers = reference_graph(font.glyphs)
+        shared = font.share_pixels()
+        for name in topological_order(references, self.referrers):
+            gg = font.glyphs[name]
+            fingerprint = hashlib.sha1(repr((name, gg.flags, gg.height, gg.width,
+                                             gg.preferred_top, gg.preferred_left,
+                                             sorted(gg.points.items()))))
+            for i, g in enumerate(gg.subglyphs):
+                top, left, height, width, stride, data, negated = g
+                if (name, i) in shared:
+                    sharedname, sharedindex = shared[name, i]
+                    sharedgg = font.glyphs[sharedname]
+                    sharedg = sharedgg.subglyphs[sharedindex]
+                    data = (sharedname, sharedindex, sharedgg.height, sharedg.top, sharedg.left,
+                            len(sharedgg.subglyphs))
+                elif isinstance(data, Pixels):
+                    data = str(data)
+                else:
+                    data = self.fingerprints[data]
+                fingerprint.update(repr((top, left, height, width, stride, data, negated)))
+            self.fingerprints[name] = fingerprint.hexdigest()
+        self.changed = set(name for name, fingerprint in self.fingerprints.iteritems()
+                           if previous.get(name) != fingerprint)
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def cache_key():
+        return BuildCache.make_key(MANIFEST_VERSION, get_parser_digest())
+
+    def get(self, kind, name):
+        # returns a fragment for given glyph from the previous build, or None
+        fragment = self.fragments.get(kind, {}).get(self.fingerprints[name])
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fragment
+
+    def put(self, kind, name, fragment):
+        self.fragments.setdefault(kind, {})[self.fingerprints[name]] = fragment
+
+    def save(self):
+        if not self.cache: return
+        current = set(self.fingerprints.itervalues())
+        fragments = {}
+        for kind, kindfragments in self.fragments.items():
+            fragments[kind] = dict((fingerprint, fragment)
+                                   for fingerprint, fragment in kindfragments.iteritems()
+                                   if fingerprint in current)
+        self.cache.store('manifest', self.cache_key(), (self.fingerprints, fragments))
+
+# lookup types used by FontLayout.lookups, which is a list of (set name, lookup type, data):
+# - LOOKUP_SINGLE has a list of (input glyph, output glyph).
+# - LOOKUP_LIGATURE has a list of (first glyph, list of (remaining glyphs, output glyph)).
+# - LOOKUP_CHAIN has a list of ChainRules.
+LOOKUP_SINGLE = 1
+LOOKUP_LIGATURE = 4
+LOOKUP_CHAIN = 6
+
+# each coverage is a list of glyph names. `lookup` is an index to the lookup list,
+# which should be applied to the input when the context matches.
+ChainRule = namedtuple('ChainRule', 'backtrack input lookahead lookup setname')
+
+# a class-based form of ChainRules, written as a single subtable (format 2) instead of
+# a subtable per rule (format 3). backtrack, input and lookahead are dicts of glyph name: class;
+# classsets[c] is a list of (backtrack classes, remaining input classes, lookahead classes,
+# lookup) for glyphs of the input class c, in the order of original rules.
+ChainClasses = namedtuple('ChainClasses', 'coverage backtrack input lookahead classsets')
+
+def chain_classes(rules, glyphids):
+    # infers glyph classes so that every coverage in `rules` is exactly one class, and
+    # returns ChainClasses or None if it's not possible (a coverage would need multiple rules)
+    # or there is only one rule. glyphs in the same class are in the same set of coverages,
+    # so matching classes in the original order is same to matching each rule in turn.
+    if len(rules) < 2: return None
+    classdefs = []
+    ruleclasses = [[] for _ in rules]
+    for kind in ('backtrack', 'input', 'lookahead'):
+        coverages = [(i, glyphs) for i, rule in enumerate(rules) for glyphs in getattr(rule, kind)]
+        memberships = {} # glyph name: indices of coverages
+        for k, (_, glyphs) in enumerate(coverages):
+            for glyph in glyphs: memberships.setdefault(glyph, []).append(k)
+        classes = {} # indices of coverages: glyph names
+        for glyph, indices in memberships.items():
+            classes.setdefault(tuple(indices), []).append(glyph)
+        # classes are numbered from 1 in the order of their first glyphs
+        ordered = sorted(classes.items(),
+                         key=lambda (_, glyphs): min(glyphids[glyph] for glyph in glyphs))
+        classdef = {}
+        covclasses = [None] * len(coverages)
+        for c, (indices, glyphs) in enumerate(ordered, 1):
+            for glyph in glyphs: classdef[glyph] = c
+            for k in indices:
+                if covclasses[k] is not None: return None
+                covclasses[k] = c
+        if None in covclasses: return None # empty coverages
+        classdefs.append(classdef)
+        classes = [[] for _ in rules]
+        for (i, _), c in zip(coverages, covclasses): classes[i].append(c)
+        for i, c in enumerate(classes): ruleclasses[i].append(c)
+
+    backtrackdef, inputdef, lookaheaddef = classdefs
+    classsets = [[] for _ in xrange(max(inputdef.values()) + 1)]
+    for rule, (backclasses, inclasses, aheadclasses) in zip(rules, ruleclasses):
+        classsets[inclasses[0]].append((backclasses, inclasses[1:], aheadclasses, rule.lookup))
+    coverage = sorted(set(glyph for rule in rules for glyph in rule.input[0]),
+                      key=lambda glyph: glyphids[glyph])
+    return ChainClasses(coverage=coverage, backtrack=backtrackdef, input=inputdef,
+                        lookahead=lookaheaddef, classsets=classsets)
+
+# everything required to write the font, in font units. shared by Font.write_* methods.
+# glyphorder is a list of glyph names in the glyph index order (`.notdef` always comes first).
+# metrics is a list of (glyph name, advance width, left-side bearing) in the glyph index order.
+# outlines is a lazy iterator of (glyph name, contours, components), where contours are lists of
+# points and components are lists of (glyph name, x, y); it may be consumed only once.
+# glyphs reused by the caller have (glyph name, None, None) instead of all their entries.
+# features is a list of (feature name, list of (lookup index, set name)).
+# worker_times is filled while outlines are being consumed.
+# strikes is a list of (scale, list of BitmapGlyph or None for glyphs missing in that strike).
+FontLayout = namedtuple('FontLayout', 'emsize ascent descent linegap glyphorder metrics outlines '
+                                      'lookups features worker_times strikes')
+
+# a glyph in an embedded bitmap strike, with big glyph metrics (in pixels of that strike).
+# bits is a string of '0' and '1' for each pixel in the image, row by row; or
+# components is a list of (glyph name, x offset, y offset) from the top-left corner of the image.
+BitmapGlyph = namedtuple('BitmapGlyph', 'height width horibearingx horibearingy horiadvance '
+                                        'vertbearingx vertbearingy vertadvance bits components')
+
+NAMES = [
+    (0, 'copyright', u'Made by Kang Seonghoon; released in the public domain.'),
+    (1, 'family', u'Unison'),
+    (2, 'subfamily', u'Regular'),
+    (3, 'identifier', u'Unison'),
+    (4, 'fontname', u'Unison'),
+    (5, 'version', u'Version 0.1'),
+    (6, 'psname', u'Unison'),
+    (13, 'license', u'Public Domain. Or alternatively, CC0 1.0 Universal.'),
+]
+NAME_PLATFORMS = [(1, 0, 0), (3, 1, 0x409)] # (platform id, encoding id, language id)
+
+# TrueType instructions
+FPGM = '''
+    40120807 06050403 021b1a19 18171615 141e1f20 2c18b003 3f2d2c18 b0023f2d
+    2c18b001 3f2d2cb0 004358b1 0000451e 1f1bb000 1e592d2c b0004358 b1000045
+    1e1f1bb0 001e592d 2cb00043 58b10000 451e1f1b b0001e59 2d2cb000 4358b100
+    00451e1f 1bb0001e 592d2cb0 004358b1 0000451e 1f1bb000 1e592d2c b0004358
+    b1000045 1e1f1bb0 001e592d 2cb00043 58b10000 451e1f1b b0001e59 2d2cb000
+    4358b100 00451e1f 1bb0001e 592d2c18 2fdd2d2c 182f3cdd 2d2c182f 173cdd2d
+    2c182fdd 3c2d2c18 2fdd173c 2d2c182f 3cdd3c2d 2c182f17 3cdd173c 2d
+'''.replace(' ', '').replace('\n', '').decode('hex')
+PREP = '''
+    4bb01050 58ba01d0 00040000 8d8d851b b901d000 008d8559 b20010aa 4b524b50
+    5a42
+'''.replace(' ', '').replace('\n', '').decode('hex')
+CVT = [8, -9999, -9999, -9999, 20, 380]
+
+# TrueType glyph flags
+GLYF_ON_CURVE = 0x01
+GLYF_X_SHORT = 0x02
+GLYF_Y_SHORT = 0x04
+GLYF_REPEAT = 0x08
+GLYF_X_SAME = 0x10 # or positive short
+GLYF_Y_SAME = 0x20 # or positive short
+GLYF_ARG_1_AND_2_ARE_WORDS = 0x0001
+GLYF_ARGS_ARE_XY_VALUES = 0x0002
+GLYF_ROUND_XY_TO_GRID = 0x0004
+GLYF_MORE_COMPONENTS = 0x0020
+GLYF_UNSCALED_COMPONENT_OFFSET = 0x1000
+
+# seconds between 1904-01-01 (TrueType epoch) and 1970-01-01 (Unix epoch)
+TTF_EPOCH_OFFSET = 2082844800
+
+# the recommended order of tables in the file (other tables follow in the tag order)
+TTF_TABLE_ORDER = ['head', 'hhea', 'maxp', 'OS/2', 'hmtx', 'LTSH', 'VDMX', 'hdmx', 'cmap',
+                   'fpgm', 'prep', 'cvt ', 'loca', 'glyf', 'kern', 'name', 'post', 'gasp', 'PCLT']
+
+# signature, flavor, length, # of tables, reserved, total sfnt size, major version, minor version,
+# metadata offset, metadata length, metadata original length, private data offset and length
+WOFF_HEADER = struct.Struct('>4sLLHHLHHLLLLL')
+WOFF_ENTRY = struct.Struct('>4sLLLL') # tag, offset, compressed length, original length, checksum
+
+# height, width, horizontal bearing x/y, advance, vertical bearing x/y, advance
+BIG_GLYPH_METRICS = struct.Struct('>BBbbBbbB')
+# index subtable array offset, index tables size, # of index subtables, colorRef,
+# horizontal and vertical line metrics, start/end glyph index, ppem x/y, bit depth, flags
+EBLC_BITMAP_SIZE = struct.Struct('>LLLL12s12sHHBBBb')
+
+# standard Macintosh glyph names, referred by the `post` table format 2
+MAC_GLYPH_NAMES = '''
+    .notdef .null nonmarkingreturn space exclam quotedbl numbersign dollar percent ampersand
+    quotesingle parenleft parenright asterisk plus comma hyphen period slash zero one two three
+    four five six seven eight nine colon semicolon less equal greater question at A B C D E F G
+    H I J K L M N O P Q R S T U V W X Y Z bracketleft backslash bracketright asciicircum
+    underscore grave a b c d e f g h i j k l m n o p q r s t u v w x y z braceleft bar
+    braceright asciitilde Adieresis Aring Ccedilla Eacute Ntilde Odieresis Udieresis aacute
+    agrave acircumflex adieresis atilde aring ccedilla eacute egrave ecircumflex edieresis
+    iacute igrave icircumflex idieresis ntilde oacute ograve ocircumflex odieresis otilde uacute
+    ugrave ucircumflex udieresis dagger degree cent sterling section bullet paragraph germandbls
+    registered copyright trademark acute dieresis notequal AE Oslash infinity plusminus
+    lessequal greaterequal yen mu partialdiff summation product pi integral ordfeminine
+    ordmasculine Omega ae oslash questiondown exclamdown logicalnot radical florin approxequal
+    Delta guillemotleft guillemotright ellipsis nonbreakingspace Agrave Atilde Otilde OE oe
+    endash emdash quotedblleft quotedblright quoteleft quoteright divide lozenge ydieresis
+    Ydieresis fraction currency guilsinglleft guilsinglright fi fl daggerdbl periodcentered
+    quotesinglbase quotedblbase perthousand Acircumflex Ecircumflex Aacute Edieresis Egrave
+    Iacute Icircumflex Idieresis Igrave Oacute Ocircumflex apple Ograve Uacute Ucircumflex
+    Ugrave dotlessi circumflex tilde macron breve dotaccent ring cedilla hungarumlaut ogonek
+    caron Lslash lslash Scaron scaron Zcaron zcaron brokenbar Eth eth Yacute yacute Thorn thorn
+    minus multiply onesuperior twosuperior threesuperior onehalf onequarter threequarters franc
+    Gbreve gbreve Idotaccent Scedilla scedilla Cacute cacute Ccaron ccaron dcroat
+'''.split()
+
+# the binary interchange format read by the sample generator (`Font::from_binary` in font.rs).
+# it is a sequence of MessagePack values, where large tables are bins of little-endian structs:
+# - BINARY_MAGIC and BINARY_VERSION
+# - height, ascent, descent
+# - the string table: an array of every name used below; names are its indices
+# - the pixel data: a bin, referred by offsets from pixel subglyphs
+# - the glyph index: a bin of (glyph name, offset to the glyph table) sorted by glyph names
+# - the glyph table: a bin of glyph records, each being BINARY_GLYPH followed by
+#   as many BINARY_SUBGLYPHs and BINARY_POINTs as given in BINARY_GLYPH
+# - cmap: a bin of (code point, glyph name) sorted by code points
+# - remaps: a map from set names to arrays of [lookbehind, pattern, lookahead, replacement],
+#   where each item is a glyph/set name or an array of glyph names
+# - features: a map from feature names to arrays of set names
+# - exclude_from_sample: a bin of code points
+BINARY_MAGIC = 'unison'
+BINARY_VERSION = 1
+BINARY_INDEX = struct.Struct('<II') # name, offset
+BINARY_GLYPH = struct.Struct('<IIIiiII') # flags, height, width, preferred_top/left, #subglyphs/points
+BINARY_SUBGLYPH = struct.Struct('<iiIIIIIII') # top, left, height, width, negated, kind, data x 3
+BINARY_POINT = struct.Struct('<Iii') # name, row, column
+BINARY_CMAP = struct.Struct('<II') # code point, name
+BINARY_DATA_NONE = 0 # no data
+BINARY_DATA_PIXELS = 1 # stride, offset and length of the pixel data
+BINARY_DATA_NAMED = 2 # subglyph name
+BINARY_DATA_ADJOIN = 3 # subglyph name
+
+# a minimal MessagePack encoder for the binary interchange format
+def msgpack_int(v):
+    if 0 <= v < 0x80: return chr(v)
+    if -0x20 <= v < 0: return chr(v & 0xff)
+    if 0 < v <= 0xff: return '\xcc' + chr(v)
+    if 0 < v <= 0xffff: return struct.pack('>BH', 0xcd, v)
+    if 0 < v <= 0xffffffff: return struct.pack('>BL', 0xce, v)
+    if 0 < v: return struct.pack('>BQ', 0xcf, v)
+    if -0x80 <= v: return struct.pack('>Bb', 0xd0, v)
+    if -0x8000 <= v: return struct.pack('>Bh', 0xd1, v)
+    if -0x80000000 <= v: return struct.pack('>Bl', 0xd2, v)
+    return struct.pack('>Bq', 0xd3, v)
+
+def msgpack_str(s):
+    if isinstance(s, unicode): s = s.encode('utf-8')
+    n = len(s)
+    if n < 0x20: return chr(0xa0 | n) + s
+    if n <= 0xff: return struct.pack('>BB', 0xd9, n) + s
+    if n <= 0xffff: return struct.pack('>BH', 0xda, n) + s
+    return struct.pack('>BL', 0xdb, n) + s
+
+def msgpack_bin(s):
+    n = len(s)
+    if n <= 0xff: return struct.pack('>BB', 0xc4, n) + s
+    if n <= 0xffff: return struct.pack('>BH', 0xc5, n) + s
+    return struct.pack('>BL', 0xc6, n) + s
+
+def msgpack_array(n): # should be followed by n values
+    if n < 0x10: return chr(0x90 | n)
+    if n <= 0xffff: return struct.pack('>BH', 0xdc, n)
+    return struct.pack('>BL', 0xdd, n)
+
+def msgpack_map(n): # should be followed by n keys and values, interleaved
+    if n < 0x10: return chr(0x80 | n)
+    if n <= 0xffff: return struct.pack('>BH', 0xde, n)
+    return struct.pack('>BL', 0xdf, n)
+
+def ttf_checksum(data):
+    data += '\0' * (-len(data) % 4)
+    return sum(struct.unpack('>%dL' % (len(data) // 4), data)) & 0xffffffff
+
+def sfnt_directory(tables):
+    # returns (the offset table and table directory, tags in the order of table data,
+    # a dict of tag: (checksum, offset, length)) for tables to be put into an sfnt file.
+    # tables are laid out in the recommended order and the directory is sorted by tag.
+    # the checkSumAdjustment field of the head table is also filled.
+    tags = sorted(tables, key=lambda tag: (TTF_TABLE_ORDER.index(tag)
+                                           if tag in TTF_TABLE_ORDER else len(TTF_TABLE_ORDER),
+                                           tag))
+    numtables = len(tags)
+    searchrange = 1
+    while searchrange * 2 <= numtables: searchrange *= 2
+    offset = 12 + 16 * numtables
+    directory = {}
+    for tag in tags:
+        data = tables[tag]
+        directory[tag] = ttf_checksum(data), offset, len(data)
+        offset += len(data) + (-len(data) % 4)
+    header = struct.pack('>LHHHH', 0x10000, numtables, searchrange * 16,
+                         searchrange.bit_length() - 1, (numtables - searchrange) * 16) + \
+             ''.join(struct.pack('>4sLLL', tag, *directory[tag]) for tag in sorted(tables))
+    checksum = ttf_checksum(header) + sum(checksum for checksum, _, _ in directory.values())
+    adjustment = (0xb1b0afba - checksum) & 0xffffffff
+    tables['head'] = tables['head'][:8] + struct.pack('>L', adjustment) + tables['head'][12:]
+    return header, tags, directory
+
+def bitmap_image(bitmap):
+    # returns the image data of BitmapGlyph for EBDT format 6, where each row is byte-aligned.
+    # bit-aligned images (format 7) are not used; FreeType misplaces their pixels
+    # when they are components not aligned to bytes.
+    padding = '0' * (-bitmap.width % 8)
+    bits = ''.join(bitmap.bits[i:i+bitmap.width] + padding
+                   for i in xrange(0, len(bitmap.bits), bitmap.width or 1))
+    return ('%0*x' % (len(bits) // 4, int(bits, 2))).decode('hex') if bits else ''
+
+def bitmap_runs(bitmaps):
+    # returns a list of (first glyph index, last glyph index, image format) for a strike,
+    # where consecutive glyphs with the same image format share an index subtable:
+    # format 6 (big metrics, byte-aligned image) or 9 (big metrics, components).
+    runs = []
+    for gid, bitmap in enumerate(bitmaps):
+        if bitmap is None: continue
+        imageformat = 6 if bitmap.components is None else 9
+        if runs and runs[-1][1] == gid - 1 and runs[-1][2] == imageformat:
+            runs[-1] = runs[-1][0], gid, imageformat
+        else:
+            runs.append((gid, gid, imageformat))
+    return runs
+
+def sbit_line_metrics(bitmaps, ascent, descent, scale):
+    # returns the line metrics of a strike (ascender, descender, widthMax, caret slope
+    # numerator/denominator and offset, minOriginSB, minAdvanceSB, maxBeforeBL, minAfterBL,
+    # pad1 and pad2), shared by both directions.
+    present = filter(None, bitmaps)
+    return (ascent * scale // SCALE, -descent * scale // SCALE,
+            max(b.width for b in present), 1, 0, 0,
+            min(b.horibearingx for b in present),
+            min(b.horiadvance - b.horibearingx - b.width for b in present),
+            max(b.horibearingy for b in present),
+            min(b.horibearingy - b.height for b in present), 0, 0)
+
+def reference_graph(glyphs):
+    # returns the reference graph between glyphs as (references, referrers):
+    # references[name] is a set of glyphs `name` directly refers to as subglyphs,
+    # and referrers[name] is a list of glyphs directly referring to `name`.
+    references = {}
+    referrers = {}
+    for name, gg in glyphs.iteritems():
+        refs = references[name] = set([data.value if isinstance(data, Adjoin) else data
+                                       for _, _, _, _, _, data, _ in gg.subglyphs
+                                       if not isinstance(data, Pixels)])
+        for data in refs:
+            if data not in glyphs:
+                raise ParseError(u'glyph %s has a reference to non-existant glyph %s' %
+                                 (name, data))
+            referrers.setdefault(data, []).append(name)
+    return references, referrers
+
+def topological_order(references, referrers, remaining=None):
+    # yields glyph names from reference_graph so that every glyph comes after glyphs it refers to.
+    # glyphs in cycles (or referring to them) are never yielded and left in `remaining`,
+    # which maps them to the number of unyielded glyphs they refer to.
+    if remaining is None: remaining = {}
+    remaining.update((name, len(refs)) for name, refs in references.iteritems())
+    worklist = [name for name, count in remaining.iteritems() if count == 0]
+    while worklist:
+        name = worklist.pop()
+        del remaining[name]
+        yield name
+        for referrer in referrers.get(name, ()):
+            remaining[referrer] -= 1
+            if remaining[referrer] == 0: worklist.append(referrer)
+
+SHARD_CSS = 'unison.css' # written by `Font.write_shards` along with shards
+
+class Font(object):
+    def __init__(self, fp=None):
+        # +-----+               ^
+        # |     |               |
+        # |_____|  ^            |
+        # | @@@ |  |            |
+        # |@   @|  | ascent     |
+        # |@@@@@|  |            | height
+        # |@   @|  v            |
+        # ============ baseline |
+        # |     |  ^            |
+        # |     |  | descent    |
+        # +-----+  v            v
+        self.height = 16
+        self.ascent = 16
+        self.descent = 0 # XXX probably needs the downward translation in the glyph itself
+
+        self.glyphs = {} # name: Glyph
+        self.cmap = {} # index: glyph name
+        # remapping sets are kept in the source order, which is the order of GSUB lookups
+        self.remaps = OrderedDict() # set name: a list of Remaps
+        self.features = OrderedDict() # feature name: a list of remap set names
+        self.exclude_from_sample = set()
+
+        if fp: self.read(fp)
 
+    def read(self, fp):
+        self.merge(FontFragment(fp))
+
+    def merge(self, fragment):
+        for name, glyph in fragment.glyphs.items():
+            if name in self.glyphs:
+                raise ParseError(u'duplicate glyph %s' % name)
+            self.glyphs[name] = glyph
+        for ch, glyph in fragment.cmap.items():
+            if ch in self.cmap:
+                raise ParseError(u'duplicate character %s' % char_name(ch))
+            self.cmap[ch] = glyph
+        for setname, remaps in fragment.remaps.items():
+            self.remaps.setdefault(setname, []).extend(remaps)
+        for featurename, sets in fragment.features.items():
+            self.features.setdefault(featurename, []).extend(sets)
+        self.exclude_from_sample.update(fragment.exclude_from_sample)
+
+    def resolve_glyphs(self, memo=None):
+        # the memo, when given, is a dict of glyph name: (parsed glyph, resolved glyph)
+        # from the previous call and is updated in place. parsed glyphs are then left intact,
+        # and glyphs are reused as long as they and glyphs they refer to are parsed the same.
+        references, referrers = reference_graph(self.glyphs)
+
+        def resolve(name):
+            # should be called after every glyph in references[name] has been resolved
             gg = self.glyphs[name]
             assert isinstance(gg.preferred_top, int)
             assert isinstance(gg.preferred_left, int)
@@ -1164,7 +2438,7 @@ class Font(object):
             maxright = 0
             for k, g in enumerate(gg.subglyphs):
                 top, left, height, width, stride, data, negated = g
-                if isinstance(data, list):
+                if isinstance(data, Pixels):
                     # every other field should be final
                     assert isinstance(top, int)
                     assert isinstance(left, int)
@@ -1177,24 +2451,7 @@ class Font(object):
                         adjoin = True
                         data = data.value
 
-                    gg2 = self.glyphs[data]
-
-                    # if gg2 doesn't have enough info to resolve g's fields, try to resolve
-                    # (for gg2.height and gg2.height, we don't strictly need that to resolve,
-                    # but we use them for sanity checking so request them this early)
-                    if not ((isinstance(top, int) or gg2.preferred_top is not None) and
-                            (isinstance(left, int) or gg2.preferred_left is not None) and
-                            (isinstance(height, int) and gg2.height is not None) and
-                            (isinstance(width, int) and gg2.width is not None)):
-                        resolve(data)
-                        gg2 = self.glyphs[data] # since gg2 is, eh, an immutable tuple
-
-                    # if the resolution has failed, it has a cyclic dependency
-                    if not ((isinstance(top, int) or gg2.preferred_top is not None) and
-                            (isinstance(left, int) or gg2.preferred_left is not None) and
-                            (isinstance(height, int) or gg2.height is not None) and
-                            (isinstance(width, int) or gg2.width is not None)):
-                        raise ParseError(u'glyph %s has a cyclic dependency' % name)
+                    gg2 = self.glyphs[data] # already resolved
 
                     # resolve the default joining position if available
                     joining_delta = None
@@ -1247,7 +2504,38 @@ class Font(object):
                 height=maxbottom if gg.height is None else gg.height,
                 width=maxright if gg.width is None else gg.width)
 
-        for name in self.glyphs.keys(): resolve(name)
+        # glyphs are resolved after every glyph they refer to
+        unresolved = {}
+        if memo is None:
+            for name in topological_order(references, referrers, unresolved): resolve(name)
+        else:
+            reused = set()
+            for name in topological_order(references, referrers, unresolved):
+                parsed = self.glyphs[name]
+                previous = memo.get(name)
+                if previous and previous[0] is parsed and references[name] <= reused:
+                    self.glyphs[name] = previous[1]
+                    reused.add(name)
+                    continue
+                # resolve modifies subglyphs and points in place
+                self.glyphs[name] = parsed._replace(subglyphs=parsed.subglyphs[:],
+                                                    points=parsed.points.copy())
+                resolve(name)
+                memo[name] = parsed, self.glyphs[name]
+            for name in set(memo) - set(self.glyphs): del memo[name]
+
+        if unresolved:
+            # every remaining glyph refers to some remaining glyph, so following them loops
+            path = [min(unresolved)]
+            visited = {path[0]: 0}
+            while True:
+                name = min(ref for ref in references[path[-1]] if ref in unresolved)
+                if name in visited: break
+                visited[name] = len(path)
+                path.append(name)
+            cycle = path[visited[name]:] + [name]
+            raise ParseError(u'glyph %s has a cyclic dependency: %s' %
+                             (cycle[0], u' -> '.join(cycle)))
 
         def make_sticky(name):
             try:
@@ -1286,7 +2574,98 @@ class Font(object):
                     sets[i-offset] = sets[i]
             if offset: del sets[-offset:]
 
+    def subset(self, codepoints):
+        # prunes characters not in `codepoints` (anything supporting `in`) and everything
+        # not needed by the remaining characters. the glyph closure is computed through
+        # the cmap, subglyph references and remapping rules: a rule is kept when it can still
+        # match (every pattern and context position has a kept glyph), and its replacements
+        # for kept patterns are then kept. should be called after `resolve_glyphs`, and
+        # preferably before `inline_glyphs` so that only kept glyphs are considered for inlining.
+        # returns the number of glyphs removed.
+        references, _ = reference_graph(self.glyphs)
+
+        def alternatives(item):
+            return item if isinstance(item, list) else [item]
+
+        def variants(remap):
+            # the pattern has at most one glyph with parentheses (see `FontFragment.read`),
+            # so a rule is a list of pairwise substitutions, one for each alternative of it
+            count = max([len(item) for item in remap.pattern if isinstance(item, list)] or [1])
+            for i in xrange(count):
+                yield i, [item[i] if isinstance(item, list) else item
+                          for item in remap.pattern + remap.replacement]
+
+        kept = set()
+        def keep(names):
+            stack = [name for name in names if name not in kept]
+            while stack:
+                name = stack.pop()
+                if name in kept: continue
+                kept.add(name)
+                stack.extend(references[name] - kept)
+
+        cmap = dict((ch, name) for ch, name in self.cmap.iteritems() if ch in codepoints)
+        keep([u'.notdef'] if u'.notdef' in self.glyphs else [])
+        keep(cmap.values())
+
+        # replacements may make other rules match, so repeat until nothing is added
+        remaps = [r for setremaps in self.remaps.values() for r in setremaps]
+        while True:
+            before = len(kept)
+            for r in remaps:
+                if not all(any(name in kept for name in alternatives(item))
+                           for item in r.lookbehind + r.lookahead): continue
+                for _, names in variants(r):
+                    if all(name in kept for name in names[:len(r.pattern)]):
+                        keep(names[len(r.pattern):])
+            if len(kept) == before: break
+
+        def prune(remap):
+            # returns a remap restricted to kept glyphs, or None if it can no longer match
+            lookbehind = []
+            lookahead = []
+            for items, pruned in ((remap.lookbehind, lookbehind), (remap.lookahead, lookahead)):
+                for item in items:
+                    if isinstance(item, list):
+                        item = [name for name in item if name in kept]
+                        if not item: return None
+                    elif item not in kept:
+                        return None
+                    pruned.append(item)
+            indices = [i for i, names in variants(remap)
+                       if all(name in kept for name in names[:len(remap.pattern)])]
+            if not indices: return None
+            # lists are kept as lists, so the pairwise substitution is preserved
+            def select(items):
+                return [[item[i] for i in indices] if isinstance(item, list) else item
+                        for item in items]
+            return Remap(lookbehind=lookbehind, pattern=select(remap.pattern),
+                         lookahead=lookahead, replacement=select(remap.replacement))
+
+        # the subset should shape as the full font does for kept characters, so the order
+        # of remapping sets (and thus GSUB lookups) is kept as well
+        remaps = OrderedDict()
+        for setname, setremaps in self.remaps.items():
+            setremaps = filter(None, map(prune, setremaps))
+            if setremaps: remaps[setname] = setremaps
+        features = OrderedDict()
+        for featurename, sets in self.features.items():
+            sets = [setname for setname in sets if setname in remaps]
+            if sets: features[featurename] = sets
+        assert remaps.keys() == [setname for setname in self.remaps if setname in remaps], \
+               'remapping sets should be kept in order'
+
+        removed = len(self.glyphs) - len(kept)
+        self.glyphs = dict((name, self.glyphs[name]) for name in kept)
+        self.cmap = cmap
+        self.remaps = remaps
+        self.features = features
+        self.exclude_from_sample = set(ch for ch in self.exclude_from_sample if ch in codepoints)
+        return removed
+
     def inline_glyphs(self):
+        # glyphs are replaced instead of being modified, as they may be shared with
+        # the previous build (see `resolve_glyphs`).
         # invariant: redirect_to[a][0] == b <=> a in redirect_from[b]
         empty = set()
         redirect_to = {} # name: None or (subname, roff, coff)
@@ -1305,7 +2684,8 @@ class Font(object):
                     if g.data not in empty: subglyphs.append(g)
                 else:
                     if any(g.data): subglyphs.append(g)
-            gg.subglyphs[:] = subglyphs
+            if len(subglyphs) != len(gg.subglyphs):
+                self.glyphs[name] = gg = gg._replace(subglyphs=subglyphs)
 
             if not subglyphs:
                 if not (gg.flags & G_STICKY): empty.add(name)
@@ -1331,8 +2711,8 @@ class Font(object):
                 # we still need to avoid swapping if a-upper is replaced by, say, cyrillic А
                 gg2 = self.glyphs[subname]
                 if gg2.flags & G_STICKY: return
-                gg.subglyphs[:] = [g2._replace(top=g2.top+roff, left=g2.left+coff)
-                                   for g2 in gg2.subglyphs]
+                self.glyphs[name] = gg._replace(subglyphs=[
+                        g2._replace(top=g2.top+roff, left=g2.left+coff) for g2 in gg2.subglyphs])
                 for iname in redirect_from.get(subname, ()): # re-inlining
                     isubname, iroff, icoff = redirect_to[iname]
                     assert subname == isubname
@@ -1351,9 +2731,9 @@ class Font(object):
             if name in empty:
                 del self.glyphs[name]
             else:
-                subglyphs = gg.subglyphs
-                subglyphs.reverse() # so that we can pop the next subglyph easily
+                subglyphs = gg.subglyphs[::-1] # so that we can pop the next subglyph easily
                 newsubglyphs = []
+                changed = False
                 while subglyphs:
                     g = subglyphs.pop()
                     if isinstance(g.data, basestring):
@@ -1361,6 +2741,7 @@ class Font(object):
                             subname, roff, coff = redirect_to[g.data]
                             newsubglyphs.append(g._replace(top=g.top+roff, left=g.left+coff,
                                                            data=subname))
+                            changed = True
                             continue
                         gg2 = self.glyphs[g.data]
                         if gg2.flags & G_INLINE:
@@ -1368,16 +2749,93 @@ class Font(object):
                                 subglyphs.append(g2._replace(top=g2.top+g.top,
                                                              left=g2.left+g.left,
                                                              negated=g2.negated+g.negated))
+                            changed = True
                             continue
                     newsubglyphs.append(g)
-                subglyphs[:] = newsubglyphs
+                if changed: self.glyphs[name] = gg._replace(subglyphs=newsubglyphs)
 
         # inlined glyphs no longer require to be included
         for name, gg in self.glyphs.items():
             if gg.flags & G_INLINE: del self.glyphs[name]
 
-    def write_ttx(self, fp):
-        SCALE = 16
+    def share_pixels(self):
+        # returns a dict of (glyph name, subglyph index): (glyph name, subglyph index) for
+        # pixel subglyphs that can be written as a component of another identical one.
+        # only the sole subglyph of a simple glyph and pixel subglyphs of hybrid glyphs
+        # (written as `name#i`) are shared; the former is preferred as the shared one,
+        # since it avoids an additional glyph. empty subglyphs are never shared.
+        occurrences = {} # key: [(whether hybrid, glyph name, subglyph index), ...]
+        for name, gg in self.glyphs.items():
+            compositecount = sum(isinstance(g.data, basestring) for g in gg.subglyphs)
+            if compositecount == 0 and len(gg.subglyphs) != 1: continue
+            for i, g in enumerate(gg.subglyphs):
+                if not isinstance(g.data, Pixels): continue
+                # the full pixels are also kept for embedded bitmaps
+                key = ContourCache.make_key(g.height, g.width, g.stride, g.data,
+                                            PX_SUBPIXEL | PX_FULL)
+                if not key[3].strip('\0'): continue
+                occurrences.setdefault(key, []).append((compositecount > 0, name, i))
+        shared = {}
+        for occurs in occurrences.values():
+            if len(occurs) < 2: continue
+            occurs.sort()
+            _, sharedname, sharedindex = occurs[0]
+            for _, name, i in occurs[1:]:
+                shared[name, i] = sharedname, sharedindex
+        return shared
+
+    def layout(self, pool=None, contour_cache=None, reused=(), web=False, strikes=()):
+        # contour tracing is the most expensive part, so we start it as early as possible.
+        # every pixel subglyph is traced at most once in the order of the glyf table below;
+        # with the pool, chunks of them are traced in parallel while other tables are written.
+        # glyphs in `reused` are not traced, as the caller has their outputs elsewhere.
+        # `web` changes the glyph order for the better compression (see below).
+        # `strikes` is a list of scales (multiples of the pixel size) for embedded bitmaps.
+        # pixel subglyphs identical to others (see `share_pixels`) become components instead.
+        shared = self.share_pixels()
+        tracings = [(g.height, g.width, g.stride, g.data)
+                    for name, gg in sorted(self.glyphs.items()) if name not in reused
+                    for i, g in enumerate(gg.subglyphs)
+                    if isinstance(g.data, Pixels) and (name, i) not in shared]
+
+        # identical pixel subglyphs (or those traced by previous builds) are traced only once.
+        if contour_cache is None: contour_cache = ContourCache()
+        keys = [ContourCache.make_key(height, width, stride, data, PX_SUBPIXEL)
+                for height, width, stride, data in tracings]
+        pending = OrderedDict() # key: tracing
+        for key in keys:
+            if key in pending:
+                contour_cache.hits += 1
+            elif contour_cache.get(key) is None:
+                # pickling a view would send the whole arena to workers, so use the key instead
+                height, width, _, pixels = key
+                pending[key] = height, width, width, bytearray(pixels)
+        tracings = pending.values()
+
+        worker_times = {} # pid: (number of traced subglyphs, seconds)
+        if pool:
+            results = pool.imap(trace_contours,
+                                [tracings[i:i+TRACE_CHUNK_SIZE]
+                                 for i in xrange(0, len(tracings), TRACE_CHUNK_SIZE)])
+            def collect_contours():
+                for pid, elapsed, contours in results:
+                    count, total = worker_times.get(pid, (0, 0))
+                    worker_times[pid] = count + len(contours), total + elapsed
+                    for paths in contours: yield paths
+            new_contours = collect_contours()
+        elif PROFILE is not None:
+            new_contours = PROFILE.trace(pending)
+        else:
+            new_contours = (track_contour(height, width, stride, data, PX_SUBPIXEL)
+                            for height, width, stride, data in tracings)
+
+        def get_traced_contours():
+            pending_keys = iter(pending)
+            for key in keys:
+                while key not in contour_cache.entries:
+                    contour_cache.put(next(pending_keys), next(new_contours))
+                yield contour_cache.entries[key]
+        traced_contours = get_traced_contours()
 
         def get_subname(name):
             if isinstance(name, int):
@@ -1385,18 +2843,31 @@ class Font(object):
             else:
                 return name
 
+        def get_shared(name, i):
+            # returns (subname, top, left, y) for the shared pixel subglyph of given subglyph,
+            # where top and left are in the frame of the subname and y is from its baseline
+            sharedname, sharedindex = shared[name, i]
+            gg = self.glyphs[sharedname]
+            if any(isinstance(g.data, basestring) for g in gg.subglyphs):
+                return '%s#%d' % (get_subname(sharedname), sharedindex), 0, 0, 0
+            g = gg.subglyphs[sharedindex]
+            return get_subname(sharedname), g.top, g.left, gg.height - (g.top + g.height)
+
         # left-side bearing cannot be easily calculated without a recursion
         lsbs = {}
         def get_lsb_from_pixels(height, width, stride, data):
-            return min(c + LEFTMOST[data[r*stride+c] & PX_SUBPIXEL] if data[r*stride+c] else width
-                       for r in xrange(height) for c in xrange(width))
+            arena = data.arena
+            base = data.offset
+            return min(c + LEFTMOST[arena[i] & PX_SUBPIXEL] if arena[i] else width
+                       for r in xrange(height) for c in xrange(width)
+                       for i in (base + r*stride + c,))
         def get_lsb(name):
             try: return lsbs[name]
             except KeyError:
                 gg = self.glyphs[name]
                 lsb = gg.width
                 for g in gg.subglyphs:
-                    if isinstance(g.data, list):
+                    if isinstance(g.data, Pixels):
                         glsb = get_lsb_from_pixels(g.height, g.width, g.stride, g.data)
                     else:
                         glsb = get_lsb(g.data)
@@ -1429,13 +2900,31 @@ class Font(object):
             if 0 < compositecount < len(gg.subglyphs):
                 # add intermediate subglyphs when required
                 for i, g in enumerate(gg.subglyphs):
-                    if not isinstance(g.data, list): continue
+                    if not isinstance(g.data, Pixels) or (name, i) in shared: continue
                     subnames.append(('%s#%d' % (name, i), g.width,
                                      get_lsb_from_pixels(g.height, g.width, g.stride, g.data)))
             subnames.append((name, gg.width, get_lsb(name)))
             glyphids[name] = len(glyphids)
         assert hasnotdef, '.notdef glyph is undefined, will cause a bad effect including ' \
                           'a missing glyph for the first character (generally U+0020)'
+        # .notdef should be the first glyph (sort is stable)
+        subnames.sort(key=lambda (subname, _width, _lsb): subname != '.notdef')
+        if web:
+            # simple glyphs then composite glyphs, each ordered by the advance width,
+            # so that similar glyf entries and runs of the same hmtx entries are close
+            # (about 1% smaller WOFF for the full font). browsers are not affected by
+            # the Uniscribe bug above, and the order is otherwise kept as the sort is stable.
+            def is_composite(subname):
+                gg = self.glyphs.get(subname)
+                return gg is not None and any(isinstance(g.data, basestring) for g in gg.subglyphs)
+            subnames.sort(key=lambda (subname, width, _lsb): (subname != '.notdef',
+                                                             is_composite(subname), width))
+        glyphorder = [subname for subname, _, _ in subnames]
+
+        metrics = []
+        for subname, subwidth, sublsb in subnames:
+            if sublsb >= subwidth: sublsb = 0 # special casing for spaces
+            metrics.append((subname, int(subwidth*SCALE), int(sublsb*SCALE)))
 
         # Windows and OS X has a different idea about the typographic metrics
         # https://people.gnome.org/~fejj/code/lineheight.c
@@ -1444,6 +2933,324 @@ class Font(object):
         descent = int(self.descent * SCALE)
         linegap = int((self.height - self.ascent - self.descent) * SCALE)
 
+        def flush_contour(g, dx, dy):
+            assert isinstance(g.data, Pixels)
+            return [[(int(SCALE * (dx + x)), int(SCALE * (dy + (g.height - y))))
+                     for x, y in contour]
+                    for contour in next(traced_contours)]
+        def get_outlines():
+            for name, gg in sorted(self.glyphs.items()):
+                if name in reused:
+                    yield get_subname(name), None, None
+                    continue
+                sharing = dict((i, get_shared(name, i)) for i in xrange(len(gg.subglyphs))
+                               if (name, i) in shared)
+                name = get_subname(name)
+
+                compositecount = sum(isinstance(g.data, basestring) for g in gg.subglyphs)
+                hybrid = (0 < compositecount < len(gg.subglyphs))
+                if hybrid:
+                    for i, g in enumerate(gg.subglyphs):
+                        if not isinstance(g.data, Pixels) or i in sharing: continue
+                        yield '%s#%d' % (name, i), flush_contour(g, 0, 0), []
+
+                contours = []
+                components = []
+                for i, g in enumerate(gg.subglyphs):
+                    if isinstance(g.data, Pixels):
+                        subname = '%s#%d' % (name, i)
+                        subheight = g.height
+                    else:
+                        subname = get_subname(g.data)
+                        subheight = self.glyphs[g.data].height # NOT g.height, which can be wrong
+                    x = g.left
+                    y = gg.height - (g.top + subheight)
+                    if i in sharing:
+                        subname, _, sharedx, sharedy = sharing[i]
+                        components.append((subname, int((x - sharedx)*SCALE),
+                                           int((y - sharedy)*SCALE)))
+                    elif not hybrid and isinstance(g.data, Pixels):
+                        contours.extend(flush_contour(g, x, y))
+                    else:
+                        components.append((subname, int(x*SCALE), int(y*SCALE)))
+                if compositecount == 0 and len(gg.subglyphs) > 1:
+                    contours = optimize_contours(contours)
+                yield name, contours, components
+
+        # OpenType features
+        lookups = []
+        settolookup = {}
+        chainedlookups = {} # substitutions: index to lookups, shared by identical ones
+        for setname, remaps in self.remaps.items():
+            # determine the most compact format for given remaps
+            if all(len(r.pattern) == 1 and len(r.replacement) == 1 and
+                   len(r.lookbehind) == 0 and len(r.lookahead) == 0 for r in remaps):
+                # single substitution: a -> b
+                substs = []
+                for r in remaps:
+                    pattern, = r.pattern
+                    replacement, = r.replacement
+                    if not isinstance(pattern, list): pattern = [pattern]
+                    if not isinstance(replacement, list): replacement = [replacement]
+                    substs.extend(zip(pattern, itertools.cycle(replacement)))
+                lookup = LOOKUP_SINGLE, substs
+
+            elif all(len(r.pattern) > 1 and len(r.replacement) == 1 and
+                     len(r.lookbehind) == 0 and len(r.lookahead) == 0 for r in remaps):
+                # ligature substitution: a1 a2 a3 -> b
+                starts = {}
+                for r in remaps:
+                    patterns = r.pattern
+                    replacement, = r.replacement
+                    patterns = list(itertools.product(*[x if isinstance(x, list) else [x]
+                                                        for x in patterns]))
+                    if not isinstance(replacement, list): replacement = [replacement]
+                    if all(len(pat) == 1 for pat in patterns):
+                        assert len(replacement) == 1
+                        patterns = [pat for pat, in patterns]
+                        starts.setdefault(pat[0], []).append((pat[1:], replacement[0]))
+                    else:
+                        if len(replacement) == 1:
+                            replacement = itertools.repeat(replacement[0], len(patterns))
+                        else:
+                            assert len(replacement) == len(patterns)
+                        for pat, rep in zip(patterns, replacement):
+                            starts.setdefault(pat[0], []).append((pat[1:], rep))
+                ligatures = []
+                for start, ligs in starts.items():
+                    ligs.sort(key=lambda (k,v): (-len(k), k, v))
+                    ligatures.append((start, ligs))
+                lookup = LOOKUP_LIGATURE, ligatures
+
+            elif all(len(r.pattern) == 1 and len(r.replacement) == 1 for r in remaps):
+                # chaining contextual substitution: lb1 lb2 : a -> b : la1 la2
+                # unlike single/ligature substs, we keep each `r` in `remaps`.
+                def coverage(glyphs):
+                    if not isinstance(glyphs, list): glyphs = [glyphs]
+                    return sorted(glyphs, key=lambda name: glyphids[name])
+                rules = []
+                for i, r in enumerate(remaps):
+                    # we need a separate lookup to be run when the context matches
+                    pats, = r.pattern
+                    reps, = r.replacement
+                    if not isinstance(pats, list): pats = [pats]
+                    if not isinstance(reps, list): reps = [reps]
+                    if len(pats) > len(reps):
+                        assert len(pats) % len(reps) == 0
+                        reps *= len(pats) // len(reps)
+                    substs = zip(pats, reps)
+                    key = tuple(sorted(set(substs)))
+                    if key in chainedlookups:
+                        chainedlookup = chainedlookups[key]
+                        chainedsetname = lookups[chainedlookup][0]
+                    else:
+                        chainedlookup = chainedlookups[key] = len(lookups)
+                        chainedsetname = '%s#%d' % (setname, i)
+                        lookups.append((chainedsetname, LOOKUP_SINGLE, substs))
+                    rules.append(ChainRule(backtrack=map(coverage, reversed(r.lookbehind)),
+                                           input=map(coverage, r.pattern),
+                                           lookahead=map(coverage, r.lookahead),
+                                           lookup=chainedlookup, setname=chainedsetname))
+                lookup = LOOKUP_CHAIN, rules
+
+            else:
+                assert False, 'not yet supported remapping set format'
+
+            settolookup[setname] = len(lookups)
+            lookups.append((setname,) + lookup)
+
+        features = [(featurename, [(settolookup[setname], setname) for setname in sets])
+                    for featurename, sets in self.features.items()]
+
+        # embedded bitmaps are made of full pixels in the same way as `print_fullpixel_image`
+        # in src/sample.rs: pixels are set in order, and negated subglyphs clear them instead.
+        # glyphs with components (as in glyf) become composite bitmaps, unless anything in them
+        # is negated or components don't fit in the strike.
+        sources = {} # subname: (height, width, subglyphs, components or None)
+        negations = {} # name: whether the glyph has any negated subglyph
+        def has_negation(name):
+            try: return negations[name]
+            except KeyError: pass
+            negations[name] = negated = any(g.negated or (not isinstance(g.data, Pixels) and
+                                                          has_negation(g.data))
+                                            for g in self.glyphs[name].subglyphs)
+            return negated
+        if strikes:
+            for name, gg in self.glyphs.items():
+                subname = get_subname(name)
+                components = None
+                if any(isinstance(g.data, basestring) for g in gg.subglyphs):
+                    components = []
+                    for i, g in enumerate(gg.subglyphs):
+                        if (name, i) in shared:
+                            piece, sharedtop, sharedleft, _ = get_shared(name, i)
+                            components.append((piece, g.top - sharedtop, g.left - sharedleft))
+                        elif isinstance(g.data, Pixels):
+                            piece = '%s#%d' % (subname, i)
+                            sources[piece] = (g.height, g.width,
+                                              [g._replace(top=0, left=0, negated=0)], None)
+                            components.append((piece, g.top, g.left))
+                        else:
+                            components.append((get_subname(g.data), g.top, g.left))
+                    if has_negation(name): components = None
+                sources[subname] = gg.height, gg.width, gg.subglyphs, components
+
+        def paint_full_pixels(pixels, subglyphs, top, left, negated):
+            for g in subglyphs:
+                if isinstance(g.data, Pixels):
+                    update = pixels.discard if (negated + g.negated) & 1 else pixels.add
+                    for r in xrange(g.height):
+                        row = g.data[r*g.stride:r*g.stride+g.width]
+                        for c in xrange(g.width):
+                            if row[c] & PX_FULL: update((top + g.top + r, left + g.left + c))
+                else:
+                    paint_full_pixels(pixels, self.glyphs[g.data].subglyphs,
+                                      top + g.top, left + g.left, negated + g.negated)
+
+        images = {} # subname: (top, left, rows of '0' and '1') in the glyph frame, at 1x
+        def get_image(subname):
+            try: return images[subname]
+            except KeyError: pass
+            pixels = set()
+            paint_full_pixels(pixels, sources[subname][2], 0, 0, 0)
+            if pixels:
+                rows = [r for r, _ in pixels]
+                cols = [c for _, c in pixels]
+                top = min(rows)
+                left = min(cols)
+                image = top, left, [''.join('1' if (r, c) in pixels else '0'
+                                            for c in xrange(left, max(cols) + 1))
+                                    for r in xrange(top, max(rows) + 1)]
+            else:
+                image = 0, 0, []
+            images[subname] = image
+            return image
+
+        boxes = {} # subname: (top, left, height, width) of the image at 1x
+        def get_box(subname):
+            try: return boxes[subname]
+            except KeyError: pass
+            components = sources[subname][3]
+            if components is None:
+                top, left, rows = get_image(subname)
+                box = top, left, len(rows), len(rows[0]) if rows else 0
+            else:
+                # without negated subglyphs, this is same to the box of the flattened image
+                bottom = right = top = left = None
+                for piece, ptop, pleft in components:
+                    btop, bleft, bheight, bwidth = get_box(piece)
+                    if not bheight: continue
+                    btop += ptop
+                    bleft += pleft
+                    if top is None:
+                        top, left, bottom, right = btop, bleft, btop + bheight, bleft + bwidth
+                    else:
+                        top = min(top, btop)
+                        left = min(left, bleft)
+                        bottom = max(bottom, btop + bheight)
+                        right = max(right, bleft + bwidth)
+                box = (top, left, bottom - top, right - left) if top is not None else (0, 0, 0, 0)
+            boxes[subname] = box
+            return box
+
+        bitmaps = {} # (subname, scale): BitmapGlyph or None
+        def get_bitmap(subname, scale):
+            try: return bitmaps[subname, scale]
+            except KeyError: pass
+            height, width, _, components = sources[subname]
+            top, left, bheight, bwidth = get_box(subname)
+            if bheight:
+                bigmetrics = (bheight * scale, bwidth * scale, left * scale,
+                              (height - top) * scale, width * scale,
+                              -(bwidth * scale // 2), 0, height * scale)
+            else:
+                bigmetrics = 0, 0, 0, 0, width * scale, 0, 0, height * scale
+            bitmap = None
+            if all(0 <= v <= 255 for v in bigmetrics[0:2] + bigmetrics[4:8:3]) and \
+               all(-128 <= v <= 127 for v in bigmetrics[2:4] + bigmetrics[5:7]):
+                if components is not None:
+                    placed = []
+                    for piece, ptop, pleft in components:
+                        btop, bleft, bheight, _ = get_box(piece)
+                        if not bheight: continue
+                        dx = (pleft + bleft - left) * scale
+                        dy = (ptop + btop - top) * scale
+                        if get_bitmap(piece, scale) is None or \
+                           not (-128 <= dx <= 127 and -128 <= dy <= 127):
+                            placed = None
+                            break
+                        placed.append((piece, dx, dy))
+                    if placed:
+                        bitmap = BitmapGlyph(*bigmetrics, bits=None, components=placed)
+                if bitmap is None:
+                    _, _, rows = get_image(subname)
+                    bits = ''.join(row.replace('0', '0' * scale).replace('1', '1' * scale) * scale
+                                   for row in rows)
+                    bitmap = BitmapGlyph(*bigmetrics, bits=bits, components=None)
+            bitmaps[subname, scale] = bitmap
+            return bitmap
+
+        return FontLayout(emsize=emsize, ascent=ascent, descent=descent, linegap=linegap,
+                          glyphorder=glyphorder, metrics=metrics, outlines=get_outlines(),
+                          lookups=lookups, features=features, worker_times=worker_times,
+                          strikes=[(scale, [get_bitmap(subname, scale) for subname in glyphorder])
+                                   for scale in strikes])
+
+    def outline_stats(self, contour_cache=None):
+        # returns (a dict of glyph name: (contours, points), contours and points removed by
+        # merging contours in `layout`) for outlines in the font, where composite glyphs count
+        # their components as rasterizers do. should be called after the font is written
+        # with `contour_cache`, so that nothing is traced again.
+        if contour_cache is None: contour_cache = ContourCache()
+        outlines = {}
+        for name, contours, components in self.layout(contour_cache=contour_cache).outlines:
+            outlines[name] = contours, components
+
+        stats = {}
+        def get_stats(name):
+            try: return stats[name]
+            except KeyError: pass
+            contours, components = outlines[name]
+            ncontours = len(contours)
+            npoints = sum(len(contour) for contour in contours)
+            for subname, _, _ in components:
+                subcontours, subpoints = get_stats(subname)
+                ncontours += subcontours
+                npoints += subpoints
+            stats[name] = ncontours, npoints
+            return ncontours, npoints
+        for name in outlines: get_stats(name)
+
+        merged_contours = merged_points = 0
+        for name, gg in self.glyphs.items():
+            if len(gg.subglyphs) < 2 or not all(isinstance(g.data, Pixels) for g in gg.subglyphs):
+                continue
+            for g in gg.subglyphs:
+                key = ContourCache.make_key(g.height, g.width, g.stride, g.data, PX_SUBPIXEL)
+                paths = contour_cache.entries.get(key, [])
+                merged_contours += len(paths)
+                merged_points += sum(len(path) for path in paths)
+            contours, _ = outlines['uni%04X' % name if isinstance(name, int) else name]
+            merged_contours -= len(contours)
+            merged_points -= sum(len(contour) for contour in contours)
+        return stats, merged_contours, merged_points
+
+    def write_ttx(self, fp, pool=None, contour_cache=None, manifest=None, strikes=()):
+        # with the manifest, glyf entries for unchanged glyphs are copied from the previous build
+        reused = set()
+        if manifest:
+            fragments = {}
+            for name in self.glyphs:
+                fragment = manifest.get('ttx', name)
+                if fragment is not None:
+                    fragments[name] = fragment
+                    reused.add(name)
+        layout = self.layout(pool, contour_cache, reused, strikes=strikes)
+        emsize = layout.emsize
+        ascent = layout.ascent
+        descent = layout.descent
+        linegap = layout.linegap
+
         # let's start over
         # (the order of the following sections should not be changed, OS X complains a lot)
         print >>fp, '<?xml version="1.0" encoding="UTF-8"?>'
@@ -1451,9 +3258,7 @@ class Font(object):
 
         # internal glyph order (seems to have to be the first tag!)
         print >>fp, '<GlyphOrder>'
-        print >>fp, '<GlyphID name=".notdef"/>'
-        for subname, _, _ in subnames:
-            if subname == '.notdef': continue
+        for subname in layout.glyphorder:
             print >>fp, '<GlyphID name="{name}"/>'.format(name=subname)
         print >>fp, '</GlyphOrder>'
 
@@ -1575,10 +3380,9 @@ class Font(object):
 
         # hmtx
         print >>fp, '<hmtx>'
-        for subname, subwidth, sublsb in subnames:
-            if sublsb >= subwidth: sublsb = 0 # special casing for spaces
+        for subname, subwidth, sublsb in layout.metrics:
             print >>fp, '<mtx name="{name}" width="{width}" lsb="{lsb}"/>'.format(
-                    name=subname, width=int(subwidth*SCALE), lsb=int(sublsb*SCALE))
+                    name=subname, width=subwidth, lsb=sublsb)
         print >>fp, '</hmtx>'
 
         # cmap
@@ -1607,109 +3411,53 @@ class Font(object):
         # loca
         print >>fp, '<loca/>'
 
-        # fpgm
+        # fpgm, prep, cvt
+        def print_bytecode(code):
+            print >>fp, '<bytecode>'
+            for i in xrange(0, len(code), 16):
+                print >>fp, ' '.join(code[j:j+4].encode('hex') for j in xrange(i, i+16, 4))
+            print >>fp, '</bytecode>'
         print >>fp, '<fpgm>'
-        #print >>fp, '<bytecode></bytecode>'
-        print >>fp,'''<bytecode>
-      40120807 06050403 021b1a19 18171615
-      141e1f20 2c18b003 3f2d2c18 b0023f2d
-      2c18b001 3f2d2cb0 004358b1 0000451e
-      1f1bb000 1e592d2c b0004358 b1000045
-      1e1f1bb0 001e592d 2cb00043 58b10000
-      451e1f1b b0001e59 2d2cb000 4358b100
-      00451e1f 1bb0001e 592d2cb0 004358b1
-      0000451e 1f1bb000 1e592d2c b0004358
-      b1000045 1e1f1bb0 001e592d 2cb00043
-      58b10000 451e1f1b b0001e59 2d2cb000
-      4358b100 00451e1f 1bb0001e 592d2c18
-      2fdd2d2c 182f3cdd 2d2c182f 173cdd2d
-      2c182fdd 3c2d2c18 2fdd173c 2d2c182f
-      3cdd3c2d 2c182f17 3cdd173c 2d
-      </bytecode>'''
+        print_bytecode(FPGM)
         print >>fp, '</fpgm>'
-
-        # prep
         print >>fp, '<prep>'
-        #print >>fp, '<bytecode></bytecode>'
-        print >>fp, '''<bytecode>
-      4bb01050 58ba01d0 00040000 8d8d851b
-      b901d000 008d8559 b20010aa 4b524b50
-      5a42   
-    </bytecode>'''
+        print_bytecode(PREP)
         print >>fp, '</prep>'
-
-        # cvt
         print >>fp, '<cvt>'
-        #print >>fp, '<cv index="0" value="0"/>' # dummy
-        print >>fp, '''
-    <cv index="0" value="8"/>
-    <cv index="1" value="-9999"/>
-    <cv index="2" value="-9999"/>
-    <cv index="3" value="-9999"/>
-    <cv index="4" value="20"/>
-    <cv index="5" value="380"/>
-    '''
+        for i, value in enumerate(CVT):
+            print >>fp, '<cv index="{index}" value="{value}"/>'.format(index=i, value=value)
         print >>fp, '</cvt>'
 
         # glyf
         print >>fp, '<glyf>'
-        def flush_contour(fp, g, dx, dy):
-            assert isinstance(g.data, list)
-            for contour in track_contour(g.height, g.width, g.stride, g.data, PX_SUBPIXEL):
-                print >>fp, '<contour>'
+        glyffp = StringIO() if manifest else fp
+        for name, contours, components in layout.outlines:
+            if contours is None:
+                fp.write(fragments[name])
+                continue
+            print >>glyffp, '<TTGlyph name="{name}">'.format(name=name)
+            for contour in contours:
+                print >>glyffp, '<contour>'
                 for x, y in contour:
-                    x = int(SCALE * (dx + x))
-                    y = int(SCALE * (dy + (g.height - y)))
-                    print >>fp, '<pt x="{x}" y="{y}" on="1"/>'.format(x=x, y=y)
-                print >>fp, '</contour>'
-        for name, gg in sorted(self.glyphs.items()):
-            name = get_subname(name)
-
-            compositecount = sum(isinstance(g.data, basestring) for g in gg.subglyphs)
-            hybrid = (0 < compositecount < len(gg.subglyphs))
-            if hybrid:
-                for i, g in enumerate(gg.subglyphs):
-                    if not isinstance(g.data, list): continue
-                    subname = '%s#%d' % (name, i)
-                    print >>fp, '<TTGlyph name="{subname}">'.format(subname=subname)
-                    flush_contour(fp, g, 0, 0)
-                    print >>fp, '<instructions><bytecode></bytecode></instructions>'
-                    print >>fp, '</TTGlyph>'
-
-            print >>fp, '<TTGlyph name="{name}">'.format(name=name)
-            for i, g in enumerate(gg.subglyphs):
-                if isinstance(g.data, list):
-                    subname = '%s#%d' % (name, i)
-                    subheight = g.height
-                else:
-                    subname = get_subname(g.data)
-                    subheight = self.glyphs[g.data].height # NOT g.height, which can be wrong
-                x = g.left
-                y = gg.height - (g.top + subheight)
-                if not hybrid and isinstance(g.data, list):
-                    flush_contour(fp, g, x, y)
-                else:
-                    print >>fp, '<component glyphName="{subname}" x="{x}" y="{y}" ' \
-                                 'flags="0x1004"/>'.format(subname=subname,
-                                                           x=int(x*SCALE), y=int(y*SCALE))
-            print >>fp, '<instructions><bytecode></bytecode></instructions>'
-            print >>fp, '</TTGlyph>'
+                    print >>glyffp, '<pt x="{x}" y="{y}" on="1"/>'.format(x=x, y=y)
+                print >>glyffp, '</contour>'
+            for subname, x, y in components:
+                print >>glyffp, '<component glyphName="{subname}" x="{x}" y="{y}" ' \
+                                 'flags="0x1004"/>'.format(subname=subname, x=x, y=y)
+            print >>glyffp, '<instructions><bytecode></bytecode></instructions>'
+            print >>glyffp, '</TTGlyph>'
+            # intermediate entries for hybrid glyphs (`name#i`) precede the glyph's own entry
+            if manifest and '#' not in name:
+                fragment = glyffp.getvalue()
+                manifest.put('ttx', name, fragment)
+                fp.write(fragment)
+                glyffp = StringIO()
         print >>fp, '</glyf>'
 
         # name
         print >>fp, '<name>'
-        names = [
-            (0, 'copyright', u'Made by Kang Seonghoon; released in the public domain.'),
-            (1, 'family', u'Unison'),
-            (2, 'subfamily', u'Regular'),
-            (3, 'identifier', u'Unison'),
-            (4, 'fontname', u'Unison'),
-            (5, 'version', u'Version 0.1'),
-            (6, 'psname', u'Unison'),
-            (13, 'license', u'Public Domain. Or alternatively, CC0 1.0 Universal.'),
-        ]
-        for platid, platenc, langid in ((1, 0, 0), (3, 1, 0x409)):
-            for nameid, _, nameval in names:
+        for platid, platenc, langid in NAME_PLATFORMS:
+            for nameid, _, nameval in NAMES:
                 print >>fp, '<namerecord nameID="{id}" platformID="{platid}" ' \
                              'platEncID="{platenc}" langID="{langid}" ' \
                              'unicode="True">{val}</namerecord>'.format(
@@ -1733,117 +3481,6 @@ class Font(object):
         print >>fp, '<extraNames/>'
         print >>fp, '</post>'
 
-        # OpenType features
-        lookups = []
-        settolookup = {}
-        for setname, remaps in self.remaps.items():
-            lines = []
-
-            # determine the most compact format for given remaps
-            if all(len(r.pattern) == 1 and len(r.replacement) == 1 and
-                   len(r.lookbehind) == 0 and len(r.lookahead) == 0 for r in remaps):
-                # single substitution: a -> b
-                lines.append('<LookupFlag value="0"/>')
-                lines.append('<SingleSubst index="0">')
-                for r in remaps:
-                    pattern, = r.pattern
-                    replacement, = r.replacement
-                    if not isinstance(pattern, list): pattern = [pattern]
-                    if not isinstance(replacement, list): replacement = [replacement]
-                    for pat, rep in zip(pattern, itertools.cycle(replacement)):
-                        lines.append('<Substitution in="{pat}" out="{rep}"/>'.format(pat=pat,
-                                                                                     rep=rep))
-                lines.append('</SingleSubst>')
-
-            elif all(len(r.pattern) > 1 and len(r.replacement) == 1 and
-                     len(r.lookbehind) == 0 and len(r.lookahead) == 0 for r in remaps):
-                # ligature substitution: a1 a2 a3 -> b
-                starts = {}
-                for r in remaps:
-                    patterns = r.pattern
-                    replacement, = r.replacement
-                    patterns = list(itertools.product(*[x if isinstance(x, list) else [x]
-                                                        for x in patterns]))
-                    if not isinstance(replacement, list): replacement = [replacement]
-                    if all(len(pat) == 1 for pat in patterns):
-                        assert len(replacement) == 1
-                        patterns = [pat for pat, in patterns]
-                        starts.setdefault(pat[0], []).append((pat[1:], replacement[0]))
-                    else:
-                        if len(replacement) == 1:
-                            replacement = itertools.repeat(replacement[0], len(patterns))
-                        else:
-                            assert len(replacement) == len(patterns)
-                        for pat, rep in zip(patterns, replacement):
-                            starts.setdefault(pat[0], []).append((pat[1:], rep))
-                lines.append('<LookupFlag value="0"/>')
-                lines.append('<LigatureSubst index="0">')
-                for start, ligatures in starts.items():
-                    ligatures.sort(key=lambda (k,v): (-len(k), k, v))
-                    lines.append('<LigatureSet glyph="{start}">'.format(start=start))
-                    for remainder, mapped in ligatures:
-                        lines.append('<Ligature components="{remainder}" glyph="{mapped}"/>'.format(
-                            remainder=','.join(remainder), mapped=mapped))
-                    lines.append('</LigatureSet>')
-                lines.append('</LigatureSubst>')
-
-            elif all(len(r.pattern) == 1 and len(r.replacement) == 1 for r in remaps):
-                # chaining contextual substitution: lb1 lb2 : a -> b : la1 la2
-                # unlike single/ligature substs, we keep each `r` in `remaps`.
-                lines = []
-                lines.append('<LookupFlag value="0"/>')
-                for i, r in enumerate(remaps):
-                    # we need a separate lookup to be run when the context matches
-                    chainedlines = []
-                    chainedlines.append('<LookupFlag value="0"/>')
-                    chainedlines.append('<SingleSubst index="0">')
-                    pats, = r.pattern
-                    reps, = r.replacement
-                    if not isinstance(pats, list): pats = [pats]
-                    if not isinstance(reps, list): reps = [reps]
-                    if len(pats) > len(reps):
-                        assert len(pats) % len(reps) == 0
-                        reps *= len(pats) // len(reps)
-                    for pat, rep in zip(pats, reps):
-                        chainedlines.append('<Substitution in="{pat}" '
-                                                          'out="{rep}"/>'.format(pat=pat, rep=rep))
-                    chainedlines.append('</SingleSubst>')
-                    chainedlookup = len(lookups)
-                    chainedsetname = '%s#%d' % (setname, i)
-                    lookups.append((chainedsetname, chainedlines))
-
-                    lines.append('<ChainContextSubst index="{index}" Format="3">'.format(index=i))
-                    for j, glyphs in enumerate(reversed(r.lookbehind)):
-                        if not isinstance(glyphs, list): glyphs = [glyphs]
-                        lines.append('<BacktrackCoverage index="{index}">'.format(index=j))
-                        for glyph in sorted(glyphs, key=lambda name: glyphids[name]):
-                            lines.append('<Glyph value="{glyph}"/>'.format(glyph=glyph))
-                        lines.append('</BacktrackCoverage>')
-                    for j, glyphs in enumerate(r.pattern):
-                        if not isinstance(glyphs, list): glyphs = [glyphs]
-                        lines.append('<InputCoverage index="{index}">'.format(index=j))
-                        for glyph in sorted(glyphs, key=lambda name: glyphids[name]):
-                            lines.append('<Glyph value="{glyph}"/>'.format(glyph=glyph))
-                        lines.append('</InputCoverage>')
-                    for j, glyphs in enumerate(r.lookahead):
-                        if not isinstance(glyphs, list): glyphs = [glyphs]
-                        lines.append('<LookAheadCoverage index="{index}">'.format(index=j))
-                        for glyph in sorted(glyphs, key=lambda name: glyphids[name]):
-                            lines.append('<Glyph value="{glyph}"/>'.format(glyph=glyph))
-                        lines.append('</LookAheadCoverage>')
-                    lines.append('<SubstLookupRecord index="0">')
-                    lines.append('<SequenceIndex value="0"/>')
-                    lines.append('<LookupListIndex value="{lookup}"/><!-- {set} -->'.format(
-                                    lookup=chainedlookup, set=chainedsetname))
-                    lines.append('</SubstLookupRecord>')
-                    lines.append('</ChainContextSubst>')
-
-            else:
-                assert False, 'not yet supported remapping set format'
-
-            settolookup[setname] = len(lookups)
-            lookups.append((setname, lines))
-
         # GDEF
         print >>fp, '<GDEF>'
         print >>fp, '<Version value="1.0"/>'
@@ -1858,66 +3495,1139 @@ class Font(object):
         print >>fp, '<Script>'
         print >>fp, '<DefaultLangSys>'
         print >>fp, '<ReqFeatureIndex value="65535"/>'
-        features = []
-        for featurename, sets in self.features.items():
+        for i in xrange(len(layout.features)):
             print >>fp, '<FeatureIndex index="{index}" value="{feature}"/>'.format(
-                    index=len(features), feature=len(features))
-            features.append(featurename)
+                    index=i, feature=i)
         print >>fp, '</DefaultLangSys>'
         print >>fp, '</Script>'
         print >>fp, '</ScriptRecord>'
         print >>fp, '</ScriptList>'
         print >>fp, '<FeatureList>'
-        for i, featurename in enumerate(features):
-            setnames = self.features[featurename]
+        for i, (featurename, setlookups) in enumerate(layout.features):
             print >>fp, '<FeatureRecord index="{index}">'.format(index=i)
             print >>fp, '<FeatureTag value="{tag}"/>'.format(tag=featurename)
             print >>fp, '<Feature>'
-            for j, setname in enumerate(setnames):
+            for j, (lookup, setname) in enumerate(setlookups):
                 print >>fp, '<LookupListIndex index="{index}" value="{lookup}"/><!-- {set} -->'.format(
-                        index=j, lookup=settolookup[setname], set=setname)
+                        index=j, lookup=lookup, set=setname)
             print >>fp, '</Feature>'
             print >>fp, '</FeatureRecord>'
         print >>fp, '</FeatureList>'
         print >>fp, '<LookupList>'
-        for i, (setname, lines) in enumerate(lookups):
+        def print_coverage(tag, index, glyphs):
+            print >>fp, '<{tag} index="{index}">'.format(tag=tag, index=index)
+            for glyph in glyphs:
+                print >>fp, '<Glyph value="{glyph}"/>'.format(glyph=glyph)
+            print >>fp, '</{tag}>'.format(tag=tag)
+        def print_classdef(tag, classes):
+            print >>fp, '<{tag}>'.format(tag=tag)
+            for glyph, c in sorted(classes.items(), key=lambda (glyph, _): glyphids[glyph]):
+                print >>fp, '<ClassDef glyph="{glyph}" class="{c}"/>'.format(glyph=glyph, c=c)
+            print >>fp, '</{tag}>'.format(tag=tag)
+        def print_lookup_record(lookup):
+            print >>fp, '<SubstLookupRecord index="0">'
+            print >>fp, '<SequenceIndex value="0"/>'
+            print >>fp, '<LookupListIndex value="{lookup}"/><!-- {set} -->'.format(
+                            lookup=lookup, set=layout.lookups[lookup][0])
+            print >>fp, '</SubstLookupRecord>'
+        glyphids = dict((name, i) for i, name in enumerate(layout.glyphorder))
+        for i, (setname, lookuptype, data) in enumerate(layout.lookups):
             print >>fp, '<Lookup index="{index}"><!-- {set} -->'.format(index=i, set=setname)
-            for line in lines: print >>fp, line
+            print >>fp, '<LookupFlag value="0"/>'
+            if lookuptype == LOOKUP_SINGLE:
+                print >>fp, '<SingleSubst index="0">'
+                for pat, rep in data:
+                    print >>fp, '<Substitution in="{pat}" out="{rep}"/>'.format(pat=pat, rep=rep)
+                print >>fp, '</SingleSubst>'
+            elif lookuptype == LOOKUP_LIGATURE:
+                print >>fp, '<LigatureSubst index="0">'
+                for start, ligatures in data:
+                    print >>fp, '<LigatureSet glyph="{start}">'.format(start=start)
+                    for remainder, mapped in ligatures:
+                        print >>fp, '<Ligature components="{remainder}" ' \
+                                     'glyph="{mapped}"/>'.format(remainder=','.join(remainder),
+                                                                 mapped=mapped)
+                    print >>fp, '</LigatureSet>'
+                print >>fp, '</LigatureSubst>'
+            elif lookuptype == LOOKUP_CHAIN:
+                classes = chain_classes(data, glyphids)
+                if classes:
+                    print >>fp, '<ChainContextSubst index="0" Format="2">'
+                    print_coverage('Coverage', 0, classes.coverage)
+                    print_classdef('BacktrackClassDef', classes.backtrack)
+                    print_classdef('InputClassDef', classes.input)
+                    print_classdef('LookAheadClassDef', classes.lookahead)
+                    for j, rules in enumerate(classes.classsets):
+                        if not rules:
+                            print >>fp, '<ChainSubClassSet index="{index}" empty="1"/>'.format(
+                                            index=j)
+                            continue
+                        print >>fp, '<ChainSubClassSet index="{index}">'.format(index=j)
+                        for k, (back, rest, ahead, lookup) in enumerate(rules):
+                            print >>fp, '<ChainSubClassRule index="{index}">'.format(index=k)
+                            for tag, seq in (('Backtrack', back), ('Input', rest),
+                                             ('LookAhead', ahead)):
+                                for l, c in enumerate(seq):
+                                    print >>fp, '<{tag} index="{index}" value="{c}"/>'.format(
+                                                    tag=tag, index=l, c=c)
+                            print_lookup_record(lookup)
+                            print >>fp, '</ChainSubClassRule>'
+                        print >>fp, '</ChainSubClassSet>'
+                    print >>fp, '</ChainContextSubst>'
+                else:
+                    for j, rule in enumerate(data):
+                        print >>fp, '<ChainContextSubst index="{index}" Format="3">'.format(
+                                        index=j)
+                        for k, glyphs in enumerate(rule.backtrack):
+                            print_coverage('BacktrackCoverage', k, glyphs)
+                        for k, glyphs in enumerate(rule.input):
+                            print_coverage('InputCoverage', k, glyphs)
+                        for k, glyphs in enumerate(rule.lookahead):
+                            print_coverage('LookAheadCoverage', k, glyphs)
+                        print_lookup_record(rule.lookup)
+                        print >>fp, '</ChainContextSubst>'
             print >>fp, '</Lookup>'
         print >>fp, '</LookupList>'
         print >>fp, '</GSUB>'
 
+        # EBLC and EBDT (the index subtables and the sizes are recalculated)
+        if layout.strikes:
+            linemetricnames = ['ascender', 'descender', 'widthMax', 'caretSlopeNumerator',
+                               'caretSlopeDenominator', 'caretOffset', 'minOriginSB',
+                               'minAdvanceSB', 'maxBeforeBL', 'minAfterBL', 'pad1', 'pad2']
+            metricnames = ['height', 'width', 'horiBearingX', 'horiBearingY', 'horiAdvance',
+                           'vertBearingX', 'vertBearingY', 'vertAdvance']
+
+            print >>fp, '<EBLC>'
+            print >>fp, '<header version="2.0"/>'
+            for i, (scale, bitmaps) in enumerate(layout.strikes):
+                runs = bitmap_runs(bitmaps)
+                print >>fp, '<strike index="{index}">'.format(index=i)
+                print >>fp, '<bitmapSizeTable>'
+                linemetrics = sbit_line_metrics(bitmaps, ascent, descent, scale)
+                for direction in ('hori', 'vert'):
+                    print >>fp, '<sbitLineMetrics direction="{dir}">'.format(dir=direction)
+                    for name, value in zip(linemetricnames, linemetrics):
+                        print >>fp, '<{name} value="{value}"/>'.format(name=name, value=value)
+                    print >>fp, '</sbitLineMetrics>'
+                print >>fp, '<colorRef value="0"/>'
+                print >>fp, '<startGlyphIndex value="{gid}"/>'.format(gid=runs[0][0])
+                print >>fp, '<endGlyphIndex value="{gid}"/>'.format(gid=runs[-1][1])
+                print >>fp, '<ppemX value="{ppem}"/>'.format(ppem=emsize * scale // SCALE)
+                print >>fp, '<ppemY value="{ppem}"/>'.format(ppem=emsize * scale // SCALE)
+                print >>fp, '<bitDepth value="1"/>'
+                print >>fp, '<flags value="1"/>'
+                print >>fp, '</bitmapSizeTable>'
+                for first, last, imageformat in runs:
+                    print >>fp, ('<eblc_index_sub_table_3 imageFormat="{format}" '
+                                 'firstGlyphIndex="{first}" lastGlyphIndex="{last}">').format(
+                                    format=imageformat, first=first, last=last)
+                    for gid in xrange(first, last + 1):
+                        print >>fp, '<glyphLoc id="{gid}" name="{name}"/>'.format(
+                                        gid=gid, name=layout.glyphorder[gid])
+                    print >>fp, '</eblc_index_sub_table_3>'
+                print >>fp, '</strike>'
+            print >>fp, '</EBLC>'
+
+            print >>fp, '<EBDT>'
+            print >>fp, '<header version="2.0"/>'
+            for i, (scale, bitmaps) in enumerate(layout.strikes):
+                print >>fp, '<strikedata index="{index}">'.format(index=i)
+                for subname, bitmap in zip(layout.glyphorder, bitmaps):
+                    if bitmap is None: continue
+                    imageformat = 6 if bitmap.components is None else 9
+                    print >>fp, '<ebdt_bitmap_format_{format} name="{name}">'.format(
+                                    format=imageformat, name=subname)
+                    print >>fp, '<BigGlyphMetrics>'
+                    for name, value in zip(metricnames, bitmap):
+                        print >>fp, '<{name} value="{value}"/>'.format(name=name, value=value)
+                    print >>fp, '</BigGlyphMetrics>'
+                    if imageformat == 6:
+                        print >>fp, '<rawimagedata>{data}</rawimagedata>'.format(
+                                        data=bitmap_image(bitmap).encode('hex'))
+                    else:
+                        print >>fp, '<components>'
+                        for name, dx, dy in bitmap.components:
+                            print >>fp, '<ebdtComponent name="{name}">'.format(name=name)
+                            print >>fp, '<xOffset value="{dx}"/>'.format(dx=dx)
+                            print >>fp, '<yOffset value="{dy}"/>'.format(dy=dy)
+                            print >>fp, '</ebdtComponent>'
+                        print >>fp, '</components>'
+                    print >>fp, '</ebdt_bitmap_format_{format}>'.format(format=imageformat)
+                print >>fp, '</strikedata>'
+            print >>fp, '</EBDT>'
+
         print >>fp, '</ttFont>'
 
-    def write_json(self, fp):
+        return layout.worker_times
+
+    def compile_ttf(self, pool=None, contour_cache=None, web=False, strikes=()):
+        # returns (a dict of table tag: data, worker times) for `write_ttf` and `write_woff`.
+        # the web profile drops glyph names (`post` format 3.0), which are only for debugging,
+        # and reorders glyphs for the better compression.
+        # `strikes` is a list of scales for embedded bitmaps (see `layout`).
+        t = time.time()
+        layout = self.layout(pool, contour_cache, web=web, strikes=strikes)
+        t = stage_done('ttf:layout', t)
+        emsize = layout.emsize
+        ascent = layout.ascent
+        descent = layout.descent
+        linegap = layout.linegap
+
+        glyphorder = layout.glyphorder
+        glyphids = dict((name, i) for i, name in enumerate(glyphorder))
+        numglyphs = len(glyphorder)
+        assert numglyphs <= 0xffff, 'too many glyphs'
+
+        # glyf (all other tables depend on the outline statistics)
+        outlines = {}
+        for name, contours, components in layout.outlines:
+            outlines[name] = contours, components
+
+        bboxes = {} # name: (xmin, ymin, xmax, ymax) or None for empty glyphs
+        def get_bbox(name):
+            try: return bboxes[name]
+            except KeyError: pass
+            contours, components = outlines[name]
+            if contours:
+                xs = [x for contour in contours for x, y in contour]
+                ys = [y for contour in contours for x, y in contour]
+                bbox = min(xs), min(ys), max(xs), max(ys)
+            elif components:
+                bbox = None
+                for subname, x, y in components:
+                    subbbox = get_bbox(subname)
+                    if not subbbox: continue
+                    subbbox = subbbox[0] + x, subbbox[1] + y, subbbox[2] + x, subbbox[3] + y
+                    if bbox:
+                        subbbox = (min(bbox[0], subbbox[0]), min(bbox[1], subbbox[1]),
+                                   max(bbox[2], subbbox[2]), max(bbox[3], subbbox[3]))
+                    bbox = subbbox
+                if not bbox: bbox = 0, 0, 0, 0
+            else:
+                bbox = None
+            bboxes[name] = bbox
+            return bbox
+
+        composite_maxp = {} # name: (points, contours, depth)
+        def get_composite_maxp(name):
+            try: return composite_maxp[name]
+            except KeyError: pass
+            points = ncontours = 0
+            depth = 1
+            for subname, _, _ in outlines[name][1]:
+                subcontours, subcomponents = outlines[subname]
+                if subcontours:
+                    points += sum(len(contour) for contour in subcontours)
+                    ncontours += len(subcontours)
+                elif subcomponents:
+                    subpoints, subncontours, subdepth = get_composite_maxp(subname)
+                    points += subpoints
+                    ncontours += subncontours
+                    depth = max(depth, subdepth + 1)
+            composite_maxp[name] = points, ncontours, depth
+            return points, ncontours, depth
+
+        def compile_simple(contours):
+            endpts = []
+            flags = bytearray()
+            xdata = []
+            ydata = []
+            npoints = 0
+            lastflag = None
+            repeat = 0
+            px = py = 0
+            for contour in contours:
+                for x, y in contour:
+                    dx = x - px
+                    dy = y - py
+                    px = x
+                    py = y
+                    flag = GLYF_ON_CURVE
+                    if dx == 0:
+                        flag |= GLYF_X_SAME
+                    elif -255 <= dx <= 255:
+                        flag |= GLYF_X_SHORT | (GLYF_X_SAME if dx > 0 else 0)
+                        xdata.append(chr(abs(dx)))
+                    else:
+                        xdata.append(struct.pack('>h', dx))
+                    if dy == 0:
+                        flag |= GLYF_Y_SAME
+                    elif -255 <= dy <= 255:
+                        flag |= GLYF_Y_SHORT | (GLYF_Y_SAME if dy > 0 else 0)
+                        ydata.append(chr(abs(dy)))
+                    else:
+                        ydata.append(struct.pack('>h', dy))
+                    if flag == lastflag and repeat != 255:
+                        repeat += 1
+                        if repeat == 1:
+                            flags.append(flag)
+                        else:
+                            flags[-2] = flag | GLYF_REPEAT
+                            flags[-1] = repeat
+                    else:
+                        repeat = 0
+                        flags.append(flag)
+                    lastflag = flag
+                npoints += len(contour)
+                endpts.append(npoints - 1)
+            return (struct.pack('>%dHH' % len(endpts), *(endpts + [0])) +
+                    str(flags) + ''.join(xdata) + ''.join(ydata))
+
+        def compile_composite(components):
+            data = []
+            for i, (subname, x, y) in enumerate(components):
+                flag = GLYF_ARGS_ARE_XY_VALUES | GLYF_ROUND_XY_TO_GRID | \
+                       GLYF_UNSCALED_COMPONENT_OFFSET
+                if i < len(components) - 1: flag |= GLYF_MORE_COMPONENTS
+                if -128 <= x <= 127 and -128 <= y <= 127:
+                    args = struct.pack('>bb', x, y)
+                else:
+                    flag |= GLYF_ARG_1_AND_2_ARE_WORDS
+                    args = struct.pack('>hh', x, y)
+                data.append(struct.pack('>HH', flag, glyphids[subname]) + args)
+            return ''.join(data)
+
+        glyf = []
+        loca = [0]
+        for name in glyphorder:
+            contours, components = outlines[name]
+            bbox = get_bbox(name)
+            if not bbox:
+                data = ''
+            elif contours:
+                data = struct.pack('>h4h', len(contours), *bbox) + compile_simple(contours)
+            else:
+                data = struct.pack('>h4h', -1, *bbox) + compile_composite(components)
+            data += '\0' * (-len(data) % 4)
+            glyf.append(data)
+            loca.append(loca[-1] + len(data))
+        glyf = ''.join(glyf)
+        if loca[-1] < 0x20000:
+            locformat = 0
+            loca = struct.pack('>%dH' % len(loca), *[offset // 2 for offset in loca])
+        else:
+            locformat = 1
+            loca = struct.pack('>%dL' % len(loca), *loca)
+
+        t = stage_done('ttf:glyf', t)
+
+        # statistics for head, hhea and maxp (same as what fontTools recalculates)
+        xmin = ymin = xmax = ymax = None
+        allxminislsb = True
+        advancemax = 0
+        minlsb = minrsb = xmaxextent = None
+        maxpoints = maxcontours = 0
+        maxcomppoints = maxcompcontours = maxcompelems = maxcompdepth = 0
+        for name, width, lsb in layout.metrics:
+            advancemax = max(advancemax, width)
+            bbox = get_bbox(name)
+            if not bbox: continue
+            contours, components = outlines[name]
+            if lsb != bbox[0]: allxminislsb = False
+            if xmin is None:
+                xmin, ymin, xmax, ymax = bbox
+            else:
+                xmin = min(xmin, bbox[0])
+                ymin = min(ymin, bbox[1])
+                xmax = max(xmax, bbox[2])
+                ymax = max(ymax, bbox[3])
+            extent = lsb + (bbox[2] - bbox[0])
+            minlsb = lsb if minlsb is None else min(minlsb, lsb)
+            minrsb = width - extent if minrsb is None else min(minrsb, width - extent)
+            xmaxextent = extent if xmaxextent is None else max(xmaxextent, extent)
+            if contours:
+                maxpoints = max(maxpoints, sum(len(contour) for contour in contours))
+                maxcontours = max(maxcontours, len(contours))
+            else:
+                points, ncontours, depth = get_composite_maxp(name)
+                maxcomppoints = max(maxcomppoints, points)
+                maxcompcontours = max(maxcompcontours, ncontours)
+                maxcompelems = max(maxcompelems, len(components))
+                maxcompdepth = max(maxcompdepth, depth)
+
+        numhmetrics = len(layout.metrics)
+        while numhmetrics > 1 and layout.metrics[numhmetrics-2][1] == layout.metrics[-1][1]:
+            numhmetrics -= 1
+
+        tables = {}
+
+        # head (checkSumAdjustment is filled later)
+        timestamp = int(time.time()) + TTF_EPOCH_OFFSET
+        tables['head'] = struct.pack('>LLLLHHqq4hHHhhh',
+                0x10000, 0x10000, 0, 0x5f0f3cf5,
+                0b1001 | (0b10 if allxminislsb else 0), emsize, timestamp, timestamp,
+                xmin or 0, ymin or 0, xmax or 0, ymax or 0,
+                0, 8, 2, locformat, 0)
+
+        # hhea
+        # ascent + (-descent) + linegap = line height
+        tables['hhea'] = struct.pack('>Lhhh Hhhh hhh 4h hH',
+                0x10000, ascent, -descent, linegap,
+                advancemax, minlsb or 0, minrsb or 0, xmaxextent or 0,
+                1, 0, 0, 0, 0, 0, 0, 0, numhmetrics)
+
+        # maxp
+        tables['maxp'] = struct.pack('>L14H',
+                0x10000, numglyphs, maxpoints, maxcontours, maxcomppoints, maxcompcontours,
+                2, 0, 0, 40, 0, 512, 0, maxcompelems, maxcompdepth)
+
+        # OS/2 (see write_ttx for the explanation of each field)
+        bmpcodes = [min(ch, 0xffff) for ch in self.cmap]
+        tables['OS/2'] = struct.pack('>HhHHH 11h 10s 4L 4sHHH hhhHH LL',
+                1, int(8*SCALE), 400, 5, 0,
+                390, 419, 0, 84, 390, 419, 0, 287, 29, 155, 0,
+                str(bytearray([2, 11, 6, 9, 1, 1, 1, 1, 1, 1])),
+                0x800000af, 0x0191204a, 0, 0,
+                'Morg', 0x0080, min(bmpcodes or [0]), max(bmpcodes or [0]),
+                ascent, -descent, linegap, linegap + ascent, descent,
+                0x60280011, 0x81d40000)
+
+        # hmtx
+        tables['hmtx'] = ''.join(
+                [struct.pack('>Hh', width, lsb) for _, width, lsb in layout.metrics[:numhmetrics]] +
+                [struct.pack('>h', lsb) for _, _, lsb in layout.metrics[numhmetrics:]])
+
+        t = stage_done('ttf:metrics', t)
+
+        # cmap
+        cmap = sorted((ch, glyphids[name]) for ch, name in self.cmap.items())
+        def cmap_format_4(cmap):
+            # a segment is (start, end, delta) or (start, end, list of glyph ids)
+            segments = []
+            def flush_array(array):
+                if array: segments.append((array[0][0], array[-1][0], [gid for _, gid in array]))
+            for _, run in itertools.groupby(enumerate(cmap), lambda (i, (ch, _)): ch - i):
+                # a run of consecutive characters, split into deltas when it's worthwhile
+                run = [item for _, item in run]
+                array = []
+                for _, deltarun in itertools.groupby(run, lambda (ch, gid): gid - ch):
+                    deltarun = list(deltarun)
+                    if len(deltarun) > 4 or len(deltarun) == len(run):
+                        flush_array(array)
+                        array = []
+                        start, gid = deltarun[0]
+                        segments.append((start, deltarun[-1][0], gid - start))
+                    else:
+                        array.extend(deltarun)
+                flush_array(array)
+            segments.append((0xffff, 0xffff, 1))
+
+            segcount = len(segments)
+            searchrange = 1
+            while searchrange * 2 <= segcount: searchrange *= 2
+            entryselector = searchrange.bit_length() - 1
+            glyphidarray = []
+            deltas = []
+            rangeoffsets = []
+            for i, (start, end, value) in enumerate(segments):
+                if isinstance(value, list):
+                    deltas.append(0)
+                    rangeoffsets.append(2 * (segcount - i + len(glyphidarray)))
+                    glyphidarray.extend(value)
+                else:
+                    deltas.append(value & 0xffff)
+                    rangeoffsets.append(0)
+            length = 16 + 8 * segcount + 2 * len(glyphidarray)
+            assert length <= 0xffff, 'cmap format 4 subtable overflow'
+            return (struct.pack('>7H', 4, length, 0, segcount * 2, searchrange * 2,
+                                entryselector, (segcount - searchrange) * 2) +
+                    struct.pack('>%dH' % segcount, *[end for _, end, _ in segments]) +
+                    struct.pack('>H', 0) +
+                    struct.pack('>%dH' % segcount, *[start for start, _, _ in segments]) +
+                    struct.pack('>%dH' % segcount, *deltas) +
+                    struct.pack('>%dH' % segcount, *rangeoffsets) +
+                    struct.pack('>%dH' % len(glyphidarray), *glyphidarray))
+        def cmap_format_12(cmap):
+            groups = []
+            for _, group in itertools.groupby(enumerate(cmap),
+                                              lambda (i, (ch, gid)): (ch - i, gid - i)):
+                group = [item for _, item in group]
+                groups.append(struct.pack('>3L', group[0][0], group[-1][0], group[0][1]))
+            return struct.pack('>HHLLL', 12, 0, 16 + 12 * len(groups), 0, len(groups)) + \
+                   ''.join(groups)
+        subtables = []
+        bmpsubtable = cmap_format_4([(ch, gid) for ch, gid in cmap if ch < 0x10000])
+        for platid, platenc in ((0, 3), (1, 0), (3, 1)):
+            subtables.append((platid, platenc, bmpsubtable))
+        if cmap and cmap[-1][0] >= 0x10000:
+            fullsubtable = cmap_format_12(cmap)
+            for platid, platenc in ((0, 4), (3, 10)):
+                subtables.append((platid, platenc, fullsubtable))
+        subtables.sort()
+        records = []
+        data = []
+        offsets = {}
+        offset = 4 + 8 * len(subtables)
+        for platid, platenc, subtable in subtables:
+            if subtable not in offsets:
+                offsets[subtable] = offset
+                offset += len(subtable)
+                data.append(subtable)
+            records.append(struct.pack('>HHL', platid, platenc, offsets[subtable]))
+        tables['cmap'] = struct.pack('>HH', 0, len(subtables)) + ''.join(records + data)
+        t = stage_done('ttf:cmap', t)
+
+        # fpgm, prep, cvt
+        tables['fpgm'] = FPGM
+        tables['prep'] = PREP
+        tables['cvt '] = struct.pack('>%dh' % len(CVT), *CVT)
+
+        # loca, glyf
+        tables['loca'] = loca
+        tables['glyf'] = glyf
+
+        # name
+        records = []
+        data = []
+        offsets = {}
+        offset = 0
+        for platid, platenc, langid in NAME_PLATFORMS:
+            for nameid, _, nameval in NAMES:
+                nameval = nameval.encode('mac_roman' if platid == 1 else 'utf-16be')
+                if nameval not in offsets:
+                    offsets[nameval] = offset
+                    offset += len(nameval)
+                    data.append(nameval)
+                records.append((platid, platenc, langid, nameid, len(nameval), offsets[nameval]))
+        records.sort()
+        tables['name'] = struct.pack('>HHH', 0, len(records), 6 + 12 * len(records)) + \
+                         ''.join(struct.pack('>6H', *record) for record in records) + \
+                         ''.join(data)
+
+        # post
+        if web:
+            tables['post'] = struct.pack('>LLhhL4L', 0x30000, 0, descent, int(SCALE), 1,
+                                         0, 0, 0, 0)
+        else:
+            macglyphids = dict((name, i) for i, name in enumerate(MAC_GLYPH_NAMES))
+            extranames = []
+            nameindices = []
+            for name in glyphorder:
+                if name in macglyphids:
+                    nameindices.append(macglyphids[name])
+                else:
+                    name = name.encode('utf-8')
+                    assert len(name) < 256, 'too long glyph name %s' % name
+                    nameindices.append(len(MAC_GLYPH_NAMES) + len(extranames))
+                    extranames.append(chr(len(name)) + name)
+            tables['post'] = struct.pack('>LLhhL4LH', 0x20000, 0, descent, int(SCALE), 1,
+                                         0, 0, 0, 0, numglyphs) + \
+                             struct.pack('>%dH' % numglyphs, *nameindices) + ''.join(extranames)
+
+        # GDEF
+        tables['GDEF'] = struct.pack('>L4H', 0x10000, 0, 0, 0, 0)
+
+        t = stage_done('ttf:misc', t)
+
+        # GSUB
+        def coverage(glyphs):
+            gids = sorted(set(glyphids[glyph] for glyph in glyphs))
+            ranges = []
+            for _, run in itertools.groupby(enumerate(gids), lambda (i, gid): gid - i):
+                run = list(run)
+                ranges.append((run[0][1], run[-1][1], run[0][0]))
+            if len(ranges) * 3 < len(gids):
+                return struct.pack('>HH', 2, len(ranges)) + \
+                       ''.join(struct.pack('>3H', *r) for r in ranges)
+            else:
+                return struct.pack('>HH', 1, len(gids)) + struct.pack('>%dH' % len(gids), *gids)
+        def with_offsets(head, children):
+            # packs `head`, 16-bit offsets to `children` (relative to the start) and `children`
+            offset = len(head) + 2 * len(children)
+            offsets = []
+            for child in children:
+                offsets.append(offset)
+                offset += len(child)
+            assert offset <= 0xffff, 'GSUB offset overflow'
+            return head + struct.pack('>%dH' % len(children), *offsets) + ''.join(children)
+        def single_subst(substs):
+            mapping = {}
+            for pat, rep in substs: mapping[glyphids[pat]] = glyphids[rep]
+            gids = sorted(mapping)
+            deltas = set((mapping[gid] - gid) & 0xffff for gid in gids)
+            cov = coverage(glyphorder[gid] for gid in gids)
+            if len(deltas) == 1:
+                delta, = deltas
+                return struct.pack('>HHH', 1, 6, delta) + cov
+            else:
+                return struct.pack('>HHH', 2, 6 + 2 * len(gids), len(gids)) + \
+                       struct.pack('>%dH' % len(gids), *[mapping[gid] for gid in gids]) + cov
+        def ligature_subst(ligatures):
+            ligatures = sorted(ligatures, key=lambda (start, _): glyphids[start])
+            ligsets = []
+            for start, ligs in ligatures:
+                ligsets.append(with_offsets(struct.pack('>H', len(ligs)), [
+                    struct.pack('>HH', glyphids[mapped], len(remainder) + 1) +
+                    ''.join(struct.pack('>H', glyphids[glyph]) for glyph in remainder)
+                    for remainder, mapped in ligs]))
+            covoffset = 6 + 2 * len(ligsets) + sum(map(len, ligsets))
+            return with_offsets(struct.pack('>HHH', 1, covoffset, len(ligsets)), ligsets) + \
+                   coverage(start for start, _ in ligatures)
+        def chain_subst(rule):
+            coverages = [map(coverage, rule.backtrack), map(coverage, rule.input),
+                         map(coverage, rule.lookahead)]
+            offset = 14 + 2 * sum(map(len, coverages))
+            head = struct.pack('>H', 3)
+            for covs in coverages:
+                head += struct.pack('>H', len(covs))
+                for cov in covs:
+                    head += struct.pack('>H', offset)
+                    offset += len(cov)
+            assert offset <= 0xffff, 'GSUB offset overflow'
+            head += struct.pack('>HHH', 1, 0, rule.lookup) # SubstLookupRecord
+            return head + ''.join(cov for covs in coverages for cov in covs)
+        def classdef(classes):
+            # format 1 (classes of consecutive glyphs) or 2 (ranges), whichever is smaller
+            values = sorted((glyphids[glyph], c) for glyph, c in classes.items())
+            ranges = []
+            for gid, c in values:
+                if ranges and ranges[-1][1] == gid - 1 and ranges[-1][2] == c:
+                    ranges[-1][1] = gid
+                else:
+                    ranges.append([gid, gid, c])
+            if values and values[-1][0] - values[0][0] + 1 < 3 * len(ranges) - 1:
+                first = values[0][0]
+                array = [0] * (values[-1][0] - first + 1)
+                for gid, c in values: array[gid - first] = c
+                return struct.pack('>HHH%dH' % len(array), 1, first, len(array), *array)
+            else:
+                return struct.pack('>HH', 2, len(ranges)) + \
+                       ''.join(struct.pack('>3H', *r) for r in ranges)
+        def chain_class_subst(classes):
+            classsets = []
+            for rules in classes.classsets:
+                classsets.append(rules and with_offsets(struct.pack('>H', len(rules)), [
+                    struct.pack('>H%dH' % len(back), len(back), *back) +
+                    struct.pack('>H%dH' % len(rest), len(rest) + 1, *rest) +
+                    struct.pack('>H%dH' % len(ahead), len(ahead), *ahead) +
+                    struct.pack('>HHH', 1, 0, lookup) # SubstLookupRecord
+                    for back, rest, ahead, lookup in rules]))
+            children = [coverage(classes.coverage), classdef(classes.backtrack),
+                        classdef(classes.input), classdef(classes.lookahead)]
+            offset = 12 + 2 * len(classsets)
+            offsets = []
+            for child in children + classsets:
+                offsets.append(offset if child else 0) # empty class sets are NULL
+                offset += len(child or '')
+            assert offset <= 0xffff, 'GSUB offset overflow'
+            head = [2] + offsets[:4] + [len(classsets)] + offsets[4:]
+            return struct.pack('>%dH' % len(head), *head) + \
+                   ''.join(children) + ''.join(filter(None, classsets))
+
+        lookups = []
+        for setname, lookuptype, data in layout.lookups:
+            if lookuptype == LOOKUP_SINGLE:
+                subtables = [single_subst(data)]
+            elif lookuptype == LOOKUP_LIGATURE:
+                subtables = [ligature_subst(data)]
+            elif lookuptype == LOOKUP_CHAIN:
+                classes = chain_classes(data, glyphids)
+                subtables = [chain_class_subst(classes)] if classes else map(chain_subst, data)
+            lookups.append(with_offsets(struct.pack('>HHH', lookuptype, 0, len(subtables)),
+                                        subtables))
+        features = []
+        for featurename, setlookups in layout.features:
+            features.append(struct.pack('>HH', 0, len(setlookups)) +
+                            ''.join(struct.pack('>H', lookup) for lookup, _ in setlookups))
+        featurelist = struct.pack('>H', len(features))
+        offset = 2 + 6 * len(features)
+        for (featurename, _), feature in zip(layout.features, features):
+            featurelist += struct.pack('>4sH', featurename.encode('ascii'), offset)
+            offset += len(feature)
+        featurelist += ''.join(features)
+        scriptlist = struct.pack('>H4sHHH', 1, 'DFLT', 8, 4, 0) + \
+                     struct.pack('>HHH', 0, 0xffff, len(features)) + \
+                     struct.pack('>%dH' % len(features), *range(len(features)))
+        lookuplist = with_offsets(struct.pack('>H', len(lookups)), lookups)
+        tables['GSUB'] = struct.pack('>LHHH', 0x10000, 10, 10 + len(scriptlist),
+                                     10 + len(scriptlist) + len(featurelist)) + \
+                         scriptlist + featurelist + lookuplist
+        t = stage_done('ttf:GSUB', t)
+
+        # EBDT and EBLC
+        if layout.strikes:
+            ebdt = [struct.pack('>L', 0x20000)]
+            ebdtsize = 4
+            sizetables = []
+            indexarrays = []
+            indexoffset = 8 + EBLC_BITMAP_SIZE.size * len(layout.strikes)
+            for scale, bitmaps in layout.strikes:
+                runs = bitmap_runs(bitmaps)
+                array = []
+                subtables = []
+                offset = 8 * len(runs)
+                for first, last, imageformat in runs:
+                    images = []
+                    for bitmap in bitmaps[first:last+1]:
+                        data = BIG_GLYPH_METRICS.pack(*bitmap[:8])
+                        if imageformat == 6:
+                            data += bitmap_image(bitmap)
+                        else:
+                            data += struct.pack('>H', len(bitmap.components)) + \
+                                    ''.join(struct.pack('>Hbb', glyphids[subname], dx, dy)
+                                            for subname, dx, dy in bitmap.components)
+                        images.append(data)
+                    offsets = [0]
+                    for data in images: offsets.append(offsets[-1] + len(data))
+                    if offsets[-1] < 0x10000:
+                        subtable = struct.pack('>HHL%dH' % len(offsets), 3, imageformat,
+                                               ebdtsize, *offsets)
+                        subtable += '\0' * (-len(subtable) % 4)
+                    else:
+                        subtable = struct.pack('>HHL%dL' % len(offsets), 1, imageformat,
+                                               ebdtsize, *offsets)
+                    array.append(struct.pack('>HHL', first, last, offset))
+                    subtables.append(subtable)
+                    offset += len(subtable)
+                    ebdt.extend(images)
+                    ebdtsize += offsets[-1]
+                indexarrays.append(''.join(array + subtables))
+
+                linemetrics = struct.pack('>bbBbbbbbbbbb',
+                                          *sbit_line_metrics(bitmaps, ascent, descent, scale))
+                sizetables.append(EBLC_BITMAP_SIZE.pack(
+                        indexoffset, len(indexarrays[-1]), len(runs), 0, linemetrics, linemetrics,
+                        runs[0][0], runs[-1][1], emsize * scale // SCALE, emsize * scale // SCALE,
+                        1, 1))
+                indexoffset += len(indexarrays[-1])
+
+            tables['EBDT'] = ''.join(ebdt)
+            tables['EBLC'] = struct.pack('>LL', 0x20000, len(layout.strikes)) + \
+                             ''.join(sizetables + indexarrays)
+            stage_done('ttf:EBDT', t)
+
+        return tables, layout.worker_times
+
+    def write_ttf(self, fp, pool=None, contour_cache=None, web=False, strikes=()):
+        tables, worker_times = self.compile_ttf(pool, contour_cache, web, strikes)
+        t = time.time()
+        header, tags, _ = sfnt_directory(tables)
+        fp.write(header)
+        for tag in tags:
+            fp.write(tables[tag] + '\0' * (-len(tables[tag]) % 4))
+        stage_done('ttf:assembly', t)
+        return worker_times
+
+    def write_woff(self, fp, pool=None, contour_cache=None, sizes=None, strikes=()):
+        # writes a WOFF 1.0 file in the web profile (see `compile_ttf`). each table is
+        # compressed with zlib unless that doesn't make it smaller. `sizes`, when given,
+        # is filled with table tag: (uncompressed size, compressed size).
+        tables, worker_times = self.compile_ttf(pool, contour_cache, web=True, strikes=strikes)
+        t = time.time()
+        header, tags, directory = sfnt_directory(tables)
+        entries = {}
+        blocks = []
+        offset = WOFF_HEADER.size + WOFF_ENTRY.size * len(tables)
+        for tag in tags:
+            data = tables[tag]
+            compressed = zlib.compress(data, 9)
+            if len(compressed) >= len(data): compressed = data
+            entries[tag] = offset, len(compressed), len(data), directory[tag][0]
+            blocks.append(compressed + '\0' * (-len(compressed) % 4))
+            offset += len(blocks[-1])
+            if sizes is not None: sizes[tag] = len(data), len(compressed)
+        sfntsize = len(header) + sum(len(data) + (-len(data) % 4) for data in tables.values())
+        major, minor = struct.unpack('>HH', tables['head'][4:8]) # fontRevision
+        fp.write(WOFF_HEADER.pack('wOFF', 0x10000, offset, len(tables), 0, sfntsize,
+                                  major, minor, 0, 0, 0, 0, 0))
+        fp.write(''.join(WOFF_ENTRY.pack(tag, *entries[tag]) for tag in sorted(tables)))
+        fp.write(''.join(blocks))
+        stage_done('woff:assembly', t)
+        return worker_times
+
+    def write_shards(self, path, groups=(), pool=None, contour_cache=None, web=False):
+        # writes a TrueType (or WOFF if `web`) font for each shard of characters into `path`,
+        # along with `@font-face` rules with `unicode-range` (SHARD_CSS) so that browsers
+        # only download shards a page actually uses. characters are grouped by Unicode blocks
+        # unless they are in one of `groups`, a list of (shard name, CodepointRanges).
+        # each shard is a subset of this font with its own glyph closure and GSUB, whose lookups
+        # are in the same order as this font's so that a shard shapes as the full font does.
+        # returns a list of (file name, # of characters, # of glyphs, file size).
+        blocks = ExternalData.get_blocks()
+        firsts = [first for first, _, _ in blocks]
+        shards = OrderedDict() # shard name: a list of code points
+        for ch in sorted(self.cmap):
+            for name, ranges in groups:
+                if ch in ranges: break
+            else:
+                i = bisect.bisect_right(firsts, ch) - 1
+                if i >= 0 and ch <= blocks[i][1]:
+                    name = re.sub(r'[^0-9a-z]+', '-', blocks[i][2].lower()).strip('-')
+                else:
+                    name = 'other'
+            shards.setdefault(name, []).append(ch)
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): raise
+
+        family = dict((key, value) for _, key, value in NAMES)['family']
+        written = []
+        with open(os.path.join(path, SHARD_CSS), 'w') as css:
+            for name, chars in shards.items():
+                shard = copy.copy(self) # `subset` replaces (not modifies) every field
+                shard.subset(set(chars))
+                filename = 'unison-%s.%s' % (name, 'woff' if web else 'ttf')
+                with open(os.path.join(path, filename), 'wb') as f:
+                    if web:
+                        shard.write_woff(f, pool, contour_cache)
+                    else:
+                        shard.write_ttf(f, pool, contour_cache)
+                    size = f.tell()
+                written.append((filename, len(chars), len(shard.glyphs), size))
+
+                print >>css, '@font-face {'
+                print >>css, "    font-family: '%s';" % family.encode('utf-8')
+                print >>css, "    src: url('%s') format('%s');" % (filename,
+                                                                   'woff' if web else 'truetype')
+                print >>css, '    unicode-range: %s;' % CodepointRanges((ch, ch) for ch in chars)
+                print >>css, '}'
+        return written
+
+    def write_binary(self, fp):
+        # names are interned in the order of appearance (everything is visited in a sorted order)
+        names = []
+        nameids = {}
+        def intern(name):
+            try:
+                return nameids[name]
+            except KeyError:
+                nameids[name] = nameid = len(names)
+                names.append(name)
+                return nameid
+
+        # every view to the same pixel data is written once
+        pixels = []
+        pixeloffsets = {} # (arena id, offset, length): offset to the pixel data
+        pixelsize = 0
+
+        pack_glyph = BINARY_GLYPH.pack
+        pack_subglyph = BINARY_SUBGLYPH.pack
+        index = []
+        table = []
+        tablesize = 0
+        for name, gg in sorted(self.glyphs.items()):
+            record = [pack_glyph(gg.flags, gg.height, gg.width, gg.preferred_top, gg.preferred_left,
+                                 len(gg.subglyphs), len(gg.points))]
+            for g in gg.subglyphs:
+                data = g.data
+                if isinstance(data, Pixels):
+                    key = id(data.arena), data.offset, data.length
+                    offset = pixeloffsets.get(key)
+                    if offset is None:
+                        offset = pixeloffsets[key] = pixelsize
+                        pixels.append(str(data))
+                        pixelsize += data.length
+                    record.append(pack_subglyph(g.top, g.left, g.height, g.width, g.negated,
+                                                BINARY_DATA_PIXELS, g.stride, offset, data.length))
+                else:
+                    if isinstance(data, Adjoin):
+                        kind, data = BINARY_DATA_ADJOIN, intern(data.value)
+                    elif isinstance(data, basestring):
+                        kind, data = BINARY_DATA_NAMED, intern(data)
+                    else:
+                        kind, data = BINARY_DATA_NONE, 0
+                    record.append(pack_subglyph(g.top, g.left, g.height, g.width, g.negated,
+                                                kind, data, 0, 0))
+            if gg.points:
+                for posname, (r, c) in sorted(gg.points.items()):
+                    record.append(BINARY_POINT.pack(intern(posname), r, c))
+            record = ''.join(record)
+            index.append(BINARY_INDEX.pack(intern(name), tablesize))
+            table.append(record)
+            tablesize += len(record)
+
+        cmap = [BINARY_CMAP.pack(ch, intern(name)) for ch, name in sorted(self.cmap.items())]
+
+        def name_item(item):
+            if isinstance(item, list):
+                return msgpack_array(len(item)) + ''.join(msgpack_int(intern(i)) for i in item)
+            else:
+                return msgpack_int(intern(item))
+        remaps = [msgpack_map(len(self.remaps))]
+        for setname, setremaps in sorted(self.remaps.items()):
+            remaps.append(msgpack_int(intern(setname)) + msgpack_array(len(setremaps)))
+            for remap in setremaps:
+                remaps.append(msgpack_array(4))
+                for items in (remap.lookbehind, remap.pattern, remap.lookahead, remap.replacement):
+                    remaps.append(msgpack_array(len(items)) + ''.join(map(name_item, items)))
+
+        features = [msgpack_map(len(self.features))]
+        for featurename, sets in sorted(self.features.items()):
+            features.append(msgpack_int(intern(featurename)) + msgpack_array(len(sets)) +
+                            ''.join(msgpack_int(intern(s)) for s in sets))
+
+        exclude_from_sample = sorted(self.exclude_from_sample)
+
+        fp.write(msgpack_str(BINARY_MAGIC))
+        fp.write(msgpack_int(BINARY_VERSION))
+        fp.write(msgpack_int(self.height))
+        fp.write(msgpack_int(self.ascent))
+        fp.write(msgpack_int(self.descent))
+        fp.write(msgpack_array(len(names)))
+        fp.write(''.join(map(msgpack_str, names)))
+        fp.write(msgpack_bin(''.join(pixels)))
+        fp.write(msgpack_bin(''.join(index)))
+        fp.write(msgpack_bin(''.join(table)))
+        fp.write(msgpack_bin(''.join(cmap)))
+        fp.write(''.join(remaps))
+        fp.write(''.join(features))
+        fp.write(msgpack_bin(struct.pack('<%dI' % len(exclude_from_sample), *exclude_from_sample)))
+
+    def write_json(self, fp, manifest=None):
         import json
         def default(o):
             if isinstance(o, set): return list(o)
+            if isinstance(o, Pixels): return list(o)
             raise TypeError
-        json.dump(self.__dict__, fp, separators=(',',':'), default=default)
+        # keys are sorted so that the output doesn't depend on the dict construction history
+        # (which differs when fragments are loaded from the parse cache)
+        def dumps(o):
+            return json.dumps(o, separators=(',',':'), sort_keys=True, default=default)
+
+        # same to `json.dump(self.__dict__, ...)`, but each glyph is encoded separately
+        # so that the manifest can keep them
+        def get_glyph(name, glyph):
+            fragment = manifest and manifest.get('json', name)
+            if fragment is None:
+                fragment = dumps(glyph)
+                if manifest: manifest.put('json', name, fragment)
+            return fragment
+        items = []
+        for key, value in sorted(self.__dict__.items()):
+            if key == 'glyphs':
+                value = '{%s}' % ','.join('%s:%s' % (dumps(name), get_glyph(name, glyph))
+                                          for name, glyph in sorted(value.items()))
+            else:
+                value = dumps(value)
+            items.append('%s:%s' % (dumps(key), value))
+        fp.write('{%s}' % ','.join(items))
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds Unison from font source files.')
+    parser.add_argument('sources', nargs='*', metavar='SOURCE',
+                        help='font source files (glob patterns are accepted)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not use on-disk caches for parsed files and contours')
+    parser.add_argument('--cache-size', type=int, default=BUILD_CACHE_SIZE, metavar='BYTES',
+                        help='size limit of the whole on-disk cache; least recently used entries '
+                             'are evicted beyond that')
+    parser.add_argument('--contour-cache-size', type=int, default=CONTOUR_CACHE_SIZE,
+                        metavar='BYTES', help='size limit of the on-disk contour cache')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='parse source files and trace contours with N worker processes')
+    parser.add_argument('--ttx', action='store_true',
+                        help='write a TTX dump (unison.ttx) instead of unison.ttf, for debugging')
+    parser.add_argument('--json', action='store_true',
+                        help='also write a JSON dump of glyphs (unison.json), for debugging')
+    parser.add_argument('--bitmaps', metavar='SCALES',
+                        help='also embed bitmap strikes (EBDT/EBLC) of full pixels at given '
+                             'comma-separated multiples of the pixel size, e.g. 1,2 for 16px '
+                             'and 32px strikes')
+    parser.add_argument('--web', action='store_true',
+                        help='write unison.woff instead of unison.ttf (and WOFF shards for '
+                             '--shards), without glyph names and with the size of each table')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write the cost of each glyph and remapping set to PATH '
+                             '(CSV if it ends with .csv, JSON otherwise); '
+                             'implies --no-cache and -j 1')
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                        help='number of the most costly items shown for --profile')
+    parser.add_argument('--mem-report', action='store_true',
+                        help='report the peak (per stage where the peak can be reset, as on '
+                             'Linux) and retained memory after each stage, '
+                             'with object types growing the most')
+    parser.add_argument('--mem-budget', type=float, metavar='MB',
+                        help='fail when the peak memory exceeds MB (implies --mem-report)')
+    parser.add_argument('--max-contours', type=int, metavar='N',
+                        help='report outline statistics and fail when any glyph has more than '
+                             'N contours (composite glyphs count their components)')
+    parser.add_argument('--max-points', type=int, metavar='N',
+                        help='report outline statistics and fail when any glyph has more than '
+                             'N points (composite glyphs count their components)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and rebuild whenever source files change')
+    parser.add_argument('--subset', action='append', metavar='SPEC',
+                        help='only keep characters in SPEC and glyphs needed by them; SPEC is '
+                             'a comma-separated list of code points and ranges '
+                             '(e.g. U+0000-007F,U+AC00-D7A3) or @PATH to a UTF-8 text file '
+                             'of characters. can be given multiple times')
+    parser.add_argument('--shards', metavar='DIR',
+                        help='also write a font for each Unicode block into DIR, with unison.css '
+                             'declaring them with unicode-range for web pages')
+    parser.add_argument('--shard-group', action='append', default=[], metavar='[NAME=]SPEC',
+                        help='make a single shard for characters in SPEC (see --subset) instead '
+                             'of per-block shards. can be given multiple times')
+    args = parser.parse_args()
+    if args.watch and (args.profile or args.mem_report or args.mem_budget is not None):
+        parser.error('--watch cannot be used with --profile or --mem-report')
+    budgets = args.max_contours is not None or args.max_points is not None
+    if args.watch and budgets:
+        parser.error('--watch cannot be used with --max-contours or --max-points')
+    if args.web and args.ttx:
+        parser.error('--web cannot be used with --ttx')
+    strikes = ()
+    if args.bitmaps:
+        try:
+            strikes = sorted(set(int(scale) for scale in args.bitmaps.split(',')))
+        except ValueError:
+            parser.error('invalid --bitmaps: %s' % args.bitmaps)
+        # line metrics in EBLC are signed bytes, and the ascent should fit
+        if not all(1 <= scale <= 7 for scale in strikes):
+            parser.error('--bitmaps scales should be between 1 and 7')
+    subset = None
+    if args.subset:
+        try:
+            subset = CodepointRanges.parse(args.subset)
+        except (ValueError, IOError, UnicodeDecodeError) as e:
+            parser.error('invalid --subset: %s' % e)
+    shard_groups = []
+    for i, spec in enumerate(args.shard_group):
+        name, _, spec = spec.rpartition('=')
+        name = name or 'group%d' % (i + 1)
+        if not re.match(r'^[0-9a-z_\-]+$', name):
+            parser.error('invalid --shard-group name %r' % name)
+        try:
+            shard_groups.append((name, CodepointRanges.parse([spec])))
+        except (ValueError, IOError, UnicodeDecodeError) as e:
+            parser.error('invalid --shard-group: %s' % e)
+    if shard_groups and not args.shards:
+        parser.error('--shard-group requires --shards')
+    memory = None
+    if args.mem_report or args.mem_budget is not None:
+        memory = MemoryReport(None if args.mem_budget is None else int(args.mem_budget * 1048576))
+    if args.profile:
+        args.cache = False
+        args.jobs = 1
+        PROFILE = Profile()
+    ExternalData.cache.maxsize = args.cache_size
+    cache = ExternalData.cache if args.cache else None
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+
+    contour_cache = ContourCache(cache, args.contour_cache_size)
+    # only TTX and JSON outputs are regenerated per glyph
+    manifest = GlyphManifest(cache) if cache and (args.json or args.ttx) else None
+
+    def write_outputs(font):
+        # returns worker times from writing the TTF or TTX
+        if manifest: manifest.update(font)
+        with open('unison.dat', 'wb') as f:
+            font.write_binary(f)
+        if memory: memory.stage_done('write_binary')
+        if args.json:
+            with open('unison.json', 'wb') as f:
+                font.write_json(f, manifest)
+            if memory: memory.stage_done('write_json')
+        if args.ttx:
+            with open('unison.ttx', 'w') as f:
+                worker_times = font.write_ttx(f, pool, contour_cache, manifest, strikes)
+            if memory: memory.stage_done('write_ttx')
+        elif args.web:
+            sizes = {}
+            with open('unison.woff', 'wb') as f:
+                worker_times = font.write_woff(f, pool, contour_cache, sizes, strikes)
+                print >>sys.stderr, 'woff: %d bytes, %d bytes uncompressed' % (
+                        f.tell(), sum(size for size, _ in sizes.values()))
+            for tag, (size, compressed) in sorted(sizes.items(), key=lambda (_, v): -v[0]):
+                print >>sys.stderr, '  %-4s %9d -> %9d bytes (%5.1f%%)' % (
+                        tag, size, compressed, compressed * 100. / size)
+            if memory: memory.stage_done('write_woff')
+        else:
+            with open('unison.ttf', 'wb') as f:
+                worker_times = font.write_ttf(f, pool, contour_cache, strikes=strikes)
+            if memory: memory.stage_done('write_ttf')
+        if args.shards:
+            shards = font.write_shards(args.shards, shard_groups, pool, contour_cache, args.web)
+            print >>sys.stderr, 'shards: %d fonts written to %s, %d bytes in total' % (
+                    len(shards), args.shards, sum(size for _, _, _, size in shards))
+            if memory: memory.stage_done('write_shards')
+        return worker_times
+
+    if args.watch:
+        # caches are kept in memory while watching, and saved only when stopped
+        try:
+            SourceWatcher(args.sources, cache, pool, subset).run(write_outputs)
+        except KeyboardInterrupt:
+            contour_cache.save()
+            if manifest: manifest.save()
+        raise SystemExit
+
     font = Font()
     t1 = time.time()
     try:
         current_path = None
-        for pat in sys.argv[1:]:
-            for path in glob.glob(pat):
-                current_path = path
-                with open(path) as f:
-                    font.read(f)
+        sources = [(path, read_source(path, cache, pool))
+                   for pat in args.sources for path in glob.glob(pat)]
+        for path, get_fragments in sources:
+            current_path = path
+            for fragment in get_fragments():
+                font.merge(fragment)
         current_path = None
+        if memory: memory.stage_done('read')
         font.resolve_glyphs()
+        if memory: memory.stage_done('resolve_glyphs')
+        if subset is not None:
+            removed = font.subset(subset)
+            print >>sys.stderr, 'subset: %d glyphs for %d characters kept, %d glyphs removed' % (
+                    len(font.glyphs), len(font.cmap), removed)
+            if memory: memory.stage_done('subset')
+        if PROFILE is not None: PROFILE.record_resolved(font)
         font.inline_glyphs()
+        if memory: memory.stage_done('inline_glyphs')
     except ParseError as e:
         if current_path: print >>sys.stderr, current_path + ':',
         print >>sys.stderr, unicode(e).encode('utf-8')
         raise SystemExit(1)
     t2 = time.time()
-    with open('unison.json', 'wb') as f:
-        font.write_json(f)
-    with open('unison.ttx', 'w') as f:
-        font.write_ttx(f)
+    worker_times = write_outputs(font)
+    contour_cache.save()
+    if manifest: manifest.save()
     t3 = time.time()
     print >>sys.stderr, '%.3fs parsing, %.3fs rendering' % (t2 - t1, t3 - t2)
-
+    print >>sys.stderr, '  contour cache: %d hits, %d misses' % (contour_cache.hits,
+                                                               contour_cache.misses)
+    shared = font.share_pixels()
+    if shared:
+        points = 0
+        for name, i in shared:
+            g = font.glyphs[name].subglyphs[i]
+            key = ContourCache.make_key(g.height, g.width, g.stride, g.data, PX_SUBPIXEL)
+            points += sum(len(path) for path in contour_cache.entries.get(key, []))
+        print >>sys.stderr, '  shared outlines: %d pixel subglyphs written as components, ' \
+                            '%d points saved' % (len(shared), points)
+    if manifest:
+        print >>sys.stderr, '  manifest: %d of %d glyphs changed, %d outputs reused' % (
+                len(manifest.changed), len(manifest.fingerprints), manifest.hits)
+    for pid, (count, elapsed) in sorted(worker_times.items()):
+        print >>sys.stderr, '  worker %d: %.3fs tracing %d subglyphs' % (pid, elapsed, count)
+
+    if PROFILE is not None:
+        PROFILE.record_layout(font, contour_cache)
+        if args.profile.endswith('.csv'):
+            with open(args.profile, 'wb') as f:
+                PROFILE.write(f, csv=True)
+            with open(args.profile[:-4] + '-remaps.csv', 'wb') as f:
+                PROFILE.write_remaps_csv(f)
+        else:
+            with open(args.profile, 'wb') as f:
+                PROFILE.write(f)
+        PROFILE.summarize(sys.stderr, args.profile_top)
+    if memory: memory.print_report(sys.stderr)
+
+    if budgets:
+        stats, merged_contours, merged_points = font.outline_stats(contour_cache)
+        print >>sys.stderr, 'outlines: %d contours and %d points in %d glyphs ' \
+                            '(%d contours and %d points removed by merging)' % (
+                sum(contours for contours, _ in stats.values()),
+                sum(points for _, points in stats.values()), len(stats),
+                merged_contours, merged_points)
+        over = sorted((-points, -contours, name) for name, (contours, points) in stats.items()
+                      if (args.max_contours is not None and contours > args.max_contours) or
+                         (args.max_points is not None and points > args.max_points))
+        for points, contours, name in over:
+            print >>sys.stderr, '  %-32s %d contours, %d points' % (name, -contours, -points)
+        if over:
+            print >>sys.stderr, '%d glyph(s) over the outline budget' % len(over)
+            raise SystemExit(1)